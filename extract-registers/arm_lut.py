@@ -0,0 +1,127 @@
+"""
+    Temperature lookup table of arm_cal, evaluated and fitted with numpy.
+
+    arm_cal holds three tables of up to 20 entries, lut_ov, lut_dg and lut_led, at the temperatures
+    lut_tmin + i*lut_dt.  The entries are relative to the calibration point in arm_ctrl (they are 1.0 at
+    cal_temp in the factory table in lib/sim_data/sipm_3k_nvmem.txt): the ARM uses cal_ov*lut_ov(T),
+    cal_dg*lut_dg(T) and cal_target*lut_led(T).  Between entries the tables are interpolated linearly; outside
+    of the table the end values hold.
+"""
+import numpy as np
+
+import mca3k_data
+
+TABLES = ('lut_ov', 'lut_dg', 'lut_led')
+MAX_ENTRIES = 20
+
+
+class arm_cal_lut:
+    def __init__(self, cal):
+        """
+            Precompute the tables of an arm_cal object.
+            :param cal: arm_cal with registers (or fields) filled in
+        """
+        if not cal.fields:
+            cal.registers_2_fields()
+        f = cal.fields
+        self.num = int(f['lut_len'])
+        if not 2 <= self.num <= MAX_ENTRIES:
+            raise ValueError(f'lut_len must be between 2 and {MAX_ENTRIES}, not {self.num}')
+        self.tmin = float(f['lut_tmin'])
+        self.dt = float(f['lut_dt'])
+        if self.dt <= 0:
+            raise ValueError('lut_dt must be positive')
+        self.lut_mode = f['lut_mode']
+        self.values = np.array([f[t][:self.num] for t in TABLES], dtype=np.float64)  # (3, num)
+        self.slopes = np.diff(self.values, axis=1)  # (3, num - 1), change per table step
+
+    def temperatures(self):
+        """
+            :return: temperatures of the table entries in deg C
+        """
+        return self.tmin + self.dt*np.arange(self.num)
+
+    def factors(self, temps):
+        """
+            Interpolate all three tables at an array of temperatures in one pass.
+            :param temps: temperatures in deg C, any shape
+            :return: {'lut_ov': array, 'lut_dg': array, 'lut_led': array}, each shaped like temps
+        """
+        x = (np.asarray(temps, dtype=np.float64) - self.tmin)/self.dt
+        x = np.clip(x, 0.0, self.num - 1)
+        i = np.minimum(x.astype(np.intp), self.num - 2)
+        frac = x - i
+        out = self.values[:, i] + self.slopes[:, i]*frac
+        return dict(zip(TABLES, out))
+
+    def evaluate(self, temps, ctrl):
+        """
+            Operating voltage, digital gain and LED target the ARM would use at each temperature.
+            :param temps: temperatures in deg C, e.g. the avg_temperature history of arm_status readouts
+            :param ctrl: arm_ctrl with fields (cal_ov, cal_dg, cal_target)
+            :return: {'op_voltage': array, 'dg_target': array, 'led_target': array}
+        """
+        if not ctrl.fields:
+            ctrl.registers_2_fields()
+        f = self.factors(temps)
+        return {
+            'op_voltage': ctrl.fields['cal_ov']*f['lut_ov'],
+            'dg_target': ctrl.fields['cal_dg']*f['lut_dg'],
+            'led_target': ctrl.fields['cal_target']*f['lut_led'],
+        }
+
+    @classmethod
+    def fit(cls, temps, lut_ov, lut_dg, lut_led, tmin=-30.0, dt=5.0, num=MAX_ENTRIES, smoothing=1e-3, lut_mode=0):
+        """
+            Least-squares fit of the three tables to calibration samples.  The unknowns are the table entries;
+            each sample constrains the two entries around its temperature with the interpolation weights.  A small
+            penalty on the second difference keeps entries without nearby samples well defined.
+            :param temps: sample temperatures in deg C
+            :param lut_ov, lut_dg, lut_led: relative operating voltage, digital gain and LED response measured at temps
+            :param tmin, dt, num: table layout
+            :param smoothing: weight of the curvature penalty relative to the sample weight
+            :return: arm_cal_lut
+        """
+        if not 2 <= num <= MAX_ENTRIES:
+            raise ValueError(f'num must be between 2 and {MAX_ENTRIES}')
+        t = np.asarray(temps, dtype=np.float64).ravel()
+        x = np.clip((t - tmin)/dt, 0.0, num - 1)
+        i = np.minimum(x.astype(np.intp), num - 2)
+        w1 = x - i
+        w0 = 1.0 - w1
+
+        # Normal equations of the hat-function basis: tridiagonal, accumulated with bincount
+        ata = np.zeros((num, num))
+        ata[np.arange(num), np.arange(num)] = np.bincount(i, w0*w0, num) + np.bincount(i + 1, w1*w1, num)
+        off = np.bincount(i, w0*w1, num)[:num - 1]
+        ata[np.arange(num - 1), np.arange(1, num)] = off
+        ata[np.arange(1, num), np.arange(num - 1)] = off
+        if num > 2:
+            d2 = np.diff(np.eye(num), n=2, axis=0)
+            ata += smoothing*max(len(t), 1)/num*(d2.T @ d2)
+
+        values = []
+        for y in (lut_ov, lut_dg, lut_led):
+            y = np.asarray(y, dtype=np.float64).ravel()
+            atb = np.bincount(i, w0*y, num) + np.bincount(i + 1, w1*y, num)
+            values.append(np.linalg.lstsq(ata, atb, rcond=None)[0])
+
+        cal = mca3k_data.arm_cal()
+        cal.fields = {'lut_len': float(num), 'lut_tmin': float(tmin), 'lut_dt': float(dt), 'lut_mode': lut_mode}
+        for name, v in zip(TABLES, values):
+            cal.fields[name] = list(v)
+        return cls(cal)
+
+    def to_arm_cal(self):
+        """
+            Build an arm_cal command holding this table, with fields and all 64 registers filled in.
+            Unused entries repeat the last value.
+            :return: arm_cal
+        """
+        cal = mca3k_data.arm_cal()
+        cal.fields = {'lut_len': float(self.num), 'lut_tmin': self.tmin, 'lut_dt': self.dt, 'lut_mode': self.lut_mode}
+        for name, v in zip(TABLES, self.values):
+            padded = np.concatenate([v, np.full(MAX_ENTRIES - self.num, v[-1])])
+            cal.fields[name] = [float(d) for d in padded]
+        cal.fields_2_registers()
+        return cal
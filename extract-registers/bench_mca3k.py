@@ -0,0 +1,320 @@
+"""
+    Benchmarks of the mca3k_data decode/encode paths on realistic, reproducible payloads.
+
+    Every command class is timed through registers_2_fields, fields_2_user, user_2_fields and fields_2_registers,
+    along with the vectorized and batch paths built on top of them (list mode arrays, trace_summary_batch,
+    statistics_columns, the bit-field batch codecs).  Payloads come from sim_events and the simulator files with a
+    fixed seed: full 12288-word nrl1 buffers, 340-event list mode buffers, 4096-bin histograms, 1024-sample traces
+    and statistics series.
+
+    Each case reports the time per call, items/s (events, samples, bins or register sets, see the items column) and
+    MB/s of register data.  Results can be saved as a baseline; later runs are compared against it and any case
+    slower than the baseline by more than the threshold is a regression (exit status 1).  A case that raises, and
+    a baseline case that is no longer run, fail the run as well.
+
+        python bench_mca3k.py                    # run and compare against bench_baseline.json, if it exists
+        python bench_mca3k.py --save-baseline    # run and store the results as the new baseline
+        python bench_mca3k.py -k nrl1 -k trace   # only cases whose name contains one of the filters
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+import numpy as np
+
+import mca3k_data
+import sim_events
+import stats_batch
+import trace_batch
+from mca3k_sim import SIM_DATA, load_nvmem, ARM, FPGA, ARM_VERSION_REGISTERS
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+METHODS = ('registers_2_fields', 'fields_2_user', 'user_2_fields', 'fields_2_registers')
+SEED = 3000
+
+# fpga_ctrl registers of FpgaCtrlContainer::LM_OPTIMIZED_REGISTERS
+FPGA_CTRL_REGISTERS = [17800, 20, 34, 72, 60, 65280, 100, 1092, 0, 0, 0, 0, 3906, 0, 33008, 32768]
+
+
+def synthetic_traces(num, length=1024, seed=SEED):
+    """
+        Raw fpga_trace registers: a noisy baseline with one pulse at a random position in most traces.
+        :return: (num, length) uint16 array
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(length)
+    start = rng.integers(100, length - 300, num)[:, None]
+    amp = rng.uniform(2000, 20000, num)[:, None]*(rng.random(num) < 0.9)[:, None]
+    dt = np.maximum(t - start, 0)
+    pulse = amp*(np.exp(-dt/60.0) - np.exp(-dt/5.0))
+    traces = 3200 + pulse + rng.normal(0, 20, (num, length))
+    return np.clip(traces, 0, 65535).astype(np.uint16)
+
+
+def payloads():
+    """
+        Registers for every command class, with the number of items each payload stands for.
+        :return: {class name: (registers, items, unit)}
+    """
+    gen = sim_events.event_generator(rate=2.0e5, background_rate=2.0e4, neutron_fraction=0.1, seed=SEED)
+    nvmem = load_nvmem(os.path.join(SIM_DATA, 'sipm_3k_nvmem.txt'))
+    rng = np.random.default_rng(SEED)
+    lm0 = gen.list_mode_buffers(1, mode=0)[0]
+    return {
+        'arm_ping': ([0]*16, 1, 'sets'),
+        'fpga_ctrl': (FPGA_CTRL_REGISTERS, 1, 'sets'),
+        'fpga_action': ([0, 0, 0, 0], 1, 'sets'),
+        'fpga_statistics': (rng.integers(0, 1 << 24, 16).tolist(), 1, 'sets'),
+        'fpga_results': (rng.integers(0, 1 << 16, 32).tolist(), 1, 'sets'),
+        'fpga_histogram': (sim_events.pack_histogram(gen.events(10**6)).tolist(), 4096, 'bins'),
+        'fpga_list_mode': (lm0.tolist(), int(lm0[0] & 0xFFF), 'events'),
+        'fpga_trace': (synthetic_traces(1)[0].tolist(), 1024, 'samples'),
+        'fpga_weights': (np.frombuffer(nvmem[(FPGA, mca3k_data.MA_WEIGHTS)], '<u2').tolist(), 1024, 'weights'),
+        'fpga_time_slice': (gen.time_slices(1)[0].tolist(), 1, 'slices'),
+        'arm_version': (list(ARM_VERSION_REGISTERS), 1, 'sets'),
+        'arm_status': (rng.uniform(0, 100, 16).tolist(), 1, 'sets'),
+        'arm_ctrl': (np.frombuffer(nvmem[(ARM, mca3k_data.ARM_CTRL)], '<f4')[:12].tolist(), 1, 'sets'),
+        'arm_cal': (np.frombuffer(nvmem[(ARM, mca3k_data.ARM_CAL)], '<f4').tolist(), 1, 'sets'),
+        'fpga_lm_nrl1': (gen.nrl1_buffers(1)[0].tolist(), sim_events.NRL1_EVENTS, 'events'),
+    }
+
+
+# Methods of each command that do real work and are timed; the others are empty stubs.  A listed method that
+# fails or has become a stub is reported as a failed case, never silently dropped.
+TIMED_METHODS = {
+    'arm_ping': (),
+    'fpga_ctrl': METHODS,
+    'fpga_action': ('registers_2_fields', 'fields_2_user', 'fields_2_registers'),
+    'fpga_statistics': ('registers_2_fields', 'fields_2_user'),
+    'fpga_results': ('registers_2_fields', 'fields_2_user'),
+    'fpga_histogram': ('registers_2_fields', 'fields_2_user'),
+    'fpga_list_mode': ('registers_2_fields', 'fields_2_user'),
+    'fpga_trace': ('registers_2_fields',),
+    'fpga_weights': (),
+    'fpga_time_slice': ('registers_2_fields',),
+    'arm_version': ('registers_2_fields', 'fields_2_user'),
+    'arm_status': ('registers_2_fields', 'fields_2_user'),
+    'arm_ctrl': METHODS,
+    'arm_cal': ('registers_2_fields', 'fields_2_registers'),
+    'fpga_lm_nrl1': ('registers_2_fields', 'fields_2_user'),
+}
+
+
+def _stub(self):
+    pass
+
+
+def _failed(error):
+    """
+        Stand-in for a case that could not be prepared; raises the original error when timed.
+    """
+    def fn():
+        raise error
+    return fn
+
+
+def prepared(name, registers):
+    """
+        Command object with registers, fields and user filled in by one pass through the chain, so every method
+        can be timed on its own.
+        :return: (object, {method name: callable}); the callable of a method that is a stub or fails on the
+                 payload raises its error when called
+    """
+    obj = mca3k_data.COMMANDS[name]()
+    obj.registers = list(registers)
+    methods = {}
+    for method in TIMED_METHODS[name]:
+        if getattr(type(obj), method).__code__.co_code == _stub.__code__.co_code:
+            methods[method] = _failed(NotImplementedError(f'{name}.{method} is an empty stub'))
+            continue
+        try:
+            getattr(obj, method)()
+            methods[method] = getattr(obj, method)
+        except Exception as e:
+            methods[method] = _failed(e)
+    obj.registers = list(registers)
+    return obj, methods
+
+
+def cases():
+    """
+        :return: list of (case name, callable, items per call, unit, bytes per call)
+    """
+    out = []
+    data = payloads()
+    for name, (registers, items, unit) in data.items():
+        obj, methods = prepared(name, registers)
+        for method, fn in methods.items():
+            out.append((f'{name}.{method}', fn, items, unit, obj.num_bytes))
+        raw = obj.to_bytes()
+        cls = type(obj)
+        out.append((f'{name}.from_buffer', lambda cls=cls, raw=raw: cls.from_buffer(raw), items, unit, len(raw)))
+
+    for mode in (0, 1):
+        buf = sim_events.event_generator(rate=2.0e5, seed=SEED).list_mode_buffers(1, mode)[0]
+        obj = mca3k_data.fpga_list_mode.from_buffer(buf.tobytes())
+        out.append((f'fpga_list_mode.registers_2_fields[mode{mode}]', obj.registers_2_fields,
+                    int(buf[0] & 0xFFF), 'events', obj.num_bytes))
+        out.append((f'fpga_list_mode.registers_2_fields[mode{mode},vectorized]',
+                    lambda obj=obj: obj.registers_2_fields(vectorized=True), int(buf[0] & 0xFFF), 'events',
+                    obj.num_bytes))
+
+    nrl1 = mca3k_data.fpga_lm_nrl1.from_buffer(np.asarray(data['fpga_lm_nrl1'][0], dtype='<u2').tobytes())
+    nrl1.registers_2_fields(vectorized=True)
+    vec = dict(nrl1.fields)
+    out.append(('fpga_lm_nrl1.registers_2_fields[vectorized]', lambda: nrl1.registers_2_fields(vectorized=True),
+                sim_events.NRL1_EVENTS, 'events', nrl1.num_bytes))
+
+    def nrl1_user():
+        nrl1.fields = vec
+        nrl1.fields_2_user()
+    out.append(('fpga_lm_nrl1.fields_2_user[vectorized]', nrl1_user, sim_events.NRL1_EVENTS, 'events',
+                nrl1.num_bytes))
+
+    def nrl1_quick_look():
+        nrl1.registers_2_fields(lazy=True)
+        nrl1.fields_2_user(lazy=True)
+        return nrl1.fields['num_events'], nrl1.user['energies']
+    out.append(('fpga_lm_nrl1.quick_look[lazy]', nrl1_quick_look, sim_events.NRL1_EVENTS, 'events',
+                nrl1.num_bytes))
+
+    trace = mca3k_data.fpga_trace()
+    trace.registers = data['fpga_trace'][0]
+    out.append(('fpga_trace.trace_summary', trace.trace_summary, 1024, 'samples', trace.num_bytes))
+    traces = synthetic_traces(4096)
+    out.append(('trace_batch.trace_summary_batch[4096]', lambda: trace_batch.trace_summary_batch(traces, processes=1),
+                traces.size, 'samples', traces.nbytes))
+
+    series = np.cumsum(np.random.default_rng(SEED).integers(0, 5000, (10000, 16)), axis=0).astype(np.uint32)
+    out.append(('stats_batch.statistics_columns[10000]', lambda: stats_batch.statistics_columns(series),
+                len(series), 'snapshots', series.nbytes))
+    out.append(('stats_batch.statistics_deltas[10000]', lambda: stats_batch.statistics_deltas(series),
+                len(series), 'snapshots', series.nbytes))
+
+    ctrl = np.tile(np.asarray(FPGA_CTRL_REGISTERS, dtype=np.uint16), (10000, 1))
+    fields = mca3k_data.fpga_ctrl.registers_2_fields_batch(ctrl)
+    out.append(('fpga_ctrl.registers_2_fields_batch[10000]',
+                lambda: mca3k_data.fpga_ctrl.registers_2_fields_batch(ctrl), len(ctrl), 'sets', ctrl.nbytes))
+    out.append(('fpga_ctrl.fields_2_registers_batch[10000]',
+                lambda: mca3k_data.fpga_ctrl.fields_2_registers_batch(fields), len(ctrl), 'sets', ctrl.nbytes))
+    return out
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """
+        Best time per call over repeat runs, each at least min_time/repeat long.
+        :return: seconds per call
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time/repeat:
+            break
+        number *= 2
+    return min(timer.repeat(repeat, number))/number
+
+
+def run(filters=(), min_time=0.2):
+    """
+        :param filters: substrings; only cases whose name contains one of them are run (all if empty)
+        :return: ({case name: {'seconds', 'items_per_s', 'unit', 'mb_per_s'}}, {case name: error message} of the
+                 cases that raised)
+    """
+    results = {}
+    failures = {}
+    for name, fn, items, unit, nbytes in cases():
+        if filters and not any(f in name for f in filters):
+            continue
+        try:
+            sec = measure(fn, min_time)
+        except Exception as e:
+            failures[name] = f'{type(e).__name__}: {e}'
+            continue
+        results[name] = {'seconds': sec, 'items_per_s': items/sec, 'unit': unit, 'mb_per_s': nbytes/sec/1e6}
+    return results, failures
+
+
+def compare(results, baseline, threshold, filters=()):
+    """
+        :param filters: as in run(); baseline cases outside of them are not expected in results
+        :return: {case name: time relative to the baseline}, the list of regressed case names and the list of
+                 baseline cases that were selected but have no result
+    """
+    ratios = {}
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        ratios[name] = r['seconds']/base['seconds']
+        if ratios[name] > 1.0 + threshold:
+            regressions.append(name)
+    missing = [name for name in baseline
+               if name not in results and (not filters or any(f in name for f in filters))]
+    return ratios, regressions, missing
+
+
+def report(results, ratios, out=sys.stdout):
+    width = max([len(n) for n in results] + [4])
+    out.write(f"{'case':<{width}}  {'us/call':>10}  {'items/s':>12} {'':<9}  {'MB/s':>9}  {'vs base':>8}\n")
+    for name, r in results.items():
+        rel = f'{(ratios[name] - 1)*100:+7.1f}%' if name in ratios else ''
+        out.write(f"{name:<{width}}  {r['seconds']*1e6:10.2f}  {r['items_per_s']:12.4g} {r['unit']:<9}  "
+                  f"{r['mb_per_s']:9.2f}  {rel:>8}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the mca3k_data decode/encode paths.')
+    parser.add_argument('-k', dest='filters', action='append', default=[],
+                        help='only run cases whose name contains this string (repeatable)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown against the baseline, as a fraction (default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent timing each case')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results, failures = run(args.filters, args.min_time)
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+    ratios, regressions, missing = compare(results, baseline, args.threshold, args.filters)
+    report(results, ratios)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as f:
+                stored = json.load(f)['results']
+        else:
+            stored = {}
+        stored.update(results)  # A filtered run only replaces its own cases
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                       'results': stored}, f, indent=1, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+    if failures:
+        print(f'{len(failures)} case(s) failed:', file=sys.stderr)
+        for name, msg in failures.items():
+            print(f'  {name}: {msg}', file=sys.stderr)
+    missing = [name for name in missing if name not in failures]
+    if missing:
+        print(f'{len(missing)} baseline case(s) were not run:', file=sys.stderr)
+        for name in missing:
+            print(f'  {name}', file=sys.stderr)
+    if regressions:
+        print(f'{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}:', file=sys.stderr)
+        for name in regressions:
+            print(f'  {name}: {ratios[name]:.2f}x', file=sys.stderr)
+    if failures or missing or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,205 @@
+"""
+    Coincidence event builder for several detectors, on the time stamps of list mode event chunks.
+
+    Each detector delivers time-sorted chunks of events as produced by lm_stream (the 'ticks' column holds
+    monotonic ADC clock ticks, e.g. the unwrapped 51-bit fpga_lm_nrl1 wall clock at 40 MHz).  coincidence_builder
+    keeps the not yet finished events of every detector and emits coincidence groups as soon as no future event
+    can change them: a group starts at the earliest event that has events of at least `multiplicity` different
+    detectors (itself included) within `window` after it, and takes all events in that window.  Events that
+    start no group and fall in none are singles and are dropped.
+
+    The matching is vectorized over all pending events: one searchsorted gives the end of every event's window
+    and per-detector cumulative counts give the number of detectors in it; only the qualifying group starts are
+    walked in Python.  A detector that stops delivering data would hold back all others, so events older than
+    max_lag behind the most advanced detector are finalized anyway; events that arrive after their time was
+    finalized are counted in `late` and dropped.
+
+    Emitted groups are dictionaries of numpy arrays with one entry per group member:
+        'group':        group number, counting from 0 over the whole run
+        'detector':     index of the detector in self.detectors
+        'index':        event number within the detector's stream
+        'ticks':        time stamp in ADC clock ticks, including the detector's offset
+        'multiplicity': number of different detectors in the group
+    plus the requested columns of the input chunks (e.g. 'energies', 'psd').
+"""
+import heapq
+
+import numpy as np
+
+
+class coincidence_builder:
+    def __init__(self, detectors, window=250e-9, multiplicity=2, adc_sr=40.0e6, offsets=None, max_lag=1.0,
+                 columns=('energies',)):
+        """
+            :param detectors: list of detector names, e.g. serial numbers
+            :param window: coincidence window in seconds, measured from the first event of a group
+            :param multiplicity: minimum number of different detectors in a group
+            :param adc_sr: ADC sampling rate in Hz, to convert window and max_lag to ticks
+            :param offsets: {detector: ticks} added to the time stamps of that detector, e.g. for cable delays
+            :param max_lag: seconds a detector may fall behind the most advanced one before its events are
+                            finalized without it; None waits for every detector
+            :param columns: names of the chunk columns copied into the groups
+        """
+        if multiplicity < 1:
+            raise ValueError('multiplicity must be at least 1')
+        self.detectors = list(detectors)
+        self.window = int(round(window*adc_sr))
+        self.multiplicity = multiplicity
+        self.adc_sr = adc_sr
+        offsets = offsets or {}
+        self.offsets = np.array([int(offsets.get(d, 0)) for d in self.detectors], dtype=np.int64)
+        self.max_lag = None if max_lag is None else int(round(max_lag*adc_sr))
+        self.columns = tuple(columns)
+
+        n = len(self.detectors)
+        self.last = [None]*n  # Latest time stamp fed per detector
+        self.closed = [False]*n  # Detectors that will deliver no more events
+        self.fed = [0]*n  # Events fed per detector, to number them
+        self.pending = [None]*n  # Unfinished events per detector: dictionary of arrays incl. 'ticks' and 'index'
+        self.cutoff = None  # Events before this tick are finished
+        self.groups = 0  # Groups emitted
+        self.late = 0  # Events dropped because they arrived after their time was finished
+
+    def feed(self, detector, chunk):
+        """
+            Add a time-sorted chunk of events of one detector and yield the groups that are now complete.
+            :param detector: name of the detector, as in self.detectors
+            :param chunk: dictionary of arrays with at least 'ticks' and the requested columns
+            :return: generator of group dictionaries (at most one)
+        """
+        d = self.detectors.index(detector)
+        ticks = np.asarray(chunk['ticks'], dtype=np.int64) + self.offsets[d]
+        if len(ticks) == 0:
+            return
+        if np.any(ticks[1:] < ticks[:-1]) or (self.last[d] is not None and ticks[0] < self.last[d]):
+            raise ValueError(f'events of detector {detector!r} are not sorted in time')
+        index = np.arange(self.fed[d], self.fed[d] + len(ticks), dtype=np.int64)
+        self.fed[d] += len(ticks)
+        self.last[d] = int(ticks[-1])
+
+        keep = 0 if self.cutoff is None else int(np.searchsorted(ticks, self.cutoff))
+        self.late += keep
+        new = {'ticks': ticks[keep:], 'index': index[keep:]}
+        for name in self.columns:
+            new[name] = np.asarray(chunk[name])[keep:]
+        old = self.pending[d]
+        self.pending[d] = new if old is None else {k: np.concatenate((old[k], v)) for k, v in new.items()}
+        horizon = self._horizon()
+        if horizon is not None:
+            yield from self._emit(horizon)
+
+    def close(self, detector):
+        """
+            Mark the end of the data of one detector, so the others no longer wait for it.
+            :return: generator of group dictionaries (at most one)
+        """
+        self.closed[self.detectors.index(detector)] = True
+        if all(self.closed):
+            yield from self.finish()
+            return
+        horizon = self._horizon()
+        if horizon is not None:
+            yield from self._emit(horizon)
+
+    def finish(self):
+        """
+            Treat all pending events as complete, e.g. at the end of a run.
+            :return: generator of group dictionaries (at most one)
+        """
+        yield from self._emit(None)
+
+    def _horizon(self):
+        """
+            :return: tick before which every open detector has delivered all of its events, or None if unknown
+        """
+        open_last = [t for t, closed in zip(self.last, self.closed) if not closed]
+        seen = [t for t in open_last if t is not None]
+        if not seen:
+            return None
+        horizon = min(seen) if len(seen) == len(open_last) else None
+        if self.max_lag is not None:
+            forced = max(seen) - self.max_lag
+            horizon = forced if horizon is None else max(horizon, forced)
+        return horizon
+
+    def _emit(self, horizon):
+        """
+            Build the groups whose first event is earlier than horizon - window and drop the events they and
+            the singles before that time used up.
+            :param horizon: see _horizon; None finishes everything
+        """
+        parts = [(d, p) for d, p in enumerate(self.pending) if p is not None and len(p['ticks'])]
+        if not parts:
+            return
+        finish_all = horizon is None
+        cols = {k: np.concatenate([p[k] for _, p in parts]) for k in parts[0][1]}
+        det = np.concatenate([np.full(len(p['ticks']), d, dtype=np.int64) for d, p in parts])
+        order = np.argsort(cols['ticks'], kind='stable')
+        t = cols['ticks'][order]
+        dd = det[order]
+
+        n_cut = len(t) if finish_all else int(np.searchsorted(t, horizon - self.window))
+        if n_cut == 0:
+            return
+        end = np.searchsorted(t, t[:n_cut] + self.window, side='right')
+        mult = np.zeros(n_cut, dtype=np.int64)
+        for d, _ in parts:
+            c = np.concatenate(([0], np.cumsum(dd == d)))
+            mult += c[end] > c[:n_cut]
+
+        starts, ends = [], []
+        pos = 0
+        for i in np.flatnonzero(mult >= self.multiplicity).tolist():
+            if i >= pos:
+                pos = int(end[i])
+                starts.append(i)
+                ends.append(pos)
+
+        used = max(n_cut, pos)
+        consumed = np.bincount(dd[:used], minlength=len(self.detectors))
+        for d, p in parts:
+            self.pending[d] = {k: v[consumed[d]:] for k, v in p.items()}
+        self.cutoff = None if finish_all else horizon - self.window
+        if not starts:
+            return
+
+        starts = np.asarray(starts, dtype=np.int64)
+        sizes = np.asarray(ends, dtype=np.int64) - starts
+        group = np.repeat(np.arange(len(starts), dtype=np.int64), sizes)
+        members = np.arange(len(group), dtype=np.int64) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        members += starts[group]
+        src = order[members]
+        out = {
+            'group': group + self.groups,
+            'detector': dd[members],
+            'index': cols['index'][src],
+            'ticks': t[members],
+            'multiplicity': mult[starts][group],
+        }
+        for name in self.columns:
+            out[name] = cols[name][src]
+        self.groups += len(starts)
+        yield out
+
+
+def build_coincidences(streams, **kwargs):
+    """
+        k-way merge of the event chunk streams of several detectors into coincidence groups.
+        The next chunk is always taken from the detector that is furthest behind, so the pending events stay
+        within about one chunk per detector.
+        :param streams: {detector: iterable of time-sorted chunk dictionaries}, e.g. lm_stream.stream_events
+        :param kwargs: passed to coincidence_builder
+        :return: generator of group dictionaries
+    """
+    builder = coincidence_builder(list(streams), **kwargs)
+    iters = {d: iter(s) for d, s in streams.items()}
+    heap = [(-1 << 62, k, d) for k, d in enumerate(streams)]  # (latest tick fed, tie breaker, detector)
+    while heap:
+        _, k, d = heapq.heappop(heap)
+        chunk = next(iters[d], None)
+        if chunk is None:
+            yield from builder.close(d)
+            continue
+        yield from builder.feed(d, chunk)
+        heapq.heappush(heap, (-1 << 62 if builder.last[k] is None else builder.last[k], k, d))
+    yield from builder.finish()
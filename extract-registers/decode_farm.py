@@ -0,0 +1,233 @@
+"""
+    Multi-process decoding of raw buffers from several detectors through shared memory.
+
+    decode_farm owns two multiprocessing.shared_memory blocks cut into slots: raw buffers are copied into an input
+    slot and the workers write the decoded events into the matching output slot as a fixed-layout record array.
+    Only slot numbers travel through the process pool, never the payloads.  Slots are handed to the workers in
+    batches so the per-task overhead of the pool is spread over several buffers.
+
+    Every buffer is tagged with the detector serial number (as returned by BaseManager::peek_serials) and gets a
+    sequence number per serial; results() returns the buffers of each detector in the order they were submitted.
+
+    Decoded results are dictionaries of numpy arrays:
+        'nrl1':       energies (MCA bins), wc (ADC ticks), psd, flags (bits 0-4 = xt, pu, ov, or, pps)
+        'list_mode':  energies (MCA bins), times (raw 32-bit mode 0 or 16-bit mode 1 counts), short_sums (MCA bins,
+                      mode 1 only); plus 'mode'
+        'time_slice': the scalar fields of fpga_time_slice.registers_2_fields and the 1006-bin histogram
+"""
+import collections
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import mca3k_data
+from lm_stream import NRL1_FLAGS
+
+KINDS = {
+    'nrl1': mca3k_data.fpga_lm_nrl1,
+    'list_mode': mca3k_data.fpga_list_mode,
+    'time_slice': mca3k_data.fpga_time_slice,
+}
+
+# Record layout of the decoded events in an output slot, and the most records a buffer can hold
+RESULT_DTYPES = {
+    'nrl1': (np.dtype([('energies', '<f8'), ('wc', '<u8'), ('psd', '<u2'), ('flags', 'u1')]), 2048 - 1),
+    'list_mode': (np.dtype([('energies', '<f8'), ('times', '<u4'), ('short_sums', '<f8')]), (1024 - 4)//3),
+    'time_slice': (np.dtype([('buffer_number', '<u2'), ('temperature', '<f8'), ('gamma_events', '<u2'),
+                             ('gamma_triggers', '<u2'), ('dead_time', '<f8'), ('neutron_counts', '<u2'),
+                             ('gm_counts', '<u2'), ('histogram', '<u2', (1024 - 18,))]), 1),
+}
+IN_SLOT_BYTES = max(cls().num_bytes for cls in KINDS.values())
+OUT_SLOT_BYTES = max(dt.itemsize*n for dt, n in RESULT_DTYPES.values())
+
+_worker = {}  # Shared memory attached in each worker process
+
+
+def _attach(in_name, out_name):
+    _worker['in'] = shared_memory.SharedMemory(name=in_name)
+    _worker['out'] = shared_memory.SharedMemory(name=out_name)
+    _worker['cmds'] = {kind: cls() for kind, cls in KINDS.items()}
+
+
+def decode_into(kind, raw, out, cmd=None, adc_sr=40.0e6):
+    """
+        Decode one raw buffer into an output record array.
+        :param kind: 'nrl1', 'list_mode' or 'time_slice'
+        :param raw: buffer holding the registers
+        :param out: record array of RESULT_DTYPES[kind], long enough for a full buffer
+        :param cmd: command object to reuse
+        :return: (number of records written, list mode mode or None)
+    """
+    cmd = KINDS[kind]() if cmd is None else cmd
+    cmd.load_buffer(raw, copy=False)
+    if kind == 'nrl1':
+        f = cmd.registers_2_arrays()
+        n = len(f['energies'])
+        out['energies'][:n] = f['energies']/16.0
+        out['wc'][:n] = f['wc']
+        out['psd'][:n] = f['psd']
+        flags = out['flags'][:n]
+        flags[:] = 0
+        for bit, name in enumerate(NRL1_FLAGS):
+            flags |= f[name] << bit
+        return n, None
+    if kind == 'list_mode':
+        f = cmd.registers_2_arrays()
+        n = min(f['num_events'], len(f['energies']))
+        out['energies'][:n] = f['energies'][:n]/16.0
+        out['times'][:n] = f['times'][:n]
+        out['short_sums'][:n] = f['short_sums'][:n]/16.0 if f['mode'] == 1 else 0.0
+        return n, f['mode']
+    words = np.frombuffer(raw, dtype='<u2', count=1024)
+    rec = out[0]
+    rec['buffer_number'] = words[0]
+    rec['temperature'] = words[1]/16.0
+    rec['gamma_events'] = words[8]
+    rec['gamma_triggers'] = words[10]
+    rec['dead_time'] = (int(words[12]) + int(words[13])*65536.0)/adc_sr
+    rec['neutron_counts'] = words[14]
+    rec['gm_counts'] = words[16]
+    rec['histogram'] = words[18:1024]
+    return 1, None
+
+
+def _decode_batch(tasks):
+    """
+        Worker: decode a batch of (slot, kind, nbytes) from the input slots into the output slots.
+        :return: list of (slot, number of records, mode)
+    """
+    done = []
+    for slot, kind, nbytes in tasks:
+        raw = _worker['in'].buf[slot*IN_SLOT_BYTES:slot*IN_SLOT_BYTES + nbytes]
+        dt, cap = RESULT_DTYPES[kind]
+        out = np.ndarray(cap, dtype=dt, buffer=_worker['out'].buf, offset=slot*OUT_SLOT_BYTES)
+        n, mode = decode_into(kind, raw, out, _worker['cmds'][kind])
+        del raw, out  # Release the exported buffers of the shared memory
+        done.append((slot, n, mode))
+    return done
+
+
+class decode_farm:
+    def __init__(self, processes=None, num_slots=256, batch_size=16):
+        """
+            :param processes: number of worker processes; None uses all cores
+            :param num_slots: buffers that can be in flight at once
+            :param batch_size: buffers handed to a worker per task
+        """
+        self.num_slots = num_slots
+        self.batch_size = batch_size
+        self.shm_in = shared_memory.SharedMemory(create=True, size=num_slots*IN_SLOT_BYTES)
+        self.shm_out = shared_memory.SharedMemory(create=True, size=num_slots*OUT_SLOT_BYTES)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            processes, initializer=_attach, initargs=(self.shm_in.name, self.shm_out.name))
+
+        self.free = collections.deque(range(num_slots))
+        self.slot_info = {}  # slot -> (serial, sequence number, kind)
+        self.batch = []  # (slot, kind, nbytes) not yet handed to the pool
+        self.futures = set()
+        self.next_seq = collections.defaultdict(int)  # serial -> next sequence number to hand out
+        self.next_out = collections.defaultdict(int)  # serial -> next sequence number to return
+        self.ready = collections.defaultdict(dict)  # serial -> {sequence number: result}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, serial, kind, buf):
+        """
+            Copy a raw buffer into a free slot and queue it for decoding.  Blocks while all slots are in use.
+            :param serial: detector serial number
+            :param kind: 'nrl1', 'list_mode' or 'time_slice'
+            :param buf: bytes-like raw buffer, or a command object holding registers
+            :return: sequence number of the buffer for this serial
+        """
+        if kind not in KINDS:
+            raise ValueError(f'kind must be one of {sorted(KINDS)}, not {kind!r}')
+        raw = buf.to_bytes() if hasattr(buf, 'to_bytes') else buf
+        raw = memoryview(raw).cast('B')
+        nbytes = KINDS[kind]().num_bytes
+        if len(raw) < nbytes:
+            raise ValueError(f'{kind} buffer needs {nbytes} bytes, got {len(raw)}')
+        while not self.free:
+            if self.batch:
+                self._dispatch()
+            self._collect(block=True)
+
+        slot = self.free.popleft()
+        self.shm_in.buf[slot*IN_SLOT_BYTES:slot*IN_SLOT_BYTES + nbytes] = raw[:nbytes]
+        seq = self.next_seq[serial]
+        self.next_seq[serial] += 1
+        self.slot_info[slot] = (serial, seq, kind)
+        self.batch.append((slot, kind, nbytes))
+        if len(self.batch) >= self.batch_size:
+            self._dispatch()
+        return seq
+
+    def _dispatch(self):
+        self.futures.add(self.pool.submit(_decode_batch, self.batch))
+        self.batch = []
+
+    def _collect(self, block):
+        """
+            Copy finished results out of their output slots and free the slots.
+        """
+        if not self.futures:
+            return
+        done, _ = concurrent.futures.wait(
+            self.futures, timeout=None if block else 0, return_when=concurrent.futures.FIRST_COMPLETED)
+        for fut in done:
+            self.futures.discard(fut)
+            for slot, n, mode in fut.result():
+                serial, seq, kind = self.slot_info.pop(slot)
+                dt, cap = RESULT_DTYPES[kind]
+                rec = np.ndarray(n, dtype=dt, buffer=self.shm_out.buf, offset=slot*OUT_SLOT_BYTES).copy()
+                result = {name: rec[name] for name in dt.names}
+                if kind == 'list_mode':
+                    result['mode'] = mode
+                    if mode == 0:
+                        del result['short_sums']
+                elif kind == 'time_slice':
+                    result = {name: v[0] for name, v in result.items()}
+                self.ready[serial][seq] = (kind, result)
+                self.free.append(slot)
+
+    def results(self, wait=False):
+        """
+            Return decoded buffers, per serial number in submission order.  A buffer is only returned once all
+            earlier buffers of the same detector are.
+            :param wait: first wait until every submitted buffer is decoded
+            :return: list of (serial, sequence number, kind, result)
+        """
+        if self.batch:
+            self._dispatch()
+        if wait:
+            while self.futures:
+                self._collect(block=True)
+        else:
+            self._collect(block=False)
+        out = []
+        for serial, ready in self.ready.items():
+            seq = self.next_out[serial]
+            while seq in ready:
+                kind, result = ready.pop(seq)
+                out.append((serial, seq, kind, result))
+                seq += 1
+            self.next_out[serial] = seq
+        return out
+
+    def close(self):
+        """
+            Stop the workers and release the shared memory.
+            :return: None
+        """
+        if self.pool is None:
+            return
+        self.pool.shutdown(wait=True)
+        self.pool = None
+        self.shm_in.close()
+        self.shm_out.close()
+        self.shm_in.unlink()
+        self.shm_out.unlink()
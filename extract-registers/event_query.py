@@ -0,0 +1,297 @@
+"""
+    Vectorized event selection on the packed flag word of fpga_lm_nrl1 buffers and on archived event columns.
+
+    Predicates are built from flag(), no_flags(), energy(), psd() and ticks() and combined with &, | and ~, e.g.
+        no_flags('pu', 'ov') & energy(600, 700)
+    event_query compiles a predicate into one boolean mask over the events.  All flag tests of a conjunction are
+    merged into a single (word & care) == value comparison on the raw flag word (nrl1 word 11, bits 3..7), energy
+    and psd bounds are converted to raw register units so the uint16 columns are compared without conversion, and
+    the 51-bit wall clock is only assembled when a time range is asked for.  The nrl1 buffer is read through a
+    record view with an overlapping uint64 field over wc0..wc3, so none of the per-flag lists of
+    registers_2_fields are built.
+
+    Sources are fpga_lm_nrl1 objects, raw nrl1 buffers, NRL1_RECORD arrays, or column dictionaries with the packed
+    'flags' of lm_archive (bits 0..4 = xt, pu, ov, or, pps), 'energy' or 'energies' in MCA bins, 'psd' and 'ticks',
+    such as lm_archive.read() returns.
+"""
+import math
+
+import numpy as np
+
+import mca3k_data
+from lm_stream import NRL1_FLAGS
+
+FLAG_BITS = {name: bit for bit, name in enumerate(NRL1_FLAGS)}  # Packed flag bits, as in lm_archive
+NRL1_FLAG_SHIFT = 3  # Position of the xt bit in nrl1 word 11
+WC_MASK = (1 << 51) - 1
+
+# nrl1 event record with the wall clock words read as one little-endian uint64 (wc3 flags masked off later)
+NRL1_VIEW = np.dtype({'names': ['psd', 'energy', 'wc', 'wc3'], 'formats': ['<u2', '<u2', '<u8', '<u2'],
+                      'offsets': [0, 2, 4, 10], 'itemsize': 12})
+
+
+class predicate:
+    def __and__(self, other):
+        return all_of(self, other)
+
+    def __or__(self, other):
+        return any_of(self, other)
+
+    def __invert__(self):
+        return not_of(self)
+
+
+class flag_test(predicate):
+    def __init__(self, care, value):
+        """
+            :param care: packed flag bits that are tested
+            :param value: required values of those bits
+        """
+        self.care = care
+        self.value = value & care
+
+    def __invert__(self):
+        if bin(self.care).count('1') == 1:
+            return flag_test(self.care, self.value ^ self.care)
+        return not_of(self)
+
+    def __repr__(self):
+        on = [n for n, b in FLAG_BITS.items() if self.care & self.value & (1 << b)]
+        off = [n for n, b in FLAG_BITS.items() if self.care & ~self.value & (1 << b)]
+        return f'flags(on={on}, off={off})'
+
+
+class range_test(predicate):
+    def __init__(self, column, lo, hi):
+        """
+            :param column: 'energy' (MCA bins), 'psd' (raw) or 'ticks' (ADC clock ticks)
+            :param lo: inclusive lower bound, None for none
+            :param hi: exclusive upper bound, None for none
+        """
+        self.column = column
+        self.lo = lo
+        self.hi = hi
+
+    def __repr__(self):
+        return f'{self.column}[{self.lo}, {self.hi})'
+
+
+class all_of(predicate):
+    def __init__(self, *terms):
+        self.terms = []
+        for t in terms:
+            self.terms.extend(t.terms if isinstance(t, all_of) else [t])
+
+    def __repr__(self):
+        return '(' + ' & '.join(map(repr, self.terms)) + ')'
+
+
+class any_of(predicate):
+    def __init__(self, *terms):
+        self.terms = []
+        for t in terms:
+            self.terms.extend(t.terms if isinstance(t, any_of) else [t])
+
+    def __repr__(self):
+        return '(' + ' | '.join(map(repr, self.terms)) + ')'
+
+
+class not_of(predicate):
+    def __init__(self, term):
+        self.term = term
+
+    def __repr__(self):
+        return f'~{self.term!r}'
+
+
+def _bits(names):
+    unknown = set(names) - set(FLAG_BITS)
+    if unknown:
+        raise ValueError(f'Unknown flags: {sorted(unknown)}')
+    return sum(1 << FLAG_BITS[n] for n in names)
+
+
+def flag(*names):
+    """
+        :return: predicate true where all named flags are set
+    """
+    bits = _bits(names)
+    return flag_test(bits, bits)
+
+
+def no_flags(*names):
+    """
+        :return: predicate true where none of the named flags is set
+    """
+    return flag_test(_bits(names), 0)
+
+
+def energy(lo=None, hi=None):
+    """
+        :return: predicate lo <= energy < hi, in MCA bins
+    """
+    return range_test('energy', lo, hi)
+
+
+def psd(lo=None, hi=None):
+    """
+        :return: predicate lo <= psd < hi, in raw psd units
+    """
+    return range_test('psd', lo, hi)
+
+
+def ticks(lo=None, hi=None):
+    """
+        :return: predicate lo <= time stamp < hi, in ADC clock ticks
+    """
+    return range_test('ticks', lo, hi)
+
+
+QUALITY = no_flags('pu', 'ov', 'or')  # The usual event quality cut
+
+
+class _columns:
+    """
+        Uniform access to the columns of a source; derived columns are built once, on first use.
+    """
+    def __init__(self, source):
+        if isinstance(source, dict):
+            self.rec = None
+            self.flags = np.asarray(source['flags'])
+            self.shift = 0
+            e = source['energy'] if 'energy' in source else source['energies']
+            self.cols = {'energy': np.asarray(e), 'psd': source.get('psd'), 'ticks': source.get('ticks')}
+            self.energy_scale = 1.0
+            self.n = len(self.flags)
+            return
+        if isinstance(source, mca3k_data.fpga_lm_nrl1):
+            source = source.records()
+        elif not isinstance(source, np.ndarray) or source.dtype.names is None:
+            words = np.frombuffer(source, dtype='<u2') if isinstance(source, (bytes, bytearray, memoryview)) \
+                else np.ascontiguousarray(source, dtype=np.uint16)
+            count = max(0, min(int(words[0]) & 0xFFF, len(words)//6) - 1)
+            source = words[6:6*(count + 1)].view(mca3k_data.NRL1_RECORD)
+        self.rec = np.ascontiguousarray(source).view(NRL1_VIEW)
+        self.flags = self.rec['wc3']
+        self.shift = NRL1_FLAG_SHIFT
+        self.cols = {'energy': self.rec['energy'], 'psd': self.rec['psd'], 'ticks': None}
+        self.energy_scale = 16.0  # Raw nrl1 energy units per MCA bin
+        self.n = len(self.rec)
+
+    def get(self, name):
+        col = self.cols[name]
+        if col is None and name == 'ticks' and self.rec is not None:
+            col = self.cols['ticks'] = self.rec['wc'] & np.uint64(WC_MASK)
+        if col is None:
+            raise ValueError(f'the source has no {name!r} column')
+        return col
+
+
+class event_query:
+    def __init__(self, where):
+        """
+            :param where: predicate, e.g. QUALITY & energy(600, 700)
+        """
+        self.where = where
+
+    def __repr__(self):
+        return f'event_query({self.where!r})'
+
+    def mask(self, source):
+        """
+            :param source: see the module docstring
+            :return: boolean array, one entry per event
+        """
+        return self._eval(self.where, source if isinstance(source, _columns) else _columns(source))
+
+    def count(self, source):
+        return int(np.count_nonzero(self.mask(source)))
+
+    def select(self, source):
+        """
+            Gather the selected events.  Only the selected records are decoded.
+            :param source: see the module docstring
+            :return: dictionary with 'index' (event number in the source), 'energies' (MCA bins), 'psd', 'ticks'
+                     and the packed 'flags' (bits 0..4 = xt, pu, ov, or, pps); for nrl1 sources also 'records',
+                     the selected raw NRL1_RECORD entries
+        """
+        cols = _columns(source)
+        index = np.flatnonzero(self._eval(self.where, cols))
+        out = {'index': index}
+        if cols.rec is not None:
+            rec = cols.rec[index]
+            out['records'] = rec.view(mca3k_data.NRL1_RECORD)
+            out['energies'] = rec['energy']/16.0
+            out['psd'] = rec['psd']
+            out['ticks'] = rec['wc'] & np.uint64(WC_MASK)
+            out['flags'] = ((rec['wc3'] >> NRL1_FLAG_SHIFT) & 0x1F).astype(np.uint8)
+            return out
+        out['energies'] = cols.cols['energy'][index]
+        out['flags'] = cols.flags[index]
+        for name in ('psd', 'ticks'):
+            if cols.cols[name] is not None:
+                out[name] = cols.cols[name][index]
+        return out
+
+    def _eval(self, node, cols):
+        if isinstance(node, all_of):
+            care = value = 0
+            rest = []
+            for t in node.terms:
+                if isinstance(t, flag_test):
+                    if (value ^ t.value) & care & t.care:
+                        return np.zeros(cols.n, dtype=bool)  # Contradictory flag tests
+                    care |= t.care
+                    value |= t.value
+                else:
+                    rest.append(t)
+            mask = self._flags(cols, care, value) if care else None
+            for t in rest:
+                m = self._eval(t, cols)
+                if mask is None:
+                    mask = m
+                else:
+                    mask &= m
+            return np.ones(cols.n, dtype=bool) if mask is None else mask
+        if isinstance(node, any_of):
+            mask = self._eval(node.terms[0], cols)
+            for t in node.terms[1:]:
+                mask |= self._eval(t, cols)
+            return mask
+        if isinstance(node, not_of):
+            return ~self._eval(node.term, cols)
+        if isinstance(node, flag_test):
+            return self._flags(cols, node.care, node.value)
+        if isinstance(node, range_test):
+            return self._range(cols, node)
+        raise TypeError(f'not a predicate: {node!r}')
+
+    @staticmethod
+    def _flags(cols, care, value):
+        word = cols.flags & (care << cols.shift)
+        return word == (value << cols.shift)
+
+    @staticmethod
+    def _range(cols, node):
+        col = cols.get(node.column)
+        lo, hi = node.lo, node.hi
+        if node.column == 'energy':
+            lo = None if lo is None else lo*cols.energy_scale
+            hi = None if hi is None else hi*cols.energy_scale
+        if col.dtype.kind in 'ui':
+            # Integer bounds keep the comparison in the column's own type; clip to its range
+            info = np.iinfo(col.dtype)
+            lo = None if lo is None else min(max(math.ceil(lo), info.min), info.max + 1)
+            hi = None if hi is None else min(max(math.ceil(hi), info.min), info.max + 1)
+            if (lo is not None and lo > info.max) or (hi is not None and hi <= info.min):
+                return np.zeros(cols.n, dtype=bool)
+            lo = None if lo is None or lo <= info.min else col.dtype.type(lo)
+            hi = None if hi is None or hi > info.max else col.dtype.type(hi)
+        if lo is None and hi is None:
+            return np.ones(cols.n, dtype=bool)
+        if lo is None:
+            return col < hi
+        mask = col >= lo
+        if hi is not None:
+            mask &= col < hi
+        return mask
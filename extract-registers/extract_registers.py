@@ -1,20 +1,43 @@
+import argparse
 import json
 import os
 import sys
 import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 import mca3k_data
 
+# C++ container and register count for the commands that are written to the detector.
+# arm_ctrl has 12 registers in mca3k_data but 16 in ArmCtrlContainer; the rest is zero padding.
+CPP_CONTAINERS = {
+    'fpga_ctrl': ('FpgaCtrlContainer', 16),
+    'fpga_action': ('FpgaActionContainer', 4),
+    'arm_ctrl': ('ArmCtrlContainer', 16),
+}
+
+
+def settings_2_registers(k, fields):
+    """
+        Run one command's saved fields through fields_2_user and fields_2_registers.
+        :param k: command name, a key of mca3k_data.COMMANDS
+        :param fields: the 'fields' dictionary saved for that command
+        :return: list of registers
+    """
+    obj = mca3k_data.COMMANDS[k]()
+    obj.fields = fields
+    obj.fields_2_user()
+    obj.fields_2_registers()
+    return list(obj.registers)
+
+
 def extract_registers(settings):
     for k in settings:
         loaded = settings[k]['fields']
-        obj = eval(f'mca3k_data.{k}()')
-        obj.fields = loaded
         try:
-            obj.fields_2_user()
-            obj.fields_2_registers()
+            registers = settings_2_registers(k, loaded)
             print(f'Computed registers for {k}:')
-            print(obj.registers)
+            print(registers)
         except KeyError as e:
             print(
                 "*" * 80,
@@ -28,15 +51,183 @@ def extract_registers(settings):
             print("*" * 80)
 
 
+def process_file(path):
+    """
+        Compute the registers of every command in one settings file.  Problems are recorded, not raised,
+        so one bad file doesn't stop a batch.
+        :return: {'file': path, 'registers': {command: registers}, 'errors': {command: message}}
+    """
+    result = {'file': path, 'registers': {}, 'errors': {}}
+    try:
+        with open(path, 'r') as f:
+            settings = json.loads(f.read())
+    except (OSError, ValueError) as e:
+        result['errors']['*'] = f'could not read settings: {e}'
+        return result
+    if not isinstance(settings, dict):
+        result['errors']['*'] = f'settings must be a JSON object of commands, not {type(settings).__name__}'
+        return result
+
+    for k in settings:
+        if k not in mca3k_data.COMMANDS:
+            result['errors'][k] = 'unknown command'
+            continue
+        fields = settings[k].get('fields') if isinstance(settings[k], dict) else None
+        if not isinstance(fields, dict):
+            result['errors'][k] = "missing or invalid 'fields' dictionary"
+            continue
+        try:
+            result['registers'][k] = settings_2_registers(k, fields)
+        except KeyError as e:
+            result['errors'][k] = f'missing key {e}; probably a self-clearing value that was not saved'
+        except (TypeError, ValueError) as e:
+            result['errors'][k] = f'invalid field value: {e}'
+    return result
+
+
+def find_settings_files(paths):
+    """
+        Expand directories into the .json files they contain (recursively); files are taken as given.
+    """
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, names in os.walk(p):
+                dirs.sort()
+                files.extend(os.path.join(root, n) for n in sorted(names) if n.endswith('.json'))
+        else:
+            files.append(p)
+    return files
+
+
+def cpp_name(path, root=None):
+    """
+        C++ identifier for the registers of a settings file, from its path relative to root without the
+        extension (just its file name if root is None), e.g. det1/settings.json -> DET1_SETTINGS_REGISTERS.
+    """
+    rel = os.path.relpath(path, root) if root is not None else os.path.basename(path)
+    rel = os.path.splitext(rel)[0]
+    name = ''.join(c if c.isalnum() else '_' for c in rel).upper()
+    return ('_' + name if name[:1].isdigit() else name) + '_REGISTERS'
+
+
+def cpp_names(paths):
+    """
+        Unique C++ identifiers for settings files: the file name where that is unique, otherwise the path
+        relative to the files' common directory, with a numeric suffix if names still collide.
+        :return: dictionary of path -> identifier
+    """
+    paths = list(dict.fromkeys(paths))
+    names = {p: cpp_name(p) for p in paths}
+    counts = Counter(names.values())
+    clashes = [p for p in paths if counts[names[p]] > 1]
+    if clashes:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in clashes])
+        for p in clashes:
+            names[p] = cpp_name(os.path.abspath(p), root)
+    used = set()
+    for p in paths:
+        name, n = names[p], 1
+        while name in used:
+            n += 1
+            name = names[p][:-len('_REGISTERS')] + f'_{n}_REGISTERS'
+        names[p] = name
+        used.add(name)
+    return names
+
+
+def cpp_initializers(results):
+    """
+        Format the registers as C++ initializers like FpgaCtrlContainer::LM_OPTIMIZED_REGISTERS,
+        grouped by container class.
+        :return: str
+    """
+    lines = []
+    names = cpp_names(r['file'] for r in results)
+    for k, (container, num_regs) in CPP_CONTAINERS.items():
+        entries = [(r['file'], r['registers'][k]) for r in results if k in r['registers']]
+        if not entries:
+            continue
+        lines.append(f'// {container} ({k})')
+        for path, regs in entries:
+            regs = regs + [0.0 if mca3k_data.COMMANDS[k]().data_type == 'f' else 0] * (num_regs - len(regs))
+            lines.append(f'// computed using extract_registers.py from {path}')
+            lines.append(f'static constexpr Registers {names[path]} = {{')
+            lines.append('    ' + ', '.join(repr(r) for r in regs))
+            lines.append('};')
+        lines.append('')
+    return os.linesep.join(lines)
+
+
+def write_register_table(results, path):
+    """
+        Save the registers as a numpy .npz table: for each command an (N, num_items) array and an N-element
+        'valid' mask, plus the N file names.
+    """
+    import numpy as np
+    table = {'files': np.array([r['file'] for r in results])}
+    names = sorted({k for r in results for k in r['registers']})
+    for k in names:
+        cmd = mca3k_data.COMMANDS[k]()
+        regs = np.zeros((len(results), cmd.num_items), dtype=cmd.data_type)
+        valid = np.zeros(len(results), dtype=bool)
+        for i, r in enumerate(results):
+            if k in r['registers']:
+                regs[i] = r['registers'][k]
+                valid[i] = True
+        table[k] = regs
+        table[k + '_valid'] = valid
+    np.savez(path, **table)
+
+
+def extract_batch(paths, jobs=None):
+    """
+        Process many settings files in a process pool.
+        :param paths: settings files and/or directories of them
+        :param jobs: number of worker processes; None uses all cores
+        :return: list of process_file results, in file order
+    """
+    files = find_settings_files(paths)
+    if jobs == 1 or len(files) < 2:
+        return [process_file(f) for f in files]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(process_file, files, chunksize=max(1, len(files)//64)))
+
+
 def main():
-    if len(sys.argv) != 2:
-        print('Usage: python extract_registers.py [settings file name]')
-        exit(1)
+    parser = argparse.ArgumentParser(
+        description='Compute detector registers from saved settings files. With a single file and no options '
+                    'the registers are printed; otherwise all files are processed in parallel.')
+    parser.add_argument('paths', nargs='+', help='settings files or directories of .json settings files')
+    parser.add_argument('-o', '--output', help='output file; .npz writes a binary register table, '
+                                               'anything else JSON lines (default: JSON lines to stdout)')
+    parser.add_argument('--cpp', help='also write C++ register initializers to this file')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    if len(args.paths) == 1 and os.path.isfile(args.paths[0]) and not (args.output or args.cpp or args.jobs):
+        with open(args.paths[0], 'r') as f:
+            settings = json.loads(f.read())
+        extract_registers(settings)
+        return
+
+    results = extract_batch(args.paths, args.jobs)
+    for r in results:
+        for k, msg in r['errors'].items():
+            print(f"{r['file']}: {k}: {msg}", file=sys.stderr)
 
-    with open(sys.argv[1], 'r') as f:
-        settings = json.loads(f.read())
+    if args.output and args.output.endswith('.npz'):
+        write_register_table(results, args.output)
+    else:
+        out = open(args.output, 'w') if args.output else sys.stdout
+        for r in results:
+            out.write(json.dumps(r) + '\n')
+        if out is not sys.stdout:
+            out.close()
 
-    extract_registers(settings)
+    if args.cpp:
+        with open(args.cpp, 'w') as f:
+            f.write(cpp_initializers(results))
 
 
 if __name__ == '__main__': main()
@@ -0,0 +1,259 @@
+"""
+    Append-only, memory-mapped archive of decoded list mode events.
+
+    An archive is a directory of fixed-width little-endian column files, one value per event:
+        ticks.i8    unwrapped time stamp in ADC clock ticks (int64, non-decreasing)
+        energy.f4   energy in MCA bins (float32; exact for 16-bit raw energies)
+        psd.u2      raw psd word (nrl1) or raw short sum (mode 1); 0 for mode 0
+        flags.u1    event flags, bit 0..4 = xt, pu, ov, or, pps (nrl1 word 11 bits 3..7)
+    plus a sparse index, index.i8, holding (ticks, offset) pairs for every index_stride-th event, and
+    meta.json with the sampling rate and index stride.
+
+    Writers append the chunks produced by lm_stream; readers open the columns with numpy.memmap and only touch
+    the pages covering the requested time range.
+"""
+import json
+import os
+
+import numpy as np
+
+from lm_stream import NRL1_FLAGS
+
+COLUMNS = {
+    'ticks': np.dtype('<i8'),
+    'energy': np.dtype('<f4'),
+    'psd': np.dtype('<u2'),
+    'flags': np.dtype('u1'),
+}
+FILE_NAMES = {'ticks': 'ticks.i8', 'energy': 'energy.f4', 'psd': 'psd.u2', 'flags': 'flags.u1'}
+INDEX_FILE = 'index.i8'
+META_FILE = 'meta.json'
+VERSION = 1
+
+
+def pack_flags(chunk):
+    """
+        Pack the nrl1 flag columns of a chunk into one uint8 per event.
+        :return: uint8 array; zeros if the chunk has no flags
+    """
+    n = len(chunk['ticks'])
+    flags = np.zeros(n, dtype=np.uint8)
+    for bit, name in enumerate(NRL1_FLAGS):
+        if name in chunk:
+            flags |= (np.asarray(chunk[name], dtype=np.uint8) & 1) << bit
+    return flags
+
+
+def _event_count(path):
+    """
+        Number of complete events in an archive: the shortest column wins, so a torn write is ignored.
+    """
+    counts = []
+    for name, dt in COLUMNS.items():
+        fn = os.path.join(path, FILE_NAMES[name])
+        counts.append(os.path.getsize(fn)//dt.itemsize if os.path.exists(fn) else 0)
+    return min(counts)
+
+
+class lm_archive_writer:
+    def __init__(self, path, adc_sr=40.0e6, index_stride=4096):
+        """
+            Open an archive for appending, creating it if needed.  An existing archive keeps its own
+            adc_sr and index_stride.
+            :param path: archive directory
+            :param adc_sr: ADC sampling rate in Hz
+            :param index_stride: number of events between two index entries
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_fn = os.path.join(path, META_FILE)
+        if os.path.exists(meta_fn):
+            with open(meta_fn, 'r') as f:
+                meta = json.loads(f.read())
+            adc_sr = meta['adc_sr']
+            index_stride = meta['index_stride']
+        self.adc_sr = adc_sr
+        self.index_stride = int(index_stride)
+
+        self.count = _event_count(path)
+        self.last_tick = None
+        if self.count:
+            ticks = np.memmap(os.path.join(path, FILE_NAMES['ticks']), dtype=COLUMNS['ticks'], mode='r',
+                              shape=(self.count,))
+            self.last_tick = int(ticks[-1])
+            del ticks
+
+        self.files = {}
+        for name in COLUMNS:
+            f = open(os.path.join(path, FILE_NAMES[name]), 'ab')
+            f.truncate(self.count*COLUMNS[name].itemsize)  # Drop a torn tail left by an interrupted writer
+            self.files[name] = f
+        self.index_file = open(os.path.join(path, INDEX_FILE), 'ab')
+        self._repair_index()
+        self._write_meta()
+
+    def append(self, chunk):
+        """
+            Append one chunk of events, as yielded by lm_stream.
+            :param chunk: dictionary with at least 'ticks' and 'energies'; 'psd', 'short_sums' and the nrl1 flags are optional
+            :return: None
+        """
+        ticks = np.asarray(chunk['ticks'], dtype=np.int64)
+        n = len(ticks)
+        if n == 0:
+            return
+        if np.any(ticks[1:] < ticks[:-1]) or (self.last_tick is not None and ticks[0] < self.last_tick):
+            raise ValueError('lm_archive: time stamps must be non-decreasing')
+
+        if 'psd' in chunk:
+            psd = np.asarray(chunk['psd'], dtype=np.uint16)
+        elif 'short_sums' in chunk:
+            psd = np.rint(np.asarray(chunk['short_sums'])*16.0).astype(np.uint16)
+        else:
+            psd = np.zeros(n, dtype=np.uint16)
+        cols = {
+            'ticks': ticks,
+            'energy': np.asarray(chunk['energies'], dtype=np.float32),
+            'psd': psd,
+            'flags': pack_flags(chunk),
+        }
+        for name, arr in cols.items():
+            self.files[name].write(arr.astype(COLUMNS[name], copy=False).tobytes())
+
+        # Index entries fall on multiples of index_stride
+        first = -(-self.count//self.index_stride)*self.index_stride
+        offsets = np.arange(first, self.count + n, self.index_stride, dtype=np.int64)
+        if len(offsets):
+            entries = np.empty((len(offsets), 2), dtype='<i8')
+            entries[:, 0] = ticks[offsets - self.count]
+            entries[:, 1] = offsets
+            self.index_file.write(entries.tobytes())
+
+        self.count += n
+        self.last_tick = int(ticks[-1])
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+        self.index_file.flush()
+        self._write_meta()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _repair_index(self):
+        """
+            Make the index file agree with the ticks column after an interrupted write.
+        """
+        num_index = -(-self.count//self.index_stride)
+        have = min(os.path.getsize(os.path.join(self.path, INDEX_FILE))//16, num_index)
+        self.index_file.truncate(have*16)
+        if have < num_index:
+            ticks = np.memmap(os.path.join(self.path, FILE_NAMES['ticks']), dtype=COLUMNS['ticks'], mode='r',
+                              shape=(self.count,))
+            offsets = np.arange(have, num_index, dtype=np.int64)*self.index_stride
+            entries = np.empty((len(offsets), 2), dtype='<i8')
+            entries[:, 0] = ticks[offsets]
+            entries[:, 1] = offsets
+            self.index_file.write(entries.tobytes())
+            self.index_file.flush()
+            del ticks
+
+    def _write_meta(self):
+        meta = {'version': VERSION, 'adc_sr': self.adc_sr, 'index_stride': self.index_stride, 'count': self.count}
+        tmp = os.path.join(self.path, META_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(meta))
+        os.replace(tmp, os.path.join(self.path, META_FILE))
+
+
+class lm_archive:
+    def __init__(self, path):
+        """
+            Open an archive for reading.  Events appended later are not visible; reopen to see them.
+            :param path: archive directory
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.loads(f.read())
+        self.adc_sr = meta['adc_sr']
+        self.index_stride = meta['index_stride']
+        self.count = _event_count(path)
+
+        self.columns = {}
+        for name, dt in COLUMNS.items():
+            if self.count:
+                self.columns[name] = np.memmap(os.path.join(path, FILE_NAMES[name]), dtype=dt, mode='r',
+                                               shape=(self.count,))
+            else:
+                self.columns[name] = np.empty(0, dtype=dt)
+
+        # The index may lag behind the columns while a writer is active
+        num_index = min(-(-self.count//self.index_stride), os.path.getsize(os.path.join(path, INDEX_FILE))//16)
+        if num_index:
+            self.index = np.memmap(os.path.join(path, INDEX_FILE), dtype='<i8', mode='r', shape=(num_index, 2))
+        else:
+            self.index = np.empty((0, 2), dtype='<i8')
+
+    def __len__(self):
+        return self.count
+
+    def locate(self, tick, side='left'):
+        """
+            Event offset of a time stamp, as numpy.searchsorted on the ticks column would return it.
+            Only the index and one index_stride block of the ticks column are read.
+            :param tick: time stamp in ADC clock ticks
+            :param side: 'left' or 'right', as in numpy.searchsorted
+            :return: event offset
+        """
+        block = int(np.searchsorted(self.index[:, 0], tick, side)) - 1
+        if block < 0:
+            return 0
+        start = block*self.index_stride
+        if block == len(self.index) - 1:
+            stop = self.count
+        else:
+            stop = min(start + 2*self.index_stride, self.count)
+        return start + int(np.searchsorted(self.columns['ticks'][start:stop], tick, side))
+
+    def time_range(self, t0=None, t1=None):
+        """
+            Event offsets covering t0 <= time < t1, with times in seconds.
+            :return: (start, stop)
+        """
+        start = 0 if t0 is None else self.locate(int(np.ceil(t0*self.adc_sr)), 'left')
+        stop = self.count if t1 is None else self.locate(int(np.ceil(t1*self.adc_sr)), 'left')
+        return start, max(start, stop)
+
+    def read(self, t0=None, t1=None, e_lo=None, e_hi=None, columns=None):
+        """
+            Read the events with t0 <= time < t1 (seconds) and e_lo <= energy < e_hi (MCA bins).
+            Without an energy window the arrays are memmap views; with one they are copies of the selected events.
+            :param columns: names of the columns to return, default all
+            :return: dictionary of arrays, plus 'times' in seconds
+        """
+        start, stop = self.time_range(t0, t1)
+        names = list(COLUMNS) if columns is None else list(columns)
+        out = {name: self.columns[name][start:stop] for name in names if name != 'times'}
+        if e_lo is not None or e_hi is not None:
+            energy = self.columns['energy'][start:stop]
+            mask = np.ones(stop - start, dtype=bool)
+            if e_lo is not None:
+                mask &= energy >= e_lo
+            if e_hi is not None:
+                mask &= energy < e_hi
+            out = {name: arr[mask] for name, arr in out.items()}
+            if columns is None or 'times' in names:
+                out['times'] = self.columns['ticks'][start:stop][mask]/self.adc_sr
+        elif columns is None or 'times' in names:
+            out['times'] = self.columns['ticks'][start:stop]/self.adc_sr
+        return out
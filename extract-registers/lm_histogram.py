@@ -0,0 +1,82 @@
+"""
+    Build energy spectra from list mode events with the same 4096-bin layout as fpga_histogram.registers.
+"""
+import numpy as np
+
+import mca3k_data
+from lm_stream import NRL1_FLAGS
+
+NUM_BINS = 4096
+
+
+class histogram_accumulator:
+    def __init__(self, reject=('pu', 'ov', 'or'), num_bins=NUM_BINS):
+        """
+            :param reject: names of nrl1 flags ('xt', 'pu', 'ov', 'or', 'pps'); events with any of them set are dropped
+            :param num_bins: number of MCA bins, 4096 like fpga_histogram
+        """
+        unknown = set(reject) - set(NRL1_FLAGS)
+        if unknown:
+            raise ValueError(f'Unknown flags: {sorted(unknown)}')
+        self.reject = tuple(reject)
+        self.num_bins = num_bins
+        self.counts = np.zeros(num_bins, dtype=np.uint64)
+        self.accepted = 0  # Events added to the histogram
+        self.rejected = 0  # Events dropped by the flag mask
+        self.out_of_range = 0  # Events outside of [0, num_bins)
+
+    def reset(self):
+        """
+            Clear the histogram and the counters, like fpga_action clear_histogram does on the detector.
+            :return: None
+        """
+        self.counts[:] = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.out_of_range = 0
+
+    def add(self, events):
+        """
+            Fold a chunk of list mode events into the histogram with a single bincount.
+            :param events: chunk dictionary from lm_stream, or an fpga_list_mode / fpga_lm_nrl1 object holding registers.
+                           Energies are in MCA bins; flag columns that are missing count as 0.
+            :return: number of events added
+        """
+        if isinstance(events, (mca3k_data.fpga_list_mode, mca3k_data.fpga_lm_nrl1)):
+            fields = events.registers_2_arrays()
+            n = min(fields['num_events'], len(fields['energies']))
+            events = {k: v[:n] for k, v in fields.items() if k in NRL1_FLAGS}
+            events['energies'] = fields['energies'][:n]/16.0
+
+        bins = np.floor(np.asarray(events['energies'])).astype(np.intp)
+        keep = (bins >= 0) & (bins < self.num_bins)
+        self.out_of_range += int(len(bins) - np.count_nonzero(keep))
+        flagged = None
+        for name in self.reject:
+            if name in events:
+                f = np.asarray(events[name]) != 0
+                flagged = f if flagged is None else flagged | f
+        if flagged is not None:
+            self.rejected += int(np.count_nonzero(flagged & keep))
+            keep &= ~flagged
+
+        bins = bins[keep]
+        self.counts += np.bincount(bins, minlength=self.num_bins).astype(np.uint64)
+        self.accepted += len(bins)
+        return len(bins)
+
+    def snapshot(self):
+        """
+            Copy of the current spectrum; costs one 4096-bin copy no matter how many events were added.
+            :return: uint32 array laid out like fpga_histogram.registers (bins saturate at 0xFFFFFFFF)
+        """
+        return np.minimum(self.counts, 0xFFFFFFFF).astype(np.uint32)
+
+    def to_fpga_histogram(self):
+        """
+            Current spectrum as an fpga_histogram command object, so it can go wherever a histogram readout goes.
+            :return: fpga_histogram
+        """
+        histo = mca3k_data.fpga_histogram()
+        histo.registers = self.snapshot()
+        return histo
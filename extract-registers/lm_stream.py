@@ -0,0 +1,187 @@
+"""
+    Streaming decoder for list mode data.
+
+    Successive fpga_list_mode (mode 0 or mode 1) or fpga_lm_nrl1 buffers are decoded with numpy and regrouped
+    into fixed-size chunks of events.  The raw event time counters wrap around (32 bits in mode 0, 16 bits in
+    mode 1, 51 bits for nrl1); the stream carries the last time stamp from one buffer to the next and unwraps
+    them into monotonic 64-bit clock tick counts.
+
+    Mode 1 time stamps are decoded as fpga_list_mode.fields_2_user converts them: event k's time is register
+    3 + 3k (the word before its energy), in units of MODE1_TICKS = 512 ADC clock ticks, so the 16-bit counter
+    wraps every 2**25 ticks (~0.84 s at 40 MHz), not every 2**16.
+
+    Each chunk is a dictionary of numpy arrays of equal length:
+        'energies': energy in MCA bins (float64)
+        'ticks':    unwrapped time stamp in ADC clock ticks (int64)
+        'times':    unwrapped time stamp in seconds (float64)
+        'short_sums': (mode 1 only) short integral in MCA bins (float64)
+        'psd', 'xt', 'pu', 'ov', 'or', 'pps': (nrl1 only) raw psd and event flags
+    plus 'mode', which is 0, 1 or 'nrl1'.
+"""
+import numpy as np
+
+import mca3k_data
+
+MODE0_PERIOD = 1 << 32  # 32-bit time; wraps every ~107 s at 40 MHz
+MODE1_PERIOD = 1 << 16  # 16-bit time
+NRL1_PERIOD = 1 << 51  # 51-bit wall clock
+
+MODE1_TICKS = 512  # ADC clock ticks per LSB of a mode 1 time stamp, as in fpga_list_mode.fields_2_user
+
+NRL1_FLAGS = ('xt', 'pu', 'ov', 'or', 'pps')
+
+
+def buffer_words(buf):
+    """
+        Return the uint16 words of a list mode buffer without copying where possible.
+        :param buf: command object (uses its registers), bytes-like object or sequence of register values
+        :return: 1-D numpy uint16 array
+    """
+    if hasattr(buf, 'registers'):
+        buf = buf.registers
+    if isinstance(buf, (bytes, bytearray)):
+        return np.frombuffer(buf, dtype='<u2')
+    if isinstance(buf, memoryview) and buf.format == 'B':
+        return np.frombuffer(buf, dtype='<u2')
+    return np.ascontiguousarray(buf, dtype=np.uint16)
+
+
+class list_mode_stream:
+    def __init__(self, kind='list_mode', chunk_size=65536, adc_sr=40.0e6, mode1_ticks=MODE1_TICKS):
+        """
+            :param kind: 'list_mode' for fpga_list_mode buffers (mode 0 or 1), 'nrl1' for fpga_lm_nrl1 buffers
+            :param chunk_size: number of events per yielded chunk
+            :param adc_sr: ADC sampling rate in Hz, used to convert ticks to seconds
+            :param mode1_ticks: ADC clock ticks per LSB of a mode 1 time stamp
+        """
+        if kind == 'list_mode':
+            self.cmd = mca3k_data.fpga_list_mode()
+        elif kind == 'nrl1':
+            self.cmd = mca3k_data.fpga_lm_nrl1()
+        else:
+            raise ValueError(f"kind must be 'list_mode' or 'nrl1', not {kind!r}")
+        self.kind = kind
+        self.chunk_size = int(chunk_size)
+        self.adc_sr = adc_sr
+        self.mode1_ticks = mode1_ticks
+
+        self.mode = None  # Format of the buffers seen so far: 0, 1 or 'nrl1'
+        self.last_raw = None  # Last raw time stamp, for wrap detection across buffers
+        self.wraps = 0  # Number of counter wrap-arounds seen so far
+        self.num_events = 0  # Total number of events seen
+        self._chunk = None
+        self._fill = 0
+
+    def reset(self):
+        """
+            Forget the time stamp history; any partially filled chunk is discarded.
+            :return: None
+        """
+        self.mode = None
+        self.last_raw = None
+        self.wraps = 0
+        self._chunk = None
+        self._fill = 0
+
+    def feed(self, buf):
+        """
+            Decode one list mode buffer and yield every chunk it completes.
+            A change of list mode format first flushes the pending events and restarts the time stamp unwrapping.
+            :param buf: see buffer_words
+            :return: generator of chunk dictionaries
+        """
+        cols, mode = self._decode(buffer_words(buf))
+        if self.mode is not None and mode != self.mode:
+            yield from self.flush()
+            self.last_raw = None
+            self.wraps = 0
+        self.mode = mode
+
+        n = len(cols['energies'])
+        if n == 0:
+            return
+        raw = cols.pop('raw')
+        cols['ticks'] = self._unwrap(raw, mode)
+        self.num_events += n
+
+        start = 0
+        while start < n:
+            if self._chunk is None:
+                self._chunk = {k: np.empty(self.chunk_size, dtype=v.dtype) for k, v in cols.items()}
+            take = min(n - start, self.chunk_size - self._fill)
+            for k, v in cols.items():
+                self._chunk[k][self._fill:self._fill + take] = v[start:start + take]
+            self._fill += take
+            start += take
+            if self._fill == self.chunk_size:
+                yield self._pop()
+
+    def flush(self):
+        """
+            Yield the partially filled chunk, if there is one.  The time stamp history is kept.
+            :return: generator of at most one chunk dictionary
+        """
+        if self._fill:
+            yield self._pop()
+
+    def _decode(self, words):
+        """
+            Split a buffer into columns; 'raw' holds the wrapping time stamps as uint64.
+            :return: (dictionary of arrays, mode)
+        """
+        self.cmd.registers = words
+        fields = self.cmd.registers_2_arrays()
+        if self.kind == 'nrl1':
+            cols = {'energies': fields['energies']/16.0, 'raw': fields['wc'], 'psd': fields['psd']}
+            for flag in NRL1_FLAGS:
+                cols[flag] = fields[flag]
+            return cols, 'nrl1'
+
+        n = min(fields['num_events'], len(fields['energies']))
+        cols = {'energies': fields['energies'][:n]/16.0, 'raw': fields['times'][:n].astype(np.uint64)}
+        if fields['mode'] == 1:
+            cols['short_sums'] = fields['short_sums'][:n]/16.0
+        return cols, fields['mode']
+
+    def _unwrap(self, raw, mode):
+        """
+            Turn wrapping raw time stamps into monotonic tick counts.  A time stamp smaller than its predecessor
+            marks one wrap-around of the counter; gaps longer than a full period cannot be detected.
+            :return: int64 array of ADC clock ticks
+        """
+        period = {0: MODE0_PERIOD, 1: MODE1_PERIOD, 'nrl1': NRL1_PERIOD}[mode]
+        prev = np.empty_like(raw)
+        prev[0] = raw[0] if self.last_raw is None else self.last_raw
+        prev[1:] = raw[:-1]
+        wraps = np.cumsum(raw < prev, dtype=np.int64)
+        wraps += self.wraps
+        ticks = raw.astype(np.int64) + wraps*period
+        self.wraps = int(wraps[-1])
+        self.last_raw = raw[-1]
+        if mode == 1:
+            ticks *= self.mode1_ticks
+        return ticks
+
+    def _pop(self):
+        chunk = {k: v[:self._fill] for k, v in self._chunk.items()}
+        chunk['times'] = chunk['ticks']/self.adc_sr
+        chunk['mode'] = self.mode
+        self._chunk = None
+        self._fill = 0
+        return chunk
+
+
+def stream_events(buffers, kind='list_mode', chunk_size=65536, adc_sr=40.0e6):
+    """
+        Decode an iterable of list mode buffers into chunks of events with monotonic time stamps.
+        Only one chunk and one buffer are held in memory at a time; the last chunk may be short.
+        :param buffers: iterable of buffers, see buffer_words
+        :param kind: 'list_mode' or 'nrl1'
+        :param chunk_size: number of events per chunk
+        :param adc_sr: ADC sampling rate in Hz
+        :return: generator of chunk dictionaries
+    """
+    stream = list_mode_stream(kind, chunk_size, adc_sr)
+    for buf in buffers:
+        yield from stream.feed(buf)
+    yield from stream.flush()
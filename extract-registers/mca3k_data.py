@@ -3,7 +3,15 @@
 # version 1.0
 from __future__ import division
 
+import array
+import collections.abc
 import math
+import sys
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only required for the vectorized decoders
+    np = None
 
 # FPGA command types
 FPGA_WRITE = 1
@@ -30,9 +38,273 @@ MA_WEIGHTS = 6  # Access FPGA weights memory
 MA_ACTIONS = 7  # Access FPGA action registers, eg to start DAQ
 MA_TIME_SLICE = 8  # Access FPGA time slice registers
 
-class arm_ping:
+# One fpga_lm_nrl1 event: 6 uint16 words; the 51-bit wall clock is spread over wc0..wc3, flags live in wc3
+if np is not None:
+    NRL1_RECORD = np.dtype([('psd', '<u2'), ('energy', '<u2'),
+                            ('wc0', '<u2'), ('wc1', '<u2'), ('wc2', '<u2'), ('wc3', '<u2')])
+else:
+    NRL1_RECORD = None
+
+# Bit-field layouts of the FPGA control and action registers: (field name, register, shift, width).
+# registers_2_fields and fields_2_registers of fpga_ctrl and fpga_action are generated from these tables.
+FPGA_CTRL_LAYOUT = (
+    ('fine_gain', 0, 0, 16),
+    ('baseline_threshold', 1, 0, 10),
+    ('cr1_upper', 1, 10, 6),
+    ('pulse_threshold', 2, 0, 10),
+    ('cr2_upper', 2, 10, 6),
+    ('hold_off_time', 3, 0, 16),
+    ('integration_time', 4, 0, 16),
+    ('roi_bounds', 5, 0, 16),
+    ('trigger_delay', 6, 0, 10),
+    ('cr6_upper', 6, 10, 6),
+    ('ctrl_7', 7, 0, 16),
+    ('run_time_0', 8, 0, 16),  # lower 16-bit word
+    ('run_time_1', 9, 0, 16),  # upper 16-bit word
+    ('short_it', 10, 0, 16),
+    ('put', 11, 0, 16),
+    ('ecomp', 12, 0, 4),
+    ('pcomp', 12, 4, 4),
+    ('gain_select', 12, 8, 4),
+    ('cr12_upper', 12, 12, 4),
+    ('ctrl_13', 13, 0, 16),
+    ('led_repeat_time', 14, 0, 8),
+    ('led_pulse_width', 14, 8, 8),
+    ('ha_mode', 15, 0, 1),  # 0-> energy, 1->amplitude
+    ('trace_mode', 15, 1, 1),  # 0-> triggered, 1->validated
+    ('lm_mode', 15, 2, 1),  # 0-> 16-bit energy + 32-bit time, 1->16-bit energy + 16-bit PSD + 16-bit time
+    ('led_on', 15, 3, 1),
+    ('rtlt', 15, 4, 2),
+    ('sel_led', 15, 6, 1),
+    ('daq_mode', 15, 7, 1),
+    ('nai_mode', 15, 8, 1),
+    ('psd_on', 15, 9, 1),
+    ('psd_select', 15, 10, 1),
+    ('cr15_upper', 15, 11, 5),
+)
+
+FPGA_ACTION_LAYOUT = (
+    # AR0
+    ('clear_histogram', 0, 0, 1),
+    ('clear_statistics', 0, 1, 1),
+    ('clear_trace', 0, 2, 1),
+    ('clear_list_mode', 0, 3, 1),
+    ('clear_led', 0, 4, 1),
+    ('ut_run', 0, 5, 1),
+    ('clear_roi', 0, 6, 1),
+    ('ar0_upper', 0, 7, 9),
+    # AR1
+    ('ar1', 1, 0, 16),
+    # AR2
+    ('histo_run', 2, 0, 1),
+    ('trace_run', 2, 1, 1),
+    ('lm_run', 2, 2, 1),
+    ('suspend', 2, 3, 1),
+    ('segment_enable', 2, 4, 1),
+    ('segment', 2, 5, 1),
+    ('x_alarm', 2, 6, 1),
+    ('x_alarm_enable', 2, 7, 1),
+    ('ar2_upper', 2, 8, 8),
+    # AR3
+    ('ar3', 3, 0, 16),
+)
+
+
+def unpack_bit_fields(layout, registers):
+    """
+        Extract the named bit fields of a layout table from a register list.
+        :return: dictionary of ints, in layout order
+    """
+    return {name: (int(registers[reg]) >> shift) & ((1 << width) - 1) for name, reg, shift, width in layout}
+
+
+def pack_bit_fields(layout, fields, num_registers):
+    """
+        Assemble registers from named bit fields; values are truncated to their field width.
+        :return: list of num_registers ints
+    """
+    registers = [0] * num_registers
+    for name, reg, shift, width in layout:
+        registers[reg] |= (int(fields[name]) & ((1 << width) - 1)) << shift
+    return registers
+
+
+def unpack_bit_fields_batch(layout, registers):
+    """
+        unpack_bit_fields over many register sets at once (requires numpy).
+        :param registers: (N, num_registers) array-like
+        :return: dictionary of int64 arrays of length N
+    """
+    regs = np.asarray(registers, dtype=np.int64)
+    return {name: (regs[:, reg] >> shift) & ((1 << width) - 1) for name, reg, shift, width in layout}
+
+
+def pack_bit_fields_batch(layout, fields, num_registers, dtype='H'):
+    """
+        pack_bit_fields over many configurations at once (requires numpy).
+        :param fields: dictionary of array-likes of length N; scalars are broadcast
+        :param dtype: register data type of the command
+        :return: (N, num_registers) array of dtype
+    """
+    values = {name: np.asarray(fields[name]) for name, _, _, _ in layout}
+    num = max([v.size for v in values.values() if v.ndim] or [1])
+    registers = np.zeros((num, num_registers), dtype=np.int64)
+    for name, reg, shift, width in layout:
+        registers[:, reg] |= (values[name].astype(np.int64) & ((1 << width) - 1)) << shift
+    return registers.astype(dtype)
+
+
+def zero_registers(data_type, num_items):
+    """
+        Zero-filled register storage: a typed array.array instead of a list of Python numbers,
+        2 or 4 bytes per register instead of 8 for the list slot alone.
+        :param data_type: 'H', 'I' or 'f'
+        :return: array.array of num_items zeros
+    """
+    return array.array(data_type, bytes(num_items*array.array(data_type).itemsize))
+
+
+class lazy_fields(collections.abc.MutableMapping):
+    """
+        Dictionary whose values are computed on first access and then cached.
+        Used for the fields and user of the large list mode commands, so that columns nobody reads cost nothing.
+        Assigning a key replaces its value like in a dict; iteration, len and 'in' never compute anything.
+    """
+    __slots__ = ('_values', '_pending')
+
+    def __init__(self, columns):
+        """
+            :param columns: dictionary of key -> function without arguments returning the value
+        """
+        self._values = {}
+        self._pending = dict(columns)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = self._pending.pop(key)()
+            return value
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if self._pending.pop(key, None) is None:
+            del self._values[key]
+
+    def __iter__(self):
+        yield from self._values
+        yield from self._pending
+
+    def __len__(self):
+        return len(self._values) + len(self._pending)
+
+    def computed(self):
+        """
+            :return: list of the keys whose values have been computed or assigned
+        """
+        return list(self._values)
+
+    def __repr__(self):
+        items = [f'{k!r}: {v!r}' for k, v in self._values.items()] + [f'{k!r}: <lazy>' for k in self._pending]
+        return '{' + ', '.join(items) + '}'
+
+
+class mca3k_command:
+    """
+        Common base of all command classes: conversion between self.registers and the raw bytes of a USB transfer.
+        Subclasses define data_type ('H', 'I' or 'f'), num_items and num_bytes in __init__.
+        The MCA-3000 sends little-endian data.
+        The classes use __slots__, so an instance only holds these attributes and no per-instance __dict__.
+    """
+    layout = None  # (field name, register, shift, width) table for pure bit-field commands
+    __slots__ = ('registers', 'fields', 'user', 'adc_sr', 'wr_type', 'rd_type', 'cmd_addr', 'data_type',
+                 'num_items', 'num_bytes')
+
+    @classmethod
+    def from_buffer(cls, buf, copy=True):
+        """
+            Create a command object whose registers hold the data in a raw USB byte buffer.
+            With copy=True the registers are an array.array filled with a single memcpy;
+            with copy=False they are a memoryview onto buf itself, so buf must not be reused while the object lives.
+            Either way registers index to plain Python numbers, and numpy.frombuffer(obj.registers) is a zero-copy view.
+            :param buf: bytes, bytearray, memoryview or any other object supporting the buffer protocol
+            :param copy: copy the data out of buf (True) or reference it (False)
+            :return: new instance of cls
+        """
+        obj = cls()
+        obj.load_buffer(buf, copy)
+        return obj
+
+    def load_buffer(self, buf, copy=True):
+        """
+            Point self.registers at new raw data; see from_buffer.
+            :return: None
+        """
+        mv = memoryview(buf).cast('B')
+        if len(mv) < self.num_bytes:
+            raise ValueError(f'{type(self).__name__} needs {self.num_bytes} bytes, got {len(mv)}')
+        mv = mv[:self.num_bytes]
+        if not copy and sys.byteorder == 'little':
+            self.registers = mv.cast(self.data_type)
+            return
+        regs = array.array(self.data_type)
+        regs.frombytes(mv)
+        if sys.byteorder != 'little':
+            regs.byteswap()
+        self.registers = regs
+
+    def to_bytes(self):
+        """
+            Serialize self.registers into the little-endian byte layout of a USB transfer.
+            :return: bytes of length num_bytes
+        """
+        regs = self.registers
+        if sys.byteorder == 'little':
+            if isinstance(regs, array.array) and regs.typecode == self.data_type:
+                return regs.tobytes()
+            if isinstance(regs, memoryview) and regs.format == self.data_type:
+                return regs.tobytes()
+            if np is not None and isinstance(regs, np.ndarray):
+                return regs.astype(self.data_type, copy=False).tobytes()
+        if self.data_type != 'f':
+            regs = [int(r) for r in regs]
+        regs = array.array(self.data_type, regs)
+        if sys.byteorder != 'little':
+            regs.byteswap()
+        return regs.tobytes()
+
+    @classmethod
+    def registers_2_fields_batch(cls, registers):
+        """
+            Decode many register sets at once; only for commands with a bit-field layout table.
+            :param registers: (N, num_items) array-like
+            :return: dictionary of arrays of length N, keyed like self.fields
+        """
+        if cls.layout is None:
+            raise TypeError(f'{cls.__name__} has no bit-field layout')
+        return unpack_bit_fields_batch(cls.layout, registers)
+
+    @classmethod
+    def fields_2_registers_batch(cls, fields):
+        """
+            Encode many field sets at once; only for commands with a bit-field layout table.
+            :param fields: dictionary of array-likes of length N (scalars are broadcast), keyed like self.fields
+            :return: (N, num_items) array of registers
+        """
+        if cls.layout is None:
+            raise TypeError(f'{cls.__name__} has no bit-field layout')
+        obj = cls()
+        return pack_bit_fields_batch(cls.layout, fields, obj.num_items, obj.data_type)
+
+
+class arm_ping(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 16
+        self.registers = zero_registers('I', 16)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -59,12 +331,15 @@ class arm_ping:
     def user_2_fields(self):
         pass
 
-class fpga_ctrl:
+class fpga_ctrl(mca3k_command):
     """
         Note that the fpga_ctrl total data size for USB transfer must be 64 bytes.  The ARM in the MCA_3K then only writes as many data as necessary.
     """
+    layout = FPGA_CTRL_LAYOUT
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0]*16
+        self.registers = zero_registers('H', 16)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -83,98 +358,17 @@ class fpga_ctrl:
         """
             Convert FPGA control register values into a control register dictionary which has names for the bit fields.
             This function defines the keys for self.fields.  The fields are a complete description of all registers.
+            The bit positions are listed in FPGA_CTRL_LAYOUT.
             :return: None
         """
-        self.fields = dict()  # We make self.fields a dictionary
-        self.fields['fine_gain'] = int(self.registers[0])
-        self.fields['baseline_threshold'] = int(self.registers[1]) & 0x03FF
-        self.fields['cr1_upper'] = (int(self.registers[1]) >> 10) & 0x003F
-        self.fields['pulse_threshold'] = int(self.registers[2]) & 0x03FF
-        self.fields['cr2_upper'] = (int(self.registers[2]) >> 10) & 0x003F
-        self.fields['hold_off_time'] = int(self.registers[3])
-        self.fields['integration_time'] = int(self.registers[4])
-        self.fields['roi_bounds'] = int(self.registers[5])
-        self.fields['trigger_delay'] = int(self.registers[6]) & 0x03FF
-        self.fields['cr6_upper'] = (int(self.registers[6]) >> 10) & 0x003F
-
-        self.fields['ctrl_7'] = self.registers[7]
-
-        self.fields['run_time_0'] = self.registers[8]
-        self.fields['run_time_1'] = self.registers[9]
-
-        self.fields['short_it'] = int(self.registers[10])
-        self.fields['put'] = int(self.registers[11])
-
-        # CR12
-        val = int(self.registers[12])
-        self.fields['ecomp'] = val & 0xF
-        self.fields['pcomp'] = (val >> 4) & 0xF 
-        self.fields['gain_select'] = (val >> 8) & 0xF 
-        self.fields['cr12_upper'] = (val >> 12) & 0xF 
-
-        # CR13
-        self.fields['ctrl_13'] = self.registers[13]
-
-        # CR14
-        val = int(self.registers[14])
-        self.fields['led_repeat_time'] = val & 0xFF
-        self.fields['led_pulse_width'] = (val >> 8) & 0xFF
-        
-
-        # CR15
-        val = int(self.registers[15])
-        self.fields['ha_mode'] = int((val & 0x1))  # 0-> energy, 1->amplitude
-        self.fields['trace_mode'] = int((val & 0x2) >> 1)  # 0-> triggered, 1->validated
-        # List mode: 0-> 16-bit energy + 32-bit time, 1->16-bit energy + 16-bit PSD + 16-bit time
-        self.fields['lm_mode'] = (val >> 2) & 1 
-        self.fields['led_on'] = (val >> 3) & 1  
-        self.fields['rtlt'] = (val >> 4) & 3  
-        self.fields['sel_led'] = (val >> 6) & 1 
-        self.fields['daq_mode'] = (val >> 7) & 1  
-        self.fields['nai_mode'] = (val >> 8) & 1  
-        self.fields['psd_on'] = (val >> 9) & 1  
-        self.fields['psd_select'] = (val >> 10) & 1  
-        self.fields['cr15_upper'] = (val >> 11) & 5  
+        self.fields = unpack_bit_fields(FPGA_CTRL_LAYOUT, self.registers)
 
     def fields_2_registers(self):
         """
             Compute the values of the control registers from the fields dictionary.
             :return: None
         """
-        self.registers = [0] * 16
-        self.registers[0] = int(self.fields['fine_gain'])
-        self.registers[1] = (int(self.fields['baseline_threshold']) & 0x03FF) + (int(self.fields['cr1_upper']) << 10)
-        self.registers[2] = (int(self.fields['pulse_threshold']) & 0x03FF) + (int(self.fields['cr2_upper']) << 10)
-        self.registers[3] = int(self.fields['hold_off_time'])
-        self.registers[4] = int(self.fields['integration_time'])
-        self.registers[5] = int(self.fields['roi_bounds'])
-        self.registers[6] = (int(self.fields['trigger_delay']) & 0x03FF) + (int(self.fields['cr6_upper']) << 10)
-
-        self.registers[7] = int(self.fields['ctrl_7'])
-
-        self.registers[8] = int(self.fields['run_time_0'])  # lower 16-bit word
-        self.registers[9] = int(self.fields['run_time_1'])  # upper 16-bit word
-
-        self.registers[10] = int(self.fields['short_it'])
-        self.registers[11] = int(self.fields['put'])
-
-        self.registers[12] = (int(self.fields['ecomp']) & 0xF) + ((int(self.fields['pcomp']) & 0xF) << 4) + \
-                             ((int(self.fields['gain_select']) & 0xF) << 8) + \
-                             ((int(self.fields['cr12_upper']) & 0xF) << 12)
-
-        self.registers[13] = int(self.fields['ctrl_13'])
-
-        self.registers[14] = (int(self.fields['led_repeat_time']) & 0xFF) + \
-                     ((int(self.fields['led_pulse_width']) & 0xFF) << 8) 
-        
-
-        # Specific data acquisition modes for histogram, list mode and trace
-        self.registers[15] = (int(self.fields['ha_mode']) & 1) + (int(self.fields['trace_mode']) & 1) * 0x2 + \
-                             (int(self.fields['lm_mode']) & 1) * 0x4 + (int(self.fields['led_on']) & 1) * 0x8 + \
-                             (int(self.fields['rtlt']) & 3) * 0x10 + (int(self.fields['sel_led']) & 1) * 0x40 + \
-                             (int(self.fields['daq_mode']) & 1) * 0x80 + (int(self.fields['nai_mode']) & 1) * 0x100 + \
-                             (int(self.fields['psd_on']) & 1) * 0x200 + (int(self.fields['psd_select']) & 1) * 0x400 + \
-                             (int(self.fields['cr15_upper']) & 0x1F) * 0x800
+        self.registers = pack_bit_fields(FPGA_CTRL_LAYOUT, self.fields, 16)
 
     def fields_2_user(self):
         """
@@ -201,14 +395,13 @@ class fpga_ctrl:
         """
         fg = int(self.user['digital_gain'] * 40.0e6/self.adc_sr)
         if fg > 0:
-            ecomp = 0
-            while fg < 16384:
-                fg *= 2
-                ecomp += 1
-        else:  # Avoid infinite loop if fg==0
+            # Smallest power of two that brings fg up to at least 16384 = 2**14
+            ecomp = max(0, 15 - fg.bit_length())
+            fg <<= ecomp
+        else:
             fg = 16384
             ecomp = 2
-            
+
         self.fields['fine_gain'] = fg
         self.fields['ecomp'] = ecomp
         self.fields['integration_time'] = int(self.user['integration_time'] * self.adc_sr + 0.5)
@@ -222,14 +415,57 @@ class fpga_ctrl:
         self.fields['run_time_0'] = rt & 0xFFFF
         self.fields['run_time_1'] = (rt & 0xFFFF0000) >> 16
 
+    def user_2_fields_batch(self, user):
+        """
+            Vectorized user_2_fields over arrays of user values (requires numpy).
+            Gives the same numbers as user_2_fields element by element; self.adc_sr applies to all of them.
+            :param user: dictionary with the keys of user_2_fields; values are array-likes of length N or scalars
+            :return: dictionary of int64 arrays, holding only the fields that user_2_fields sets
+        """
+        def rnd(key, scale):
+            return np.trunc(np.asarray(user[key], dtype=np.float64) * scale + 0.5).astype(np.int64)
+
+        fg = np.trunc(np.asarray(user['digital_gain'], dtype=np.float64) * 40.0e6/self.adc_sr).astype(np.int64)
+        positive = fg > 0
+        _, bits = np.frexp(np.where(positive, fg, 1))  # bits == fg.bit_length()
+        ecomp = np.maximum(0, 15 - bits)
+        fields = {
+            'fine_gain': np.where(positive, fg << ecomp, 16384),
+            'ecomp': np.where(positive, ecomp, 2),
+            'integration_time': rnd('integration_time', self.adc_sr),
+            'hold_off_time': rnd('hold_off_time', self.adc_sr),
+            'short_it': rnd('short_it', self.adc_sr),
+            'trigger_delay': rnd('trigger_delay', self.adc_sr),
+            'baseline_threshold': rnd('baseline_threshold', 1000.0) & 0x3FF,
+            'pulse_threshold': rnd('pulse_threshold', 1000.0) & 0x3FF,
+            'roi_bounds': (np.floor_divide(user['roi_low'], 16) + np.multiply(user['roi_high'], 16)).astype(np.int64),
+        }
+        rt = np.trunc(np.asarray(user['run_time'], dtype=np.float64)*self.adc_sr/0x10000).astype(np.int64)
+        fields['run_time_0'] = rt & 0xFFFF
+        fields['run_time_1'] = (rt & 0xFFFF0000) >> 16
+        return fields
+
+    def user_2_registers_batch(self, user):
+        """
+            user -> fields -> registers for many configurations at once.  Fields that user_2_fields does not
+            set (modes, LED settings, ...) are taken from self.fields.
+            :param user: see user_2_fields_batch
+            :return: (N, 16) uint16 array of registers
+        """
+        fields = dict(self.fields)
+        fields.update(self.user_2_fields_batch(user))
+        return self.fields_2_registers_batch(fields)
+
 
-class fpga_action:
+class fpga_action(mca3k_command):
     """
         Note that the fpga_action total data size for USB transfer must be 64 bytes.  The ARM in the MCA_3K then only writes as many data as necessary.
     """
+    layout = FPGA_ACTION_LAYOUT
+    __slots__ = ()
 
     def __init__(self):
-        self.registers = [0] * 4
+        self.registers = zero_registers('H', 4)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -248,41 +484,11 @@ class fpga_action:
         """
             Convert FPGA action register values into a control register dictionary which has names for the bit fields.
             This function defines the keys for self.fields.  The fields are a complete description of all registers.
+            The bit positions are listed in FPGA_ACTION_LAYOUT.
             :return: None
         """
+        self.fields = unpack_bit_fields(FPGA_ACTION_LAYOUT, self.registers)
 
-        self.fields = dict()  # We make act_d a dictionary
-
-        # AR0
-        val = int(self.registers[0])
-        self.fields['clear_histogram'] = val & 0x1
-        self.fields['clear_statistics'] = (val & 0x2) >> 1
-        self.fields['clear_trace'] = (val & 0x4) >> 2
-        self.fields['clear_list_mode'] = (val & 0x8) >> 3
-        self.fields['clear_led'] = (val & 0x10) >> 4
-        self.fields['ut_run'] = (val & 0x20) >> 5
-        self.fields['clear_roi'] = (val & 0x40) >> 6
-        self.fields['ar0_upper'] = (val & 0xFF80) >> 7
-
-        # AR1
-        self.fields['ar1'] = int(self.registers[1]) & 0xFFFF
-
-        # AR2
-        val = int(self.registers[2])
-        self.fields['histo_run'] = (val & 0x1)
-        self.fields['trace_run'] = (val & 0x2) >> 1
-        self.fields['lm_run'] = (val & 0x4) >> 2
-        self.fields['suspend'] = (val & 0x8) >> 3
-        self.fields['segment_enable'] = (val & 0x10) >> 4
-        self.fields['segment'] = (val & 0x20) >> 5
-        self.fields['x_alarm'] = (val & 0x40) >> 6
-        self.fields['x_alarm_enable'] = (val & 0x80) >> 7
-        self.fields['ar2_upper'] = (val & 0xFF00) >> 8
-
-        # AR3
-        self.fields['ar3'] = int(self.registers[3]) & 0xFFFF
-
-        
     def fields_2_registers(self):
         """
             Compute the values of the control registers from the fields dictionary.
@@ -290,28 +496,9 @@ class fpga_action:
         """
         for key in self.fields:
             self.fields[key] = int(self.fields[key])
-            
-        self.registers = [0]*4
-        
-        # AR0
-        self.registers[0] = (self.fields['clear_histogram'] & 0x1) + (self.fields['clear_statistics'] & 0x1)*0x2 + \
-                            (self.fields['clear_trace'] & 0x1)*0x4 + (self.fields['clear_list_mode'] & 0x1)*0x8 + \
-                            (self.fields['clear_led'] & 0x1)*0x10 + (self.fields['ut_run'] & 0x1)*0x20 + \
-                            (self.fields['clear_roi'] & 0x1)*0x40 + (self.fields['ar0_upper'] & 0x1FF)*0x80       
-
-        # AR1
-        self.registers[1] = self.fields['ar1'] & 0xFFFF
-
-        # AR2
-        self.registers[2] = (self.fields['histo_run'] & 0x1) + (self.fields['trace_run'] & 0x1)*0x2 + \
-                            (self.fields['lm_run'] & 0x1)*0x4 + (self.fields['segment'] & 0x1)*0x8 + \
-                            (self.fields['segment_enable'] & 0x1)*0x10 + (self.fields['suspend'] & 0x1)*0x20 + \
-                            (self.fields['x_alarm'] & 0x1)*0x40 + (self.fields['x_alarm_enable'] & 0x1)*0x80 + \
-                            (self.fields['ar2_upper'] & 0xFF)*0x100
-
-        # AR3
-        self.registers[3] = self.fields['ar3'] & 0xFFFF
-        
+
+        self.registers = pack_bit_fields(FPGA_ACTION_LAYOUT, self.fields, 4)
+
     def fields_2_user(self):
         self.user = {}
 
@@ -319,9 +506,11 @@ class fpga_action:
         pass
 
 
-class fpga_statistics:
+class fpga_statistics(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 16
+        self.registers = zero_registers('I', 16)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -425,9 +614,11 @@ class fpga_statistics:
         pass
 
 
-class fpga_results:
+class fpga_results(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 32
+        self.registers = zero_registers('H', 32)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -517,9 +708,11 @@ class fpga_results:
         pass
 
 
-class fpga_histogram:
+class fpga_histogram(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 4096
+        self.registers = zero_registers('I', 4096)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -535,21 +728,50 @@ class fpga_histogram:
         pass
 
     def registers_2_fields(self):
-        pass
+        """
+            The histogram registers are the counts of the 4096 MCA bins.
+            :return: None
+        """
+        self.fields = {
+            'counts': list(self.registers),  # uint32_t counts per MCA bin
+            'total': sum(self.registers),  # Total number of counts
+        }
 
     def fields_2_registers(self):
         pass
 
-    def fields_2_user(self):
-        pass
+    def fields_2_user(self, calibration=None):
+        """
+            :param calibration: optional spectrum.energy_calibration; adds 'energies', the bin edge energies
+            :return: None
+        """
+        self.user = {
+            'counts': self.fields['counts'],
+            'total': self.fields['total'],
+        }
+        if calibration is not None:
+            self.user['energies'] = calibration.bin_edges(len(self.fields['counts']))
+
+    def analyze(self, engine=None):
+        """
+            Peak search, peak fits, ROI integrals and energy calibration of the histogram; see spectrum.py.
+            :param engine: spectrum.spectrum_engine, kept between readouts for incremental analysis
+            :return: dictionary of results, see spectrum.spectrum_engine.analyze
+        """
+        if engine is None:
+            import spectrum  # Only needed for the analysis; keeps numpy optional for the rest of this module
+            engine = spectrum.spectrum_engine()
+        return engine.analyze(self)
 
     def user_2_fields(self):
         pass
 
 
-class fpga_list_mode:
+class fpga_list_mode(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 1024
+        self.registers = zero_registers('H', 1024)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -564,50 +786,95 @@ class fpga_list_mode:
     def add_to_cmd_out_list(self, mca):
         pass
 
-    def registers_2_fields(self):
+    def field_columns(self, vectorized=False):
         """
-            Unpack the list mode data buffer into energy and time lists
-            :return: None
+            Functions computing each entry of self.fields from the current register buffer.
+            :param vectorized: numpy arrays (see registers_2_arrays) instead of lists
+            :return: dictionary of key -> function without arguments
         """
-        mode = (self.registers[0] & 0x8000) // 0x8000
-        num_events = self.registers[0] & 0xFFF
-
-        self.fields = {
-            'mode': mode,
-            'num_events': num_events,
-            'energies': self.registers[4::3]
+        if vectorized:
+            regs = np.ascontiguousarray(self.registers, dtype=np.uint16)
+        else:
+            regs = self.registers
+        mode = (int(regs[0]) & 0x8000) // 0x8000
+        columns = {
+            'mode': lambda: mode,
+            'num_events': lambda: int(regs[0]) & 0xFFF,
+            'energies': (lambda: regs[4::3]) if vectorized else (lambda: list(regs[4::3])),
         }
-        if mode == 0:
-            self.fields['times'] = [ t0 + (t1 << 16) for t0, t1 in zip(self.registers[5::3], self.registers[6::3])]
-            self.fields['short_sums'] = []
+        if vectorized and mode == 0:
+            columns['times'] = lambda: regs[5::3].astype(np.uint32) | (regs[6::3].astype(np.uint32) << 16)
+            columns['short_sums'] = lambda: regs[:0]
+        elif vectorized:
+            columns['times'] = lambda: regs[3::3]  # Event k's time is register 3 + 3k, as in fields_2_user
+            columns['short_sums'] = lambda: regs[5::3]
+        elif mode == 0:
+            columns['times'] = lambda: [t0 + (t1 << 16) for t0, t1 in zip(regs[5::3], regs[6::3])]
+            columns['short_sums'] = lambda: []
         else:
-            self.fields['times'] = self.registers[6::3]
-            self.fields['short_sums'] = self.registers[5::3]
+            columns['times'] = lambda: list(regs[3::3])
+            columns['short_sums'] = lambda: list(regs[5::3])
+        return columns
+
+    def registers_2_arrays(self):
+        """
+            Vectorized version of registers_2_fields: energies, times and short_sums as numpy arrays.
+            As in registers_2_fields the arrays cover the whole buffer; only the first num_events entries are valid.
+            Mode 0 times are uint32, all other arrays are views into the register buffer.
+            :return: dictionary with the same keys as self.fields
+        """
+        return {key: fn() for key, fn in self.field_columns(vectorized=True).items()}
+
+    def registers_2_fields(self, vectorized=False, lazy=False):
+        """
+            Unpack the list mode data buffer into energy and time lists
+            :param vectorized: if True, the fields are numpy arrays computed by registers_2_arrays
+            :param lazy: if True, self.fields is a lazy_fields mapping: each entry is only decoded when it is
+                         first read. It keeps decoding the buffer the registers held when this was called.
+            :return: None
+        """
+        columns = self.field_columns(vectorized)
+        self.fields = lazy_fields(columns) if lazy else {key: fn() for key, fn in columns.items()}
 
     def fields_2_registers(self):
         pass
 
-    def fields_2_user(self):
+    def fields_2_user(self, lazy=False):
         """
             Convert energy and time lists into seconds and mca_bins
+            :param lazy: if True, self.user is a lazy_fields mapping, and only the fields an entry needs are read
             :return: None
         """
-        self.user = {
-            'energies': [e/16.0 for e in self.fields['energies']]
-        }
-        if self.fields['mode'] == 0:
-            self.user['times'] = [t/self.adc_sr for t in self.fields['times']]
+        fields, regs, adc_sr = self.fields, self.registers, self.adc_sr
+
+        def scaled(key, divisor):
+            values = fields[key]
+            if np is not None and isinstance(values, np.ndarray):
+                return values/divisor
+            return [v/divisor for v in values]
+
+        def frame_times():
+            if np is not None and isinstance(fields['energies'], np.ndarray):
+                return np.asarray(regs[3::3], dtype=np.float64)*512.0/adc_sr
+            return [t*512.0/adc_sr for t in regs[3::3]]
+
+        columns = {'energies': lambda: scaled('energies', 16.0)}
+        if fields['mode'] == 0:
+            columns['times'] = lambda: scaled('times', adc_sr)
         else:
-            self.user['times'] = [t*512.0/self.adc_sr for t in self.registers[3::3]]
-            self.user['short_sums'] = [e/16.0 for e in self.fields['short_sums']]
+            columns['times'] = frame_times
+            columns['short_sums'] = lambda: scaled('short_sums', 16.0)
+        self.user = lazy_fields(columns) if lazy else {key: fn() for key, fn in columns.items()}
 
     def user_2_fields(self):
         pass
 
 
-class fpga_trace:
+class fpga_trace(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0]*1024
+        self.registers = zero_registers('H', 1024)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -643,7 +910,7 @@ class fpga_trace:
         dc_val = trace[0]
         n0 = 0
         n1 = 0
-        for n0, t in enumerate(trace[1:]):
+        for n0, t in enumerate(trace[1:], 1):  # n0 is the index into trace
             if abs(t - dc_val) < b_thr:
                 dc_val = 7 / 8 * dc_val + t / 8
             elif (t - dc_val) > thr:
@@ -655,20 +922,23 @@ class fpga_trace:
             mini = min(trace)
             maxi = max(trace)
             self.user = {'pulse_found': 0, 'mini': mini, 'maxi': maxi, 'std_dev': std_dev, 'avg': avg}
+            return None
 
         if n0 > 3:
             avg = sum(trace[1:n0-1]) / (n0-2)
-            std_dev = math.sqrt(sum([(t - avg) ** 2 / (n0-3) for t in trace]))
+            std_dev = math.sqrt(sum([(t - avg) ** 2 / (n0-3) for t in trace[1:n0-1]]))
         else:
             std_dev = 0
             
         energy = 0
         for n1, t in enumerate(trace[n0:]):
-            energy += trace[n1]
-            if trace[n1] - dc_val < b_thr:
+            energy += t
+            if t - dc_val < b_thr:
                 break
         n1 += n0
-        pulse = trace[n0:n1]
+        pulse = list(trace[n0:n1])
+        if not pulse:  # Pulse starts at the last sample, nothing to measure
+            return None
         mca_bin = energy  # Check how to map this into MCA bins (assuming some fixed digital gain)
 
         ymax = max(pulse)
@@ -688,7 +958,7 @@ class fpga_trace:
 
         rise_time = (xrise90 - xrise10) / adc_sr
         fall_time = (xfall10 - xfall90) / adc_sr
-        peaking_time = (xmax - n0) / adc_sr
+        peaking_time = xmax / adc_sr  # xmax counts from the start of the pulse
 
         p50 = [idx for idx, p in enumerate(pulse) if p > y50]
         fwhm = (p50[-1] - p50[0]) / adc_sr
@@ -700,9 +970,11 @@ class fpga_trace:
         return None
 
 
-class fpga_weights:
+class fpga_weights(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 1024
+        self.registers = zero_registers('H', 1024)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -730,9 +1002,11 @@ class fpga_weights:
         pass
 
 
-class fpga_time_slice:
+class fpga_time_slice(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 1024
+        self.registers = zero_registers('H', 1024)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -757,7 +1031,7 @@ class fpga_time_slice:
             "dead_time": (self.registers[12] + self.registers[13]*65536.0)/self.adc_sr,
             "neutron_counts": self.registers[14],
             "gm_counts": self.registers[16],  # GM dosimeter counts
-            "histogram": self.registers[18: 1024]
+            "histogram": list(self.registers[18: 1024])
         }
 
     def fields_2_registers(self):
@@ -769,9 +1043,11 @@ class fpga_time_slice:
     def user_2_fields(self):
         pass
 
-class arm_version:
+class arm_version(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * 16
+        self.registers = zero_registers('I', 16)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -833,9 +1109,11 @@ class arm_version:
         pass
 
 
-class arm_status:
+class arm_status(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0]*16
+        self.registers = zero_registers('f', 16)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -889,9 +1167,14 @@ class arm_status:
         pass
 
 
-class arm_ctrl:
+class arm_ctrl(mca3k_command):
+    __slots__ = ()
+    scintillators = {
+        "NaI_Tl": 0, "Generic": 1
+    }
+
     def __init__(self):
-        self.registers = [0.0]*12
+        self.registers = zero_registers('f', 12)
         self.fields = {}
         self.user = {}
 
@@ -901,9 +1184,6 @@ class arm_ctrl:
         self.data_type = 'f'
         self.num_items = len(self.registers)
         self.num_bytes = self.num_items * 4
-        self.scintillators = {
-            "NaI_Tl": 0, "Generic": 1
-        }
 
     def add_to_cmd_out_list(self, mca):
         pass
@@ -959,9 +1239,11 @@ class arm_ctrl:
             (int(self.user['gs_mode']) & 0xF)
 
 
-class arm_cal:
+class arm_cal(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0.0] * 64
+        self.registers = zero_registers('f', 64)
         self.fields = {}
         self.user = {}
 
@@ -1011,9 +1293,11 @@ class arm_cal:
         pass
 
         
-class fpga_lm_nrl1:
+class fpga_lm_nrl1(mca3k_command):
+    __slots__ = ()
+
     def __init__(self):
-        self.registers = [0] * (6*2048)
+        self.registers = zero_registers('H', 6*2048)
         self.fields = {}
         self.user = {}
         self.adc_sr = 40.0e6
@@ -1028,44 +1312,120 @@ class fpga_lm_nrl1:
     def add_to_cmd_out_list(self, mca):
         pass
 
-    def registers_2_fields(self):
+    def records(self):
+        """
+            View the register buffer as an array of 6-word event records (requires numpy).
+            The header record at offset 0 is skipped and the view is limited to the events in the buffer,
+            so it has the same length as the lists built by registers_2_fields.
+            :return: numpy structured array of NRL1_RECORD
+        """
+        buf = np.ascontiguousarray(self.registers, dtype=np.uint16)  # No copy if registers already is uint16
+        num_records = max(0, min(int(buf[0]) & 0xFFF, len(buf)//6) - 1)
+        return buf[6:6*(num_records + 1)].view(NRL1_RECORD)
+
+    def field_columns(self, vectorized=False):
+        """
+            Functions computing each entry of self.fields from the current register buffer.
+            :param vectorized: numpy arrays from the record view (see registers_2_arrays) instead of lists
+            :return: dictionary of key -> function without arguments
+        """
+        regs = self.registers
+        num_events = int(regs[0]) & 0xFFF
+        if vectorized:
+            rec = self.records()
+            w3 = rec['wc3']
+
+            def wc():
+                t = rec['wc0'].astype(np.uint64)
+                t |= rec['wc1'].astype(np.uint64) << 16
+                t |= rec['wc2'].astype(np.uint64) << 32
+                t |= (w3 & 0x7).astype(np.uint64) << 48
+                return t
+
+            def flag(bit):
+                return lambda: ((w3 >> bit) & 1).astype(np.uint8)
+
+            return {
+                'num_events': lambda: num_events,
+                'energies': lambda: rec['energy'],
+                'psd': lambda: rec['psd'],
+                'wc': wc,
+                'xt': flag(3),
+                'pu': flag(4),
+                'ov': flag(5),
+                'or': flag(6),
+                'pps': flag(7)
+            }
+        E0 = 6*num_events
+
+        def flag(mask):
+            return lambda: [(x & mask)//mask for x in regs[11:E0:6]]
+
+        return {
+            'num_events': lambda: num_events,
+            'energies': lambda: list(regs[7:E0:6]),
+            'psd': lambda: list(regs[6:E0:6]),
+            'wc': lambda: [w0 + w1*0x10000 + w2*0x10000*0x10000 + (w3 & 0x7)*0x10000*0x10000*0x10000 \
+                           for w0,w1,w2,w3 in zip(regs[8:E0:6], regs[9:E0:6], regs[10:E0:6], regs[11:E0:6])],
+            'xt': flag(0x8),
+            'pu': flag(0x10),
+            'ov': flag(0x20),
+            'or': flag(0x40),
+            'pps': flag(0x80)
+        }
+
+    def registers_2_arrays(self):
+        """
+            Vectorized version of registers_2_fields: decode all events in one pass over the record array.
+            energies and psd are views into the register buffer, wc is uint64 and the flags are uint8.
+            :return: dictionary with the same keys as self.fields
+        """
+        return {key: fn() for key, fn in self.field_columns(vectorized=True).items()}
+
+    def registers_2_fields(self, vectorized=False, lazy=False):
         """
             Unpack the list mode data buffer into energy and time lists
             In 'registers' all raw data are returned.
             In 'fields' the list length is limited to the number of events, same as in 'user'
+            :param vectorized: if True, the fields are numpy arrays computed by registers_2_arrays
+            :param lazy: if True, self.fields is a lazy_fields mapping: each entry is only decoded when it is
+                         first read, e.g. a quick look at num_events and energies never builds wc or the flags.
             :return: None
         """
-        L=2048
-        E0 = 6*(self.registers[0] & 0xFFF)
+        columns = self.field_columns(vectorized)
+        self.fields = lazy_fields(columns) if lazy else {key: fn() for key, fn in columns.items()}
 
-        self.fields = {
-            'num_events': self.registers[0] & 0xFFF,
-            'energies': self.registers[7:E0:6],
-            'psd': self.registers[6:E0:6],
-            'wc': [w0 + w1*0x10000 + w2*0x10000*0x10000 + (w3 & 0x7)*0x10000*0x10000*0x10000 \
-                   for w0,w1,w2,w3 in zip(self.registers[8:E0:6], self.registers[9:E0:6],\
-                       self.registers[10:E0:6], self.registers[11:E0:6])],
-            'xt': [(x & 0x8)//8 for x in self.registers[11:E0:6]],
-            'pu': [(p & 0x10)//0x10 for p in self.registers[11:E0:6]],
-            'ov': [(p & 0x20)//0x20 for p in self.registers[11:E0:6]],
-            'or': [(p & 0x40)//0x40 for p in self.registers[11:E0:6]],
-            'pps': [(p & 0x80)//0x80 for p in self.registers[11:E0:6]]
-        }
-        
     def fields_2_registers(self):
         pass
 
-    def fields_2_user(self):
+    def fields_2_user(self, lazy=False, clock=None):
         """
             Convert energy and time lists into seconds and mca_bins
+            :param lazy: if True, self.user is a lazy_fields mapping, and only the fields an entry needs are read
+            :param clock: optional pps_clock.pps_clock; adds 'utc', the PPS-disciplined UTC time of each event
             :return: None
         """
-        self.user = {
-            'energies': [e/16.0 for e in self.fields['energies']],
-            'wc': [w/40e6 for w in self.fields["wc"]]      
+        fields = self.fields
+
+        def scaled(key, divisor):
+            values = fields[key]
+            if np is not None and isinstance(values, np.ndarray):
+                return values/divisor
+            return [v/divisor for v in values]
+
+        columns = {
+            'energies': lambda: scaled('energies', 16.0),
+            'wc': lambda: scaled('wc', 40e6)
         }
-        
+        if clock is not None:
+            columns['utc'] = lambda: clock.to_utc(np.asarray(fields['wc'], dtype=np.int64))
+        self.user = lazy_fields(columns) if lazy else {key: fn() for key, fn in columns.items()}
 
     def user_2_fields(self):
         pass
-        
+
+
+# Command classes by name; the keys of saved settings files are these names
+COMMANDS = {cls.__name__: cls for cls in (
+    arm_ping, fpga_ctrl, fpga_action, fpga_statistics, fpga_results, fpga_histogram, fpga_list_mode, fpga_trace,
+    fpga_weights, fpga_time_slice, arm_version, arm_status, arm_ctrl, arm_cal, fpga_lm_nrl1)}
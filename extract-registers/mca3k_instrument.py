@@ -0,0 +1,247 @@
+"""
+    Opt-in timing of the mca3k_data command classes, per command and stage.
+
+    instrumentation.enable() wraps the conversion methods (the stages: load_buffer, which from_buffer goes through,
+    registers_2_fields, registers_2_arrays, fields_2_user, user_2_fields, fields_2_registers and to_bytes) of every
+    command class; disable() puts the original methods back, so there is no overhead at all while disabled.
+    For each command and stage it records the call count, total and maximum time, the latencies of the most recent
+    calls (for percentiles), the register bytes handled and, for list mode buffers, the number of events.
+
+    The numbers are exported with snapshot() as a dictionary or with prometheus() in the Prometheus text format.
+    profile_next() runs the next matching call under cProfile, and calls slower than slow_threshold keep a copy of
+    their registers so profile_buffer() can replay that buffer under cProfile later.
+"""
+import array
+import cProfile
+import io
+import pstats
+import time
+
+import numpy as np
+
+import mca3k_data
+
+STAGES = ('load_buffer', 'registers_2_fields', 'registers_2_arrays', 'fields_2_user', 'user_2_fields',
+          'fields_2_registers', 'to_bytes')
+QUANTILES = (0.5, 0.9, 0.99)
+
+_to_bytes = mca3k_data.mca3k_command.to_bytes  # Unwrapped, for copying the registers of slow calls
+
+
+def _list_mode_events(obj):
+    return min(int(obj.registers[0]) & 0xFFF, (len(obj.registers) - 4)//3)
+
+
+def _nrl1_events(obj):
+    return max(0, min(int(obj.registers[0]) & 0xFFF, len(obj.registers)//6) - 1)
+
+
+# Number of events in a command's registers, for the commands that carry events
+EVENT_COUNTERS = {
+    'fpga_list_mode': _list_mode_events,
+    'fpga_lm_nrl1': _nrl1_events,
+}
+
+
+class stage_stats:
+    __slots__ = ('count', 'total', 'max', 'bytes', 'events', 'recent', 'pos')
+
+    def __init__(self, window):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.events = 0
+        self.recent = array.array('d', bytes(8*window))  # Ring of the latest latencies
+        self.pos = 0
+
+    def add(self, dt, nbytes, events):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        self.bytes += nbytes
+        self.events += events
+        self.recent[self.pos] = dt
+        self.pos = (self.pos + 1) % len(self.recent)
+
+    def quantiles(self):
+        n = min(self.count, len(self.recent))
+        if n == 0:
+            return {q: 0.0 for q in QUANTILES}
+        values = np.quantile(np.frombuffer(self.recent, dtype=np.float64)[:n], QUANTILES)
+        return dict(zip(QUANTILES, values.tolist()))
+
+
+class instrumentation:
+    _active = None  # The enabled instance; the methods are patched on the classes, so only one at a time
+
+    def __init__(self, window=2048, slow_threshold=None, max_slow=16):
+        """
+            :param window: number of most recent calls per command and stage used for the percentiles
+            :param slow_threshold: seconds; slower calls keep a copy of their registers in self.slow
+            :param max_slow: number of slow calls kept (the most recent ones)
+        """
+        self.window = window
+        self.slow_threshold = slow_threshold
+        self.max_slow = max_slow
+        self.stats = {}  # (command, stage) -> stage_stats
+        self.slow = []  # {'command', 'stage', 'seconds', 'registers'} of slow calls
+        self.last_profile = None  # pstats.Stats of the last profiled call
+        self._armed = None  # (command, stage, callback) for profile_next
+        self._originals = {}  # (class, method name) -> original function
+
+    def enable(self):
+        """
+            Wrap the stage methods of all command classes.
+            :return: self
+        """
+        if instrumentation._active is self:
+            return self
+        if instrumentation._active is not None:
+            raise RuntimeError('another instrumentation is already enabled')
+        for cls in (mca3k_data.mca3k_command,) + tuple(mca3k_data.COMMANDS.values()):
+            for stage in STAGES:
+                fn = cls.__dict__.get(stage)
+                if fn is None or isinstance(fn, classmethod):
+                    continue
+                self._originals[(cls, stage)] = fn
+                setattr(cls, stage, self._wrap(fn, stage))
+        instrumentation._active = self
+        return self
+
+    def disable(self):
+        """
+            Restore the original methods; the recorded numbers are kept.
+            :return: None
+        """
+        for (cls, stage), fn in self._originals.items():
+            setattr(cls, stage, fn)
+        self._originals = {}
+        if instrumentation._active is self:
+            instrumentation._active = None
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def reset(self):
+        self.stats = {}
+        self.slow = []
+
+    def _wrap(self, fn, stage):
+        clock = time.perf_counter
+
+        def timed(obj, *args, **kwargs):
+            command = type(obj).__name__
+            if self._armed is not None and self._armed[0] in (None, command) and self._armed[1] == stage:
+                return self._profiled(fn, obj, command, stage, args, kwargs)
+            t0 = clock()
+            result = fn(obj, *args, **kwargs)
+            self._record(obj, command, stage, clock() - t0)
+            return result
+        timed.__name__ = fn.__name__
+        timed.__doc__ = fn.__doc__
+        timed.__wrapped__ = fn
+        return timed
+
+    def _record(self, obj, command, stage, dt):
+        key = (command, stage)
+        st = self.stats.get(key)
+        if st is None:
+            st = self.stats[key] = stage_stats(self.window)
+        counter = EVENT_COUNTERS.get(command)
+        st.add(dt, obj.num_bytes, counter(obj) if counter else 0)
+        if self.slow_threshold is not None and dt > self.slow_threshold:
+            self.slow.append({'command': command, 'stage': stage, 'seconds': dt, 'registers': _to_bytes(obj)})
+            del self.slow[:-self.max_slow]
+
+    def _profiled(self, fn, obj, command, stage, args, kwargs):
+        callback = self._armed[2]
+        self._armed = None
+        prof = cProfile.Profile()
+        t0 = time.perf_counter()
+        result = prof.runcall(fn, obj, *args, **kwargs)
+        self._record(obj, command, stage, time.perf_counter() - t0)
+        self.last_profile = pstats.Stats(prof)
+        if callback is not None:
+            callback(self.last_profile)
+        return result
+
+    def profile_next(self, command=None, stage='registers_2_fields', callback=None):
+        """
+            Run the next call of stage (on command, or on any command if None) under cProfile.
+            The result goes to self.last_profile and, if given, callback(pstats.Stats).
+            :return: None
+        """
+        if stage not in STAGES:
+            raise ValueError(f'unknown stage {stage!r}')
+        self._armed = (command, stage, callback)
+
+    def profile_buffer(self, command, registers, stage='registers_2_fields', sort='cumulative', limit=20):
+        """
+            Replay one buffer (e.g. an entry of self.slow) through a stage under cProfile.
+            Earlier stages needed to fill fields or user are run first, outside of the profile.
+            :param command: command class name
+            :param registers: raw bytes of the registers
+            :return: the profile report as text
+        """
+        obj = mca3k_data.COMMANDS[command].from_buffer(registers)
+        chain = ('registers_2_fields', 'fields_2_user', 'user_2_fields', 'fields_2_registers')
+        if stage in chain:
+            for before in chain[:chain.index(stage)]:
+                getattr(obj, before)()
+        prof = cProfile.Profile()
+        prof.runcall(getattr(obj, stage))
+        out = io.StringIO()
+        self.last_profile = pstats.Stats(prof, stream=out)
+        self.last_profile.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def snapshot(self):
+        """
+            :return: {command: {stage: {'count', 'total_s', 'mean_s', 'max_s', 'p50_s', 'p90_s', 'p99_s',
+                                        'bytes', 'events'}}}
+        """
+        out = {}
+        for (command, stage), st in sorted(self.stats.items()):
+            q = st.quantiles()
+            out.setdefault(command, {})[stage] = {
+                'count': st.count,
+                'total_s': st.total,
+                'mean_s': st.total/st.count if st.count else 0.0,
+                'max_s': st.max,
+                'p50_s': q[0.5],
+                'p90_s': q[0.9],
+                'p99_s': q[0.99],
+                'bytes': st.bytes,
+                'events': st.events,
+            }
+        return out
+
+    def prometheus(self, prefix='mca3k'):
+        """
+            :return: the numbers in the Prometheus text exposition format; latencies are a summary per
+                     command and stage
+        """
+        lines = [
+            f'# HELP {prefix}_stage_seconds Time spent in a command conversion stage.',
+            f'# TYPE {prefix}_stage_seconds summary',
+        ]
+        counters = []
+        for (command, stage), st in sorted(self.stats.items()):
+            labels = f'command="{command}",stage="{stage}"'
+            for q, v in st.quantiles().items():
+                lines.append(f'{prefix}_stage_seconds{{{labels},quantile="{q}"}} {v!r}')
+            lines.append(f'{prefix}_stage_seconds_sum{{{labels}}} {st.total!r}')
+            lines.append(f'{prefix}_stage_seconds_count{{{labels}}} {st.count}')
+            counters.append((labels, st))
+        for name, attr, text in (('bytes_total', 'bytes', 'Register bytes handled by a stage.'),
+                                 ('events_total', 'events', 'List mode events handled by a stage.')):
+            lines.append(f'# HELP {prefix}_stage_{name} {text}')
+            lines.append(f'# TYPE {prefix}_stage_{name} counter')
+            for labels, st in counters:
+                lines.append(f'{prefix}_stage_{name}{{{labels}}} {getattr(st, attr)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,331 @@
+"""
+    Pure-Python stand-in for an MCA-3000 at the USB protocol level, for load testing without hardware.
+
+    mca3k_device speaks the protocol of IoContainer and BaseManager in source-code: a 64-byte command packet on
+    CMD_OUT_EP whose first 4 bytes are the little-endian header
+        (nbytes << 16) + (mem_type << 12) + (cmd_ident << 4) + xfer_type [+ SHORT_WRITE_FLAG]
+    then either the write data on DATA_OUT_EP (or packed into bytes 4..63 of the command for a short write) or the
+    read data on DATA_IN_EP.  Every FPGA (MA_*) and ARM (ARM_*) address of mca3k_data is served from a RAM and an
+    NVRAM page per address, seeded from the simulator files in source-code/lib/sim_data.
+
+    Each transfer costs latency + nbytes/bandwidth seconds; with realtime=False the cost is only added up in
+    elapsed, so pipelines can be benchmarked faster than the wire.
+
+    sim_manager mirrors BaseManager (peek_serials, write_from, read_into) for mca3k_data command objects.
+"""
+import os
+import struct
+import time
+
+import numpy as np
+
+import mca3k_data
+
+SIM_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source-code', 'lib', 'sim_data')
+
+NUM_CMD_WRITE_BYTES = 64
+SHORT_WRITE_FLAG = 0x800
+RAM = 0
+NVRAM = 1
+
+# Endpoints, as in BaseManager
+CMD_OUT_EP = 0x01
+CMD_IN_EP = 0x81
+DATA_OUT_EP = 0x02
+DATA_IN_EP = 0x82
+
+FPGA = 'fpga'
+ARM = 'arm'
+TARGETS = {
+    mca3k_data.FPGA_WRITE: (FPGA, 'write'),
+    mca3k_data.FPGA_READ: (FPGA, 'read'),
+    mca3k_data.ARM_WRITE: (ARM, 'write'),
+    mca3k_data.ARM_READ: (ARM, 'read'),
+}
+
+# Page size in bytes of every address: the larger of the mca3k_data command and the C++ container.
+# Writes never go past the page; reads beyond the stored data return zeros.
+PAGE_BYTES = {
+    (FPGA, mca3k_data.MA_CONTROLS): 16*2,
+    (FPGA, mca3k_data.MA_STATISTICS): 16*4,
+    (FPGA, mca3k_data.MA_RESULTS): 32*2,
+    (FPGA, mca3k_data.MA_HISTOGRAM): 4096*4,
+    (FPGA, mca3k_data.MA_TRACE): 1024*2,
+    (FPGA, mca3k_data.MA_LISTMODE): 6*2048*2,  # fpga_lm_nrl1 is the largest list mode readout
+    (FPGA, mca3k_data.MA_WEIGHTS): 1024*2,
+    (FPGA, mca3k_data.MA_ACTIONS): 4*2,
+    (FPGA, mca3k_data.MA_TIME_SLICE): 1024*2,
+    (ARM, mca3k_data.ARM_VERSION): 16*4,
+    (ARM, mca3k_data.ARM_STATUS): 16*4,
+    (ARM, mca3k_data.ARM_CTRL): 64*4,  # the ARM control page holds 64 floats in sipm_3k_nvmem.txt
+    (ARM, mca3k_data.ARM_CAL): 64*4,
+}
+
+# arm_version registers from lib/sim_data/archive/sipm_3k_reset.txt, with fpga_speed in MHz as mca3k_data expects
+ARM_VERSION_REGISTERS = (515, 1, 1, 2, 3, 4, 256, 256, 7, 0, 0, 4, 8, 0, 0, 40)
+HISTOGRAM_COUNTS = 100000  # events in the seeded histogram
+
+
+def encode_header(nbytes, mem_type, cmd_ident, xfer_type, short_write=False):
+    """
+        Command header word, as built by IoContainer::update_transfer_flags.
+        :return: int
+    """
+    return (nbytes << 16) + (mem_type << 12) + (cmd_ident << 4) + xfer_type + (SHORT_WRITE_FLAG if short_write else 0)
+
+
+def decode_header(head):
+    """
+        :param head: header word or the command packet it starts
+        :return: {'nbytes', 'mem_type', 'cmd_ident', 'xfer_type', 'short_write'}
+    """
+    if not isinstance(head, int):
+        head = struct.unpack_from('<I', head)[0]
+    return {
+        'nbytes': head >> 16,
+        'mem_type': (head >> 12) & 0x1,
+        'cmd_ident': (head >> 4) & 0x7f,
+        'xfer_type': head & 0xf,
+        'short_write': bool(head & SHORT_WRITE_FLAG),
+    }
+
+
+def short_write_possible(nbytes):
+    return NUM_CMD_WRITE_BYTES - 4 >= nbytes
+
+
+def command_packet(cmd, direction, mem_type=RAM, data=None):
+    """
+        64-byte command packet for an mca3k_data command object, byte for byte what the C++ container sends.
+        :param direction: 'write' or 'read'
+        :param data: write data; default cmd.to_bytes()
+        :return: (packet, data for DATA_OUT_EP or None)
+    """
+    packet = bytearray(NUM_CMD_WRITE_BYTES)
+    if direction == 'write':
+        data = cmd.to_bytes() if data is None else bytes(data)
+        short = short_write_possible(len(data))
+        head = encode_header(NUM_CMD_WRITE_BYTES, mem_type, cmd.cmd_addr, cmd.wr_type, short)
+        if short:
+            packet[4:4 + len(data)] = data
+            data = None
+    elif direction == 'read':
+        head = encode_header(cmd.num_bytes, mem_type, cmd.cmd_addr, cmd.rd_type)
+        data = None
+    else:
+        raise ValueError(f"direction must be 'write' or 'read', not {direction!r}")
+    struct.pack_into('<I', packet, 0, head)
+    return bytes(packet), data
+
+
+def load_nvmem(path):
+    """
+        Split sipm_3k_nvmem.txt into pages: ARM control (64 floats), ARM calibration (64 floats),
+        FPGA controls (128 words) and FPGA weights (1024 words).
+        :return: {(target, address): bytes}
+    """
+    with open(path, 'r') as f:
+        values = f.read().split()
+    arm_ctrl = [float(v) for v in values[0:64]]
+    arm_cal = [float(v) for v in values[64:128]]
+    fpga_ctrl = [int(float(v)) for v in values[128:256]]
+    weights = [int(float(v)) for v in values[256:1280]]
+    return {
+        (ARM, mca3k_data.ARM_CTRL): np.array(arm_ctrl, dtype='<f4').tobytes(),
+        (ARM, mca3k_data.ARM_CAL): np.array(arm_cal, dtype='<f4').tobytes(),
+        (FPGA, mca3k_data.MA_CONTROLS): np.array(fpga_ctrl, dtype='<u2').tobytes(),
+        (FPGA, mca3k_data.MA_WEIGHTS): np.array(weights, dtype='<u2').tobytes(),
+    }
+
+
+def load_pf(path):
+    """
+        Read a cumulative energy distribution (sample_pf.txt, bck_pf.txt): 4096 values rising from 0 to 1.
+        :return: float64 array
+    """
+    return np.loadtxt(path, dtype=np.float64)
+
+
+def serial_registers(serial):
+    """
+        unique_sn_0..3 registers for a 32-digit hex serial number, inverse of ArmVersionContainer::decode_serial_number.
+        :return: 4 ints
+    """
+    raw = bytes.fromhex(serial)
+    if len(raw) != 16:
+        raise ValueError('serial number must have 32 hex digits')
+    return list(struct.unpack('<4I', raw))
+
+
+class mca3k_device:
+    def __init__(self, serial=None, sim_data=SIM_DATA, latency=0.0, bandwidth=None, realtime=True):
+        """
+            :param serial: 32-digit hex serial number; default 01000000020000000300000004000000
+            :param sim_data: directory with sipm_3k_nvmem.txt and sample_pf.txt
+            :param latency: seconds added to every USB transfer
+            :param bandwidth: bytes per second of the link; None is infinitely fast
+            :param realtime: sleep for the transfer cost (True) or only add it to self.elapsed (False)
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.realtime = realtime
+        self.elapsed = 0.0  # Simulated transfer time so far, in seconds
+        self.num_transfers = 0
+        self.num_bytes = 0
+        self.pending = None  # Decoded header of a command still waiting for its data phase
+        self.sources = {}  # (target, address) -> callable(device, nbytes) returning fresh read data
+
+        self.ram = {key: bytearray(size) for key, size in PAGE_BYTES.items()}
+        nvmem = load_nvmem(os.path.join(sim_data, 'sipm_3k_nvmem.txt'))
+        for key, data in nvmem.items():
+            self.ram[key] = bytearray(data) + bytearray(max(0, PAGE_BYTES[key] - len(data)))
+        self.nvram = {key: bytearray(page) for key, page in self.ram.items()}
+
+        self.version = list(ARM_VERSION_REGISTERS)
+        if serial is not None:
+            self.version[2:6] = serial_registers(serial)
+        self.ram[(ARM, mca3k_data.ARM_VERSION)][:64] = struct.pack('<16I', *self.version)
+
+        # Seed the histogram with the expectation of HISTOGRAM_COUNTS events from the sample spectrum
+        self.pf = load_pf(os.path.join(sim_data, 'sample_pf.txt'))
+        histo = np.rint(np.diff(self.pf, prepend=0.0)*HISTOGRAM_COUNTS).astype('<u4')
+        self.ram[(FPGA, mca3k_data.MA_HISTOGRAM)][:] = histo.tobytes()
+
+    @property
+    def serial(self):
+        """
+            Serial number as BaseManager reports it: bytes 8..23 of the ARM version page in hex.
+        """
+        return self.ram[(ARM, mca3k_data.ARM_VERSION)][8:24].hex().upper()
+
+    def set_source(self, target, address, source):
+        """
+            Generate the data of every read from one address instead of returning the stored page.
+            :param source: callable(device, nbytes) -> bytes, or None to go back to the stored page
+            :return: None
+        """
+        if (target, address) not in PAGE_BYTES:
+            raise ValueError(f'no {target} address {address}')
+        if source is None:
+            self.sources.pop((target, address), None)
+        else:
+            self.sources[(target, address)] = source
+
+    def _cost(self, nbytes):
+        dt = self.latency + (nbytes/self.bandwidth if self.bandwidth else 0.0)
+        self.elapsed += dt
+        self.num_transfers += 1
+        self.num_bytes += nbytes
+        if self.realtime and dt > 0:
+            time.sleep(dt)
+
+    def _page(self, head):
+        target, direction = TARGETS.get(head['xfer_type'], (None, None))
+        if target is None:
+            raise ValueError(f"unknown transfer type {head['xfer_type']}")
+        key = (target, head['cmd_ident'])
+        if key not in PAGE_BYTES:
+            raise ValueError(f"no {target} address {head['cmd_ident']}")
+        return key, direction, (self.nvram if head['mem_type'] == NVRAM else self.ram)
+
+    def _store(self, key, memory, data):
+        n = min(len(data), PAGE_BYTES[key])
+        memory[key][:n] = data[:n]
+
+    def bulk_out(self, endpoint, data):
+        """
+            Host-to-device transfer.
+            :param endpoint: CMD_OUT_EP for a command packet, DATA_OUT_EP for the data of a long write
+            :return: number of bytes accepted
+        """
+        data = bytes(data)
+        self._cost(len(data))
+        if endpoint == CMD_OUT_EP:
+            if len(data) < 4:
+                raise ValueError('command packet too short')
+            head = decode_header(data)
+            key, direction, memory = self._page(head)
+            if direction == 'write' and head['short_write']:
+                self._store(key, memory, data[4:NUM_CMD_WRITE_BYTES])
+                self.pending = None
+            else:
+                self.pending = head
+        elif endpoint == DATA_OUT_EP:
+            if self.pending is None or TARGETS[self.pending['xfer_type']][1] != 'write':
+                raise ValueError('data sent without a pending write command')
+            key, direction, memory = self._page(self.pending)
+            self._store(key, memory, data)
+            self.pending = None
+        else:
+            raise ValueError(f'cannot write to endpoint {endpoint:#x}')
+        return len(data)
+
+    def bulk_in(self, endpoint, nbytes):
+        """
+            Device-to-host transfer of the data requested by the last read command.
+            :return: bytes of length nbytes
+        """
+        if endpoint != DATA_IN_EP:
+            raise ValueError(f'cannot read from endpoint {endpoint:#x}')
+        if self.pending is None or TARGETS[self.pending['xfer_type']][1] != 'read':
+            raise ValueError('data requested without a pending read command')
+        key, direction, memory = self._page(self.pending)
+        self.pending = None
+        if key in self.sources:
+            data = bytes(self.sources[key](self, nbytes))
+        else:
+            data = bytes(memory[key][:nbytes])
+        data = data[:nbytes] + bytes(max(0, nbytes - len(data)))
+        self._cost(nbytes)
+        return data
+
+    def stats(self):
+        return {'transfers': self.num_transfers, 'bytes': self.num_bytes, 'elapsed': self.elapsed}
+
+
+class sim_manager:
+    def __init__(self, devices=None, **kwargs):
+        """
+            Host side of one or more simulated detectors, keyed by serial number like BaseManager::dev_map.
+            :param devices: list of mca3k_device; default one device built with kwargs
+        """
+        if devices is None:
+            devices = [mca3k_device(**kwargs)]
+        self.dev_map = {d.serial: d for d in devices}
+
+    def peek_serials(self):
+        return list(self.dev_map)
+
+    def _device(self, serial):
+        if serial not in self.dev_map:
+            raise KeyError(f"Can't find serial number '{serial}' in device map")
+        return self.dev_map[serial]
+
+    def write_from(self, serial, cmd, mem_type=RAM):
+        """
+            Write cmd.registers to the device, as BaseManager::write_from.
+            :return: None
+        """
+        dev = self._device(serial)
+        packet, data = command_packet(cmd, 'write', mem_type)
+        dev.bulk_out(CMD_OUT_EP, packet)
+        if data is not None:
+            dev.bulk_out(DATA_OUT_EP, data)
+
+    def read_raw(self, serial, cmd, mem_type=RAM):
+        """
+            Read the raw bytes of one command from the device, as BaseManager::read_into.
+            :return: bytes of length cmd.num_bytes
+        """
+        dev = self._device(serial)
+        packet, _ = command_packet(cmd, 'read', mem_type)
+        dev.bulk_out(CMD_OUT_EP, packet)
+        return dev.bulk_in(DATA_IN_EP, cmd.num_bytes)
+
+    def read_into(self, serial, cmd, mem_type=RAM):
+        """
+            Read the device into cmd.registers.
+            :return: cmd
+        """
+        cmd.load_buffer(self.read_raw(serial, cmd, mem_type))
+        return cmd
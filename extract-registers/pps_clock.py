@@ -0,0 +1,236 @@
+"""
+    PPS-disciplined conversion of ADC clock ticks to absolute UTC time.
+
+    A GPS receiver's pulse per second marks list mode events with the nrl1 'pps' flag.  Every marked event is a
+    knot (tick, UTC second): the first one is second utc0 and the following ones are numbered by rounding the
+    elapsed ticks to whole seconds at the current rate estimate, so missed pulses are bridged.  Pulses that come
+    too early (a second flagged event in the same second) or whose spacing is off by more than max_ppm plus
+    tolerance are rejected.
+
+    The knots are fitted incrementally with a piecewise-linear clock model: running least-squares sums over
+    segment_pps consecutive knots give the offset and rate of a segment; the last knot of a segment is the first of
+    the next.  The open segment is usable right away and refined as pulses arrive.  Before the first and after the
+    last segment the nearest segment is extrapolated.
+
+    to_utc() maps whole arrays of ticks with one searchsorted over the segment start ticks.  The model is saved as
+    JSON, so archived runs (see lm_archive) can be re-timed later without decoding the buffers again.
+"""
+import json
+import os
+
+import numpy as np
+
+from lm_stream import NRL1_FLAGS
+
+PPS_BIT = NRL1_FLAGS.index('pps')  # Bit of the pps flag in packed flags, e.g. the lm_archive flags column
+VERSION = 1
+
+
+def _segment_sums(tick, second, n):
+    """
+        Running least-squares sums of a segment, relative to its first knot.
+    """
+    return {'tick_ref': tick, 'sec_ref': second, 'n': n, 'sx': 0.0, 'sy': 0.0, 'sxx': 0.0, 'sxy': 0.0}
+
+
+class pps_clock:
+    def __init__(self, adc_sr=40.0e6, utc0=0, segment_pps=64, max_ppm=200.0, tolerance=1.0e-4):
+        """
+            :param adc_sr: nominal ADC sampling rate in Hz
+            :param utc0: UTC second (e.g. Unix time) of the first PPS pulse
+            :param segment_pps: number of PPS pulses per linear segment
+            :param max_ppm: largest accepted deviation of the oscillator from the current rate, in ppm
+            :param tolerance: seconds of timing jitter accepted on a PPS-marked event
+        """
+        self.adc_sr = adc_sr
+        self.utc0 = int(utc0)
+        self.segment_pps = int(segment_pps)
+        self.max_ppm = max_ppm
+        self.tolerance = tolerance
+
+        self.rate = float(adc_sr)  # Current estimate of ticks per second
+        self.last = None  # (tick, UTC second) of the last accepted pulse
+        self.accepted = 0
+        self.rejected = 0
+        # Closed segments: start tick, UTC second at the start, offset (s) and slope (s/tick)
+        self.seg = {'tick_ref': [], 'sec_ref': [], 'offset': [], 'slope': []}
+        self._open = None  # Running sums of the open segment
+        self._arrays = None  # Cached segment arrays for to_utc
+
+    def add_pps(self, ticks):
+        """
+            Add the time stamps of PPS-marked events.
+            :param ticks: non-decreasing unwrapped ADC clock ticks
+            :return: number of accepted pulses
+        """
+        before = self.accepted
+        for tick in np.asarray(ticks, dtype=np.int64).tolist():
+            if self.last is None:
+                self._add_knot(tick, self.utc0)
+                continue
+            dt = tick - self.last[0]
+            n = round(dt/self.rate)
+            slack = self.max_ppm*1e-6*dt + self.tolerance*self.rate
+            if n < 1 or abs(dt - n*self.rate) > slack:
+                self.rejected += 1
+                continue
+            self._add_knot(tick, self.last[1] + n)
+        return self.accepted - before
+
+    def add_chunk(self, chunk):
+        """
+            Add the PPS-marked events of a chunk of events.
+            :param chunk: dictionary with 'ticks' and either the nrl1 'pps' flag or packed 'flags' (lm_archive)
+            :return: number of accepted pulses
+        """
+        if 'pps' in chunk:
+            marked = np.asarray(chunk['pps']) != 0
+        else:
+            marked = (np.asarray(chunk['flags']) >> PPS_BIT) & 1 != 0
+        return self.add_pps(np.asarray(chunk['ticks'])[marked])
+
+    @classmethod
+    def from_archive(cls, archive, block=1 << 22, **kwargs):
+        """
+            Build the clock model from the pps flags stored in an lm_archive, reading block events at a time.
+            :param archive: lm_archive.lm_archive
+            :param kwargs: passed to pps_clock
+            :return: new pps_clock
+        """
+        clock = cls(adc_sr=archive.adc_sr, **kwargs)
+        ticks, flags = archive.columns['ticks'], archive.columns['flags']
+        for start in range(0, len(archive), block):
+            clock.add_chunk({'ticks': ticks[start:start + block], 'flags': flags[start:start + block]})
+        return clock
+
+    def _add_knot(self, tick, second):
+        if self._open is None:
+            self._open = _segment_sums(tick, second, 0)
+        o = self._open
+        x = float(tick - o['tick_ref'])
+        y = float(second - o['sec_ref'])
+        o['n'] += 1
+        o['sx'] += x
+        o['sy'] += y
+        o['sxx'] += x*x
+        o['sxy'] += x*y
+        self.last = (tick, second)
+        self.accepted += 1
+        self._arrays = None
+        offset, slope = self._fit(o)
+        self.rate = 1.0/slope
+        if o['n'] >= self.segment_pps:
+            self._close(offset, slope)
+            # The knot that closes a segment is the first one of the next
+            self._open = _segment_sums(tick, second, 1)
+
+    def _fit(self, o):
+        """
+            Least-squares line of the open segment.
+            :return: (offset in s at tick_ref, slope in s/tick)
+        """
+        n = o['n']
+        var = o['sxx'] - o['sx']*o['sx']/n
+        if n < 2 or var <= 0.0:
+            slope = self.seg['slope'][-1] if self.seg['slope'] else 1.0/self.rate
+            return o['sy']/n - slope*o['sx']/n, slope
+        slope = (o['sxy'] - o['sx']*o['sy']/n)/var
+        return (o['sy'] - slope*o['sx'])/n, slope
+
+    def _close(self, offset, slope):
+        o = self._open
+        self.seg['tick_ref'].append(o['tick_ref'])
+        self.seg['sec_ref'].append(o['sec_ref'])
+        self.seg['offset'].append(offset)
+        self.seg['slope'].append(slope)
+
+    def segments(self):
+        """
+            The closed segments plus the open one.
+            :return: dictionary of arrays 'tick_ref' (start tick, int64), 'sec_ref' (int64), 'offset' (s) and
+                     'slope' (s/tick); a segment covers the ticks from its start to the next segment's start
+        """
+        if self._arrays is None:
+            seg = {k: list(v) for k, v in self.seg.items()}
+            if self._open is not None:
+                offset, slope = self._fit(self._open)
+                seg['tick_ref'].append(self._open['tick_ref'])
+                seg['sec_ref'].append(self._open['sec_ref'])
+                seg['offset'].append(offset)
+                seg['slope'].append(slope)
+            self._arrays = {
+                'tick_ref': np.array(seg['tick_ref'], dtype=np.int64),
+                'sec_ref': np.array(seg['sec_ref'], dtype=np.int64),
+                'offset': np.array(seg['offset'], dtype=np.float64),
+                'slope': np.array(seg['slope'], dtype=np.float64),
+            }
+        return self._arrays
+
+    def to_utc(self, ticks, split=False):
+        """
+            Convert ADC clock ticks to UTC.
+            :param ticks: array-like of unwrapped ADC clock ticks
+            :param split: return whole seconds and fraction separately, to keep the full tick resolution
+            :return: float64 seconds, or (int64 seconds, float64 fraction in [0, 1)) if split
+        """
+        seg = self.segments()
+        if len(seg['tick_ref']) == 0:
+            raise ValueError('the clock model has no PPS pulses yet')
+        ticks = np.asarray(ticks, dtype=np.int64)
+        idx = np.searchsorted(seg['tick_ref'], ticks, side='right') - 1
+        np.maximum(idx, 0, out=idx)
+        frac = seg['offset'][idx] + seg['slope'][idx]*(ticks - seg['tick_ref'][idx])
+        whole = seg['sec_ref'][idx]
+        if not split:
+            return whole + frac
+        carry = np.floor(frac)
+        return whole + carry.astype(np.int64), frac - carry
+
+    def drift_ppm(self):
+        """
+            :return: oscillator deviation from adc_sr per segment, in ppm
+        """
+        return (1.0/(self.segments()['slope']*self.adc_sr) - 1.0)*1e6
+
+    def save(self, path):
+        """
+            Write the model, including the state needed to continue fitting, to a JSON file.
+            :return: None
+        """
+        state = {
+            'version': VERSION,
+            'adc_sr': self.adc_sr,
+            'utc0': self.utc0,
+            'segment_pps': self.segment_pps,
+            'max_ppm': self.max_ppm,
+            'tolerance': self.tolerance,
+            'rate': self.rate,
+            'last': self.last,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'segments': self.seg,
+            'open': self._open,
+        }
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(state))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+            Read a model written by save().
+            :return: new pps_clock
+        """
+        with open(path, 'r') as f:
+            state = json.loads(f.read())
+        if state.get('version') != VERSION:
+            raise ValueError(f'unsupported clock model version {state.get("version")!r}')
+        clock = cls(state['adc_sr'], state['utc0'], state['segment_pps'], state['max_ppm'], state['tolerance'])
+        clock.rate = state['rate']
+        clock.last = None if state['last'] is None else tuple(state['last'])
+        clock.accepted = state['accepted']
+        clock.rejected = state['rejected']
+        clock.seg = state['segments']
+        clock._open = state['open']
+        return clock
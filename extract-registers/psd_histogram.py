@@ -0,0 +1,198 @@
+"""
+    Streaming energy x pulse-shape histogram and cut-based particle classification for list mode events.
+
+    The pulse shape ratio of an event is its short integral over its energy: short_sums/energies for fpga_list_mode
+    mode 1 and psd/(psd_scale*energies) for fpga_lm_nrl1, whose raw psd word has the 16x scale of the raw energy.
+    psd_histogram folds each decoded chunk into a 2-D histogram of energy bins x ratio bins, classifies every event
+    by the first band it falls in (e.g. gamma and neutron bands of a CLYC or CeBr3 detector) and adds it to the
+    spectrum of its class, all in the same vectorized pass.
+
+    A band is (name, lo, hi) or (name, lo, hi, e_lo, e_hi): the event's ratio must lie in [lo, hi) and its energy in
+    [e_lo, e_hi).  lo and hi are numbers or polynomial coefficients in energy (highest power first, as numpy.polyval
+    takes them), for bands that bend with energy.
+"""
+import numpy as np
+
+import mca3k_data
+from lm_stream import NRL1_FLAGS
+
+NUM_BINS = 4096
+DEFAULT_BANDS = (('gamma', 0.0, 0.175), ('neutron', 0.175, 1.0))  # Matches the populations of sim_events
+
+
+class psd_histogram:
+    def __init__(self, bands=DEFAULT_BANDS, energy_bins=1024, energy_range=(0.0, NUM_BINS), ratio_bins=256,
+                 ratio_range=(0.0, 1.0), reject=('pu', 'ov', 'or'), psd_scale=16.0):
+        """
+            :param bands: sequence of (name, lo, hi[, e_lo, e_hi]) classification bands; the first match wins
+            :param energy_bins: number of energy bins of the 2-D histogram
+            :param energy_range: (low, high) energy in MCA bins covered by the 2-D histogram
+            :param ratio_bins: number of pulse shape ratio bins
+            :param ratio_range: (low, high) pulse shape ratio covered
+            :param reject: nrl1 flags; events with any of them set are dropped
+            :param psd_scale: raw nrl1 psd units per MCA bin of energy
+        """
+        unknown = set(reject) - set(NRL1_FLAGS)
+        if unknown:
+            raise ValueError(f'Unknown flags: {sorted(unknown)}')
+        self.bands = []
+        for band in bands:
+            name, lo, hi = band[:3]
+            e_lo, e_hi = band[3:5] if len(band) > 3 else (-np.inf, np.inf)
+            self.bands.append((name, np.atleast_1d(np.asarray(lo, dtype=np.float64)),
+                               np.atleast_1d(np.asarray(hi, dtype=np.float64)), e_lo, e_hi))
+        self.classes = [band[0] for band in self.bands]
+        if len(set(self.classes)) != len(self.classes):
+            raise ValueError('band names must be unique')
+        self.energy_bins = energy_bins
+        self.energy_range = tuple(float(e) for e in energy_range)
+        self.ratio_bins = ratio_bins
+        self.ratio_range = tuple(float(r) for r in ratio_range)
+        self.reject = tuple(reject)
+        self.psd_scale = psd_scale
+
+        self.counts = np.zeros((energy_bins, ratio_bins), dtype=np.uint64)
+        self.spectra = np.zeros((len(self.bands) + 1, NUM_BINS), dtype=np.uint64)  # Last row: unclassified
+        self.accepted = 0  # Events classified or unclassified, i.e. not rejected
+        self.rejected = 0  # Events dropped by the flag mask
+        self.out_of_range = 0  # Accepted events outside of the 2-D histogram
+
+    def reset(self):
+        """
+            Clear the histograms and the counters.
+            :return: None
+        """
+        self.counts[:] = 0
+        self.spectra[:] = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.out_of_range = 0
+
+    @staticmethod
+    def ratios(events, psd_scale=16.0):
+        """
+            Pulse shape ratio of each event of a chunk.
+            :param events: chunk dictionary with 'energies' (MCA bins) and 'short_sums' (MCA bins) or 'psd' (raw)
+            :return: float64 array; NaN where the energy is not positive
+        """
+        energies = np.asarray(events['energies'], dtype=np.float64)
+        if 'short_sums' in events:
+            short = np.asarray(events['short_sums'], dtype=np.float64)
+        elif 'psd' in events:
+            short = np.asarray(events['psd'], dtype=np.float64)/psd_scale
+        else:
+            raise ValueError("events need 'short_sums' (list mode 1) or 'psd' (nrl1)")
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(energies > 0, short/energies, np.nan)
+
+    def classify(self, energies, ratios):
+        """
+            :return: int8 array with the index of the first band each event falls in, len(self.classes) for none
+        """
+        labels = np.full(len(energies), len(self.bands), dtype=np.int8)
+        free = np.ones(len(energies), dtype=bool)
+        for k, (name, lo, hi, e_lo, e_hi) in enumerate(self.bands):
+            r_lo = lo[0] if len(lo) == 1 else np.polyval(lo, energies)
+            r_hi = hi[0] if len(hi) == 1 else np.polyval(hi, energies)
+            hit = free & (ratios >= r_lo) & (ratios < r_hi)
+            if e_lo != -np.inf or e_hi != np.inf:
+                hit &= (energies >= e_lo) & (energies < e_hi)
+            labels[hit] = k
+            free &= ~hit
+        return labels
+
+    def add(self, events):
+        """
+            Fold a chunk of list mode events into the histograms.
+            :param events: chunk dictionary from lm_stream (mode 1 or nrl1), or an fpga_list_mode / fpga_lm_nrl1
+                           object holding registers
+            :return: dictionary of class name -> boolean mask over the events of the chunk, plus 'rejected'
+        """
+        if isinstance(events, (mca3k_data.fpga_list_mode, mca3k_data.fpga_lm_nrl1)):
+            fields = events.registers_2_arrays()
+            n = min(fields['num_events'], len(fields['energies']))
+            chunk = {k: v[:n] for k, v in fields.items() if k in NRL1_FLAGS or k == 'psd'}
+            chunk['energies'] = fields['energies'][:n]/16.0
+            if 'short_sums' in fields:
+                if fields['mode'] != 1:
+                    raise ValueError('list mode 0 buffers carry no short sums')
+                chunk['short_sums'] = fields['short_sums'][:n]/16.0
+            events = chunk
+
+        energies = np.asarray(events['energies'], dtype=np.float64)
+        ratios = self.ratios(events, self.psd_scale)
+        rejected = np.zeros(len(energies), dtype=bool)
+        for name in self.reject:
+            if name in events:
+                rejected |= np.asarray(events[name]) != 0
+        labels = self.classify(energies, ratios)
+        labels[rejected] = -1
+        ok = ~rejected
+        self.rejected += int(np.count_nonzero(rejected))
+        self.accepted += len(energies) - int(np.count_nonzero(rejected))
+
+        # Per-class spectra in full MCA bins: one bincount over class*NUM_BINS + bin
+        mca = np.floor(energies).astype(np.intp)
+        take = ok & (mca >= 0) & (mca < NUM_BINS)
+        flat = labels[take].astype(np.intp)*NUM_BINS + mca[take]
+        self.spectra += np.bincount(flat, minlength=self.spectra.size).reshape(self.spectra.shape).astype(np.uint64)
+
+        # 2-D histogram: one bincount over energy bin*ratio_bins + ratio bin
+        e0, e1 = self.energy_range
+        r0, r1 = self.ratio_range
+        with np.errstate(invalid='ignore'):
+            eb = np.floor((energies - e0)*(self.energy_bins/(e1 - e0)))
+            rb = np.floor((ratios - r0)*(self.ratio_bins/(r1 - r0)))
+            inside = ok & (eb >= 0) & (eb < self.energy_bins) & (rb >= 0) & (rb < self.ratio_bins)
+        self.out_of_range += int(np.count_nonzero(ok) - np.count_nonzero(inside))
+        flat = eb[inside].astype(np.intp)*self.ratio_bins + rb[inside].astype(np.intp)
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape).astype(np.uint64)
+
+        masks = {name: labels == k for k, name in enumerate(self.classes)}
+        masks['rejected'] = rejected
+        return masks
+
+    def spectrum(self, name=None):
+        """
+            :param name: class name; None for the events in no band
+            :return: uint64 energy spectrum with NUM_BINS MCA bins
+        """
+        return self.spectra[len(self.classes) if name is None else self.classes.index(name)]
+
+    def projection(self, e_lo=None, e_hi=None):
+        """
+            Pulse shape ratio distribution of the events in an energy window, e.g. to place the band cuts.
+            :param e_lo: lower energy in MCA bins, default the bottom of the histogram
+            :param e_hi: upper energy in MCA bins, default the top of the histogram
+            :return: (ratio bin centers, counts)
+        """
+        e0, e1 = self.energy_range
+        scale = self.energy_bins/(e1 - e0)
+        b0 = 0 if e_lo is None else int(np.clip(np.floor((e_lo - e0)*scale), 0, self.energy_bins))
+        b1 = self.energy_bins if e_hi is None else int(np.clip(np.ceil((e_hi - e0)*scale), 0, self.energy_bins))
+        r0, r1 = self.ratio_range
+        centers = r0 + (np.arange(self.ratio_bins) + 0.5)*(r1 - r0)/self.ratio_bins
+        return centers, self.counts[b0:b1].sum(axis=0)
+
+    def figure_of_merit(self, a, b, e_lo=None, e_hi=None):
+        """
+            Separation of two classes in an energy window: distance of the mean ratios over the sum of the FWHMs
+            (Gaussian approximation from the standard deviations).  Each class is taken as the ratio bins
+            inside its band's limits; of polynomial limits only the constant term is used.
+            :param a: class name
+            :param b: class name
+            :return: figure of merit; above about 1.3 the classes are well separated
+        """
+        centers, counts = self.projection(e_lo, e_hi)
+        stats = []
+        for name in (a, b):
+            _, lo, hi, _, _ = self.bands[self.classes.index(name)]
+            sel = (centers >= lo[-1]) & (centers < hi[-1])
+            w = counts[sel].astype(np.float64)
+            if w.sum() == 0:
+                return 0.0
+            mean = np.average(centers[sel], weights=w)
+            std = np.sqrt(np.average((centers[sel] - mean)**2, weights=w))
+            stats.append((mean, std))
+        (m1, s1), (m2, s2) = stats
+        return abs(m2 - m1)/(2.3548*(s1 + s2)) if s1 + s2 > 0 else np.inf
@@ -0,0 +1,282 @@
+"""
+    Synthetic event streams for load and soak tests, drawn from the spectra in source-code/lib/sim_data.
+
+    sample_pf.txt (source) and bck_pf.txt (background) are cumulative distributions over the 4096 MCA bins.
+    event_generator draws Poisson-timed events from a mix of the two and the pack_* functions turn blocks of events
+    into byte-exact register buffers of fpga_list_mode (mode 0 and 1), fpga_lm_nrl1, fpga_histogram and
+    fpga_time_slice, ready for mca3k_data.<command>.from_buffer, lm_stream or mca3k_sim.
+
+    Events are dictionaries of equal-length numpy arrays:
+        'ticks':  absolute time in ADC clock ticks (int64); the packers truncate it to the width of each format,
+                  so starting near a counter period exercises the wrap-around
+        'energy': energy register, 16 per MCA bin (uint16), 0xFFFF on overflow
+        'psd':    pulse shape register (uint16), also used as the mode 1 short sum
+        'pu', 'ov', 'pps': flags (uint8): pile-up within pileup_time of a neighbour, energy beyond the last bin,
+                  first event after a PPS edge
+"""
+import os
+
+import numpy as np
+
+from lm_stream import MODE1_TICKS
+from mca3k_sim import SIM_DATA, load_pf
+
+NUM_BINS = 4096
+LIST_MODE_EVENTS = (1024 - 4)//3  # 340 three-word records after the 4 header words
+NRL1_EVENTS = 2048 - 1  # 6-word records after the header record
+TIME_SLICE_BINS = 1024 - 18
+TIME_SLICE_BIN_WIDTH = 4  # MCA bins per time slice bin
+DWELL_TIME = 0.1048576  # 64*65536/40e6, as in fpga_time_slice.registers_2_fields
+
+# psd/energy ratio of the two particle populations; illustrative values that separate cleanly
+GAMMA_PSD = 0.10
+NEUTRON_PSD = 0.25
+PSD_SPREAD = 0.02
+
+
+class event_generator:
+    def __init__(self, rate=1.0e5, background_rate=0.0, neutron_fraction=0.0, gain=1.0, pileup_time=1.0e-6,
+                 start_tick=0, adc_sr=40.0e6, sim_data=SIM_DATA, seed=None):
+        """
+            :param rate: source events per second, energies from sample_pf.txt
+            :param background_rate: background events per second, energies from bck_pf.txt
+            :param neutron_fraction: fraction of events given the neutron psd ratio
+            :param gain: factor on the energies; > 1 pushes the top of the spectrum into overflow
+            :param pileup_time: events closer than this (seconds) to a neighbour are flagged pu
+            :param start_tick: clock value of the first event, e.g. just below 2**32 to test mode 0 wrap-around
+            :param adc_sr: ADC sampling rate in Hz
+            :param seed: seed of the numpy random generator
+        """
+        self.rate = float(rate)
+        self.background_rate = float(background_rate)
+        if self.rate + self.background_rate <= 0:
+            raise ValueError('total event rate must be positive')
+        self.neutron_fraction = neutron_fraction
+        self.gain = gain
+        self.pileup_ticks = int(round(pileup_time*adc_sr))
+        self.adc_sr = adc_sr
+        self.rng = np.random.default_rng(seed)
+        self.cdfs = [load_pf(os.path.join(sim_data, 'sample_pf.txt')), load_pf(os.path.join(sim_data, 'bck_pf.txt'))]
+
+        self.clock = float(start_tick)  # Time of the last event, in ticks (float to keep sub-tick gaps)
+        self.last_tick = None  # For pile-up and PPS flags across blocks
+        self.num_events = 0
+
+    def _energies(self, cdf, n):
+        """
+            Inverse-CDF sampling with a uniform position inside the bin.
+            :return: energies in MCA bins (float64)
+        """
+        b = np.searchsorted(cdf, self.rng.random(n), side='right')
+        return np.minimum(b, NUM_BINS - 1) + self.rng.random(n)
+
+    def events(self, n):
+        """
+            Draw the next n events.
+            :return: event dictionary, see module docstring
+        """
+        n = int(n)
+        total = self.rate + self.background_rate
+        gaps = self.rng.exponential(self.adc_sr/total, n)
+        times = self.clock + np.cumsum(gaps)
+        if n:
+            self.clock = times[-1]
+        ticks = times.astype(np.int64)
+
+        bins = np.empty(n)
+        is_bck = self.rng.random(n) < self.background_rate/total
+        nb = int(is_bck.sum())
+        bins[~is_bck] = self._energies(self.cdfs[0], n - nb)
+        bins[is_bck] = self._energies(self.cdfs[1], nb)
+        bins *= self.gain
+        ov = bins >= NUM_BINS
+        energy = np.where(ov, 0xFFFF, np.minimum(bins*16, 0xFFFE)).astype(np.uint16)
+
+        ratio = np.where(self.rng.random(n) < self.neutron_fraction, NEUTRON_PSD, GAMMA_PSD)
+        ratio += self.rng.normal(0.0, PSD_SPREAD, n)
+        psd = np.clip(energy*ratio, 0, 0xFFFF).astype(np.uint16)
+
+        prev = np.empty(n, dtype=np.int64)
+        if n:
+            prev[0] = ticks[0] - self.pileup_ticks - 1 if self.last_tick is None else self.last_tick
+            prev[1:] = ticks[:-1]
+        close = ticks - prev <= self.pileup_ticks
+        pu = close.copy()
+        pu[:-1] |= close[1:]  # Both partners of a pile-up are flagged; the last partner may come in the next block
+        sec = int(self.adc_sr)
+        pps = ticks//sec != prev//sec
+        if n:
+            if self.last_tick is None:
+                pps[0] = False
+            self.last_tick = int(ticks[-1])
+        self.num_events += n
+
+        return {
+            'ticks': ticks,
+            'energy': energy,
+            'psd': psd,
+            'pu': pu.astype(np.uint8),
+            'ov': ov.astype(np.uint8),
+            'pps': pps.astype(np.uint8),
+        }
+
+    def events_for(self, duration):
+        """
+            Draw the events of the next duration seconds; the count is Poisson distributed.
+            :return: event dictionary
+        """
+        return self.events(self.rng.poisson((self.rate + self.background_rate)*duration))
+
+    def list_mode_buffers(self, num_buffers, mode=0):
+        """
+            :return: (num_buffers, 1024) uint16 array of full fpga_list_mode buffers
+        """
+        return pack_list_mode(self.events(num_buffers*LIST_MODE_EVENTS), mode)
+
+    def nrl1_buffers(self, num_buffers):
+        """
+            :return: (num_buffers, 12288) uint16 array of full fpga_lm_nrl1 buffers
+        """
+        return pack_nrl1(self.events(num_buffers*NRL1_EVENTS))
+
+    def time_slices(self, num_slices, dwell_time=DWELL_TIME, first_buffer=0, temperature=25.0, dead_time=2.0e-6):
+        """
+            Events of num_slices consecutive dwell times packed as fpga_time_slice buffers.
+            :return: (num_slices, 1024) uint16 array
+        """
+        start = self.clock
+        ev = self.events_for(num_slices*dwell_time)
+        return pack_time_slices(ev, start, num_slices, dwell_time*self.adc_sr, first_buffer, temperature,
+                                int(round(dead_time*self.adc_sr)))
+
+    def attach(self, device, list_mode=0, histogram_events=None):
+        """
+            Make a mca3k_sim.mca3k_device serve generated data: every list mode read returns a full buffer of new
+            events (fpga_lm_nrl1 when the read is large enough, else fpga_list_mode in mode list_mode), every time
+            slice read the next slice, and histogram reads the histogram of all events served so far.
+            :param histogram_events: events drawn per histogram read, so polling the histogram alone advances time
+            :return: None
+        """
+        from mca3k_sim import FPGA
+        import mca3k_data
+        state = {'histogram': np.zeros(NUM_BINS, dtype=np.uint32), 'slice': 0}
+
+        def served(ev):
+            pack_histogram(ev, state['histogram'])
+            return ev
+
+        def list_source(dev, nbytes):
+            if nbytes >= 2*6*2048:
+                return pack_nrl1(served(self.events(NRL1_EVENTS)))[0].tobytes()
+            return pack_list_mode(served(self.events(LIST_MODE_EVENTS)), list_mode)[0].tobytes()
+
+        def histogram_source(dev, nbytes):
+            if histogram_events:
+                served(self.events(histogram_events))
+            return state['histogram'].astype('<u4').tobytes()
+
+        def time_slice_source(dev, nbytes):
+            start = self.clock
+            ev = served(self.events_for(DWELL_TIME))
+            buf = pack_time_slices(ev, start, 1, DWELL_TIME*self.adc_sr, state['slice'])
+            state['slice'] += 1
+            return buf[0].tobytes()
+
+        device.set_source(FPGA, mca3k_data.MA_LISTMODE, list_source)
+        device.set_source(FPGA, mca3k_data.MA_HISTOGRAM, histogram_source)
+        device.set_source(FPGA, mca3k_data.MA_TIME_SLICE, time_slice_source)
+
+
+def _records(events, per_buffer, num_words):
+    """
+        Allocate the buffers for a block of events and the buffer/slot index of every event.
+        :return: (buffers, buffer index, slot index, events per buffer)
+    """
+    n = len(events['ticks'])
+    num_buffers = max(1, -(-n//per_buffer))
+    buffers = np.zeros((num_buffers, num_words), dtype='<u2')
+    idx = np.arange(n)
+    counts = np.bincount(idx//per_buffer, minlength=num_buffers)
+    return buffers, idx//per_buffer, idx % per_buffer, counts
+
+
+def pack_list_mode(events, mode=0):
+    """
+        Pack events into fpga_list_mode buffers of up to 340 events.
+        Mode 0: energy and the low 32 bits of the tick count.
+        Mode 1: energy, short sum (the psd register) and a 16-bit time in units of MODE1_TICKS ticks, which
+        fpga_list_mode.fields_2_user reads from the word before the energy (register 3 + 3k for event k).
+        :return: (num_buffers, 1024) uint16 array; the last buffer may be partially filled
+    """
+    buffers, b, s, counts = _records(events, LIST_MODE_EVENTS, 1024)
+    buffers[:, 0] = counts | (0x8000 if mode else 0)
+    rec = buffers[:, 4:].reshape(len(buffers), LIST_MODE_EVENTS, 3)
+    ticks = events['ticks'].astype(np.uint64)
+    rec[b, s, 0] = events['energy']
+    if mode == 0:
+        rec[b, s, 1] = ticks & 0xFFFF
+        rec[b, s, 2] = (ticks >> 16) & 0xFFFF
+    else:
+        rec[b, s, 1] = events['psd']
+        buffers[b, 3 + 3*s] = (ticks//MODE1_TICKS) & 0xFFFF
+    return buffers
+
+
+def pack_nrl1(events):
+    """
+        Pack events into fpga_lm_nrl1 buffers of up to 2047 events, with the 51-bit wall clock and the flags.
+        :return: (num_buffers, 12288) uint16 array; the last buffer may be partially filled
+    """
+    buffers, b, s, counts = _records(events, NRL1_EVENTS, 6*2048)
+    buffers[:, 0] = counts + 1  # The count includes the header record
+    rec = buffers.reshape(len(buffers), 2048, 6)[:, 1:]
+    wc = events['ticks'].astype(np.uint64) & ((1 << 51) - 1)
+    flags = ((events['pu'].astype(np.uint64) << 4) | (events['ov'].astype(np.uint64) << 5)
+             | (events['pps'].astype(np.uint64) << 7))
+    rec[b, s, 0] = events['psd']
+    rec[b, s, 1] = events['energy']
+    rec[b, s, 2] = wc & 0xFFFF
+    rec[b, s, 3] = (wc >> 16) & 0xFFFF
+    rec[b, s, 4] = (wc >> 32) & 0xFFFF
+    rec[b, s, 5] = ((wc >> 48) & 0x7) | flags
+    return buffers
+
+
+def pack_histogram(events, histogram=None):
+    """
+        Add events to a 4096-bin fpga_histogram register array; overflow events land in the last bin.
+        :param histogram: uint32 array to add to; None starts from zero
+        :return: the histogram
+    """
+    if histogram is None:
+        histogram = np.zeros(NUM_BINS, dtype=np.uint32)
+    bins = np.minimum(events['energy'] >> 4, NUM_BINS - 1)
+    histogram += np.bincount(bins, minlength=NUM_BINS).astype(np.uint32)
+    return histogram
+
+
+def pack_time_slices(events, start_tick, num_slices, slice_ticks, first_buffer=0, temperature=25.0, dead_ticks=80):
+    """
+        Pack events into fpga_time_slice buffers, one per slice_ticks interval starting at start_tick.
+        The 16-bit counters and histogram bins wrap like hardware registers; the dead time is dead_ticks per event.
+        :return: (num_slices, 1024) uint16 array
+    """
+    slices = np.zeros((num_slices, 1024), dtype='<u2')
+    k = ((events['ticks'] - start_tick)//slice_ticks).astype(np.int64)
+    keep = (k >= 0) & (k < num_slices)
+    k = k[keep]
+    bins = np.minimum(events['energy'][keep] >> 4, NUM_BINS - 1)//TIME_SLICE_BIN_WIDTH
+    in_range = bins < TIME_SLICE_BINS
+    hist = np.bincount(k[in_range]*TIME_SLICE_BINS + bins[in_range], minlength=num_slices*TIME_SLICE_BINS)
+    slices[:, 18:] = (hist.reshape(num_slices, TIME_SLICE_BINS) & 0xFFFF)
+
+    triggers = np.bincount(k, minlength=num_slices)
+    good = np.bincount(k[events['pu'][keep] == 0], minlength=num_slices)
+    dead = np.minimum(triggers*dead_ticks, int(slice_ticks))
+    slices[:, 0] = (first_buffer + np.arange(num_slices)) & 0xFFFF
+    slices[:, 1] = int(round(temperature*16)) & 0xFFFF
+    slices[:, 8] = good & 0xFFFF
+    slices[:, 10] = triggers & 0xFFFF
+    slices[:, 12] = dead & 0xFFFF
+    slices[:, 13] = dead >> 16
+    return slices
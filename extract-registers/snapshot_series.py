@@ -0,0 +1,139 @@
+"""
+    Compact storage for long series of register snapshots of one command, e.g. a day of fpga_results,
+    fpga_statistics or arm_status readings taken once per second.
+
+    A command object keeps its registers plus the fields and user dictionaries, which for the small commands is
+    several kilobytes per snapshot.  snapshot_series stores only the registers, as one row of a typed 2-D numpy
+    array per snapshot (2 or 4 bytes per register), plus a float64 timestamp column.  Fields are decoded on demand:
+    series[i] returns a command object whose registers are a zero-copy view of row i, so the usual
+    registers_2_fields / fields_2_user calls and the dictionary access to fields and user keep working.
+    records() decodes the fields of the whole series into a numpy record array with one column per field.
+"""
+import time
+
+import numpy as np
+
+import mca3k_data
+
+# numpy dtype of the registers of each command data type; the MCA-3000 sends little-endian data
+REGISTER_DTYPES = {'H': np.dtype('<u2'), 'I': np.dtype('<u4'), 'f': np.dtype('<f4')}
+
+
+class snapshot_series:
+    def __init__(self, command, capacity=1024):
+        """
+            :param command: command class or class name in mca3k_data.COMMANDS
+            :param capacity: number of snapshots to allocate room for; the storage grows as needed
+        """
+        self.command = mca3k_data.COMMANDS[command] if isinstance(command, str) else command
+        proto = self.command()
+        self.data_type = proto.data_type
+        self.num_items = proto.num_items
+        self.dtype = REGISTER_DTYPES[self.data_type]
+        self.rows = np.zeros((max(1, capacity), self.num_items), dtype=self.dtype)
+        self.times = np.zeros(max(1, capacity), dtype=np.float64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self):
+        capacity = 2*len(self.rows)
+        rows = np.zeros((capacity, self.num_items), dtype=self.dtype)
+        rows[:self.size] = self.rows[:self.size]
+        times = np.zeros(capacity, dtype=np.float64)
+        times[:self.size] = self.times[:self.size]
+        self.rows, self.times = rows, times
+
+    def append(self, snapshot, timestamp=None):
+        """
+            Add one snapshot.
+            :param snapshot: command object of the series' class, or a raw little-endian USB buffer
+            :param timestamp: seconds; None uses time.time()
+            :return: index of the snapshot
+        """
+        if self.size == len(self.rows):
+            self._grow()
+        raw = snapshot.to_bytes() if hasattr(snapshot, 'to_bytes') else snapshot
+        row = np.frombuffer(raw, dtype=self.dtype, count=self.num_items)
+        self.rows[self.size] = row
+        self.times[self.size] = time.time() if timestamp is None else timestamp
+        self.size += 1
+        return self.size - 1
+
+    @property
+    def registers(self):
+        """
+            (len, num_items) view of the stored registers.
+        """
+        return self.rows[:self.size]
+
+    @property
+    def timestamps(self):
+        return self.times[:self.size]
+
+    @property
+    def nbytes(self):
+        """
+            Bytes of register and timestamp storage in use.
+        """
+        return self.size*(self.rows.itemsize*self.num_items + self.times.itemsize)
+
+    def __getitem__(self, i):
+        """
+            :return: command object whose registers are a memoryview of row i; fields and user are empty
+                     until registers_2_fields / fields_2_user are called on it
+        """
+        if not -self.size <= i < self.size:
+            raise IndexError('snapshot index out of range')
+        obj = self.command()
+        obj.registers = memoryview(self.rows[i % self.size]).cast('B').cast(self.data_type)
+        return obj
+
+    def fields(self, i):
+        """
+            :return: the fields dictionary of snapshot i
+        """
+        obj = self[i]
+        obj.registers_2_fields()
+        return obj.fields
+
+    def user(self, i):
+        """
+            :return: the user dictionary of snapshot i
+        """
+        obj = self[i]
+        obj.registers_2_fields()
+        obj.fields_2_user()
+        return obj.user
+
+    def records(self, names=None):
+        """
+            Decode the fields of all snapshots into a record array.
+            Commands with a bit-field layout table are decoded in one vectorized pass; the others go through
+            registers_2_fields snapshot by snapshot, and fields holding lists are left out.
+            :param names: field names to keep; None keeps all scalar fields
+            :return: numpy record array of length len(self), plus a 'timestamp' column
+        """
+        if self.command.layout is not None:
+            columns = self.command.registers_2_fields_batch(self.registers)
+        else:
+            obj = self.command()
+            columns = None
+            for k, row in enumerate(self.registers):
+                obj.registers = row.tolist()
+                obj.registers_2_fields()
+                if columns is None:
+                    columns = {name: np.empty(self.size, dtype=np.asarray(v).dtype)
+                               for name, v in obj.fields.items() if np.ndim(v) == 0}
+                for name, col in columns.items():
+                    col[k] = obj.fields[name]
+            if columns is None:
+                columns = {}
+        if names is not None:
+            columns = {name: columns[name] for name in names}
+        out = np.empty(self.size, dtype=[('timestamp', '<f8')] + [(name, c.dtype) for name, c in columns.items()])
+        out['timestamp'] = self.timestamps
+        for name, c in columns.items():
+            out[name] = c
+        return out.view(np.recarray)
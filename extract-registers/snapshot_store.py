@@ -0,0 +1,315 @@
+"""
+    Delta-compressed, append-only store of periodic register snapshots, e.g. every fpga_histogram readout or
+    every fpga_time_slice buffer of a run.
+
+    A store is a directory with
+        data.bin    the compressed frames, one per snapshot, back to back
+        index.bin   one INDEX_DTYPE record per snapshot: byte offset and length of its frame, and a timestamp
+        meta.json   command name, register data type and count, keyframe interval and snapshot count
+    Snapshot i is a keyframe when i is a multiple of keyframe_interval and holds the registers themselves; every
+    other snapshot holds the difference to its predecessor.  The values are zigzag-encoded (small negative
+    differences, e.g. after a histogram clear, stay small), packed as little-endian base-128 varints and
+    compressed with zlib.  float registers are stored through their int32 bit patterns, so the store is lossless
+    for all command types.
+
+    Reading a snapshot decodes from the keyframe before it.  Ranges are decoded in one vectorized pass: the
+    frames are decompressed and joined, the varints of all of them are unpacked at once, and a cumulative sum
+    over the rows, restarted at every keyframe, rebuilds the registers.
+"""
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+import mca3k_data
+
+DATA_FILE = 'data.bin'
+INDEX_FILE = 'index.bin'
+META_FILE = 'meta.json'
+VERSION = 1
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i8'), ('timestamp', '<f8')])
+# Storage dtype of the registers and the integer dtype their differences are taken in
+REGISTER_DTYPES = {'H': (np.dtype('<u2'), np.dtype('<u2')), 'I': (np.dtype('<u4'), np.dtype('<u4')),
+                   'f': (np.dtype('<f4'), np.dtype('<i4'))}
+
+
+def zigzag_encode(values):
+    """
+        Map signed int64 to uint64 so that numbers close to zero get small codes: 0, -1, 1, -2 -> 0, 1, 2, 3.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def zigzag_decode(codes):
+    codes = np.asarray(codes, dtype=np.uint64)
+    return (codes >> np.uint64(1)).view(np.int64) ^ -(codes & np.uint64(1)).view(np.int64)
+
+
+def varint_encode(codes):
+    """
+        Pack uint64 values as base-128 varints (7 bits per byte, high bit set on all but the last byte).
+        :return: uint8 array
+    """
+    codes = np.asarray(codes, dtype=np.uint64)
+    nbytes = np.ones(len(codes), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += codes >= np.uint64(1 << 7*k)
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max()) if len(codes) else 0):
+        sel = np.flatnonzero(nbytes > k)
+        byte = (codes[sel] >> np.uint64(7*k)) & np.uint64(0x7F)
+        byte |= (nbytes[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[sel] + k] = byte
+    return out
+
+
+def varint_decode(data):
+    """
+        Unpack back-to-back base-128 varints.
+        :param data: uint8 array or bytes
+        :return: uint64 array
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, (bytes, bytearray)) else np.asarray(data)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) == len(data):
+        return data.astype(np.uint64)  # All values below 128, the usual case for small differences
+    if len(ends) == 0:
+        return np.empty(0, dtype=np.uint64)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    owner = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = (np.arange(ends[-1] + 1) - starts[owner])*7
+    parts = (data[:ends[-1] + 1] & 0x7F).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+class snapshot_store_writer:
+    def __init__(self, path, command='fpga_histogram', keyframe_interval=64, level=6):
+        """
+            Open a store for appending, creating it if needed.  An existing store keeps its own command and
+            keyframe interval.
+            :param path: store directory
+            :param command: command class or name in mca3k_data.COMMANDS whose registers are stored
+            :param keyframe_interval: snapshots from one keyframe to the next
+            :param level: zlib compression level
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_fn = os.path.join(path, META_FILE)
+        if os.path.exists(meta_fn):
+            with open(meta_fn, 'r') as f:
+                meta = json.loads(f.read())
+            command = meta['command']
+            keyframe_interval = meta['keyframe_interval']
+        self.command = command if isinstance(command, str) else command.__name__
+        proto = mca3k_data.COMMANDS[self.command]()
+        self.data_type = proto.data_type
+        self.num_items = proto.num_items
+        self.keyframe_interval = int(keyframe_interval)
+        self.level = level
+
+        # Keep the complete frames the index knows about; drop a torn tail left by an interrupted writer
+        index_fn = os.path.join(path, INDEX_FILE)
+        data_fn = os.path.join(path, DATA_FILE)
+        count = os.path.getsize(index_fn)//INDEX_DTYPE.itemsize if os.path.exists(index_fn) else 0
+        size = os.path.getsize(data_fn) if os.path.exists(data_fn) else 0
+        index = np.fromfile(index_fn, dtype=INDEX_DTYPE, count=count) if count else np.empty(0, INDEX_DTYPE)
+        while count and index[count - 1]['offset'] + index[count - 1]['length'] > size:
+            count -= 1
+        self.count = count
+        self.offset = int(index[count - 1]['offset'] + index[count - 1]['length']) if count else 0
+        self.data_file = open(data_fn, 'ab')
+        self.data_file.truncate(self.offset)
+        self.index_file = open(index_fn, 'ab')
+        self.index_file.truncate(count*INDEX_DTYPE.itemsize)
+        self.previous = None
+        if count:
+            _, diff = REGISTER_DTYPES[self.data_type]
+            last = snapshot_store(path, count).read(count - 1, count)[0]
+            self.previous = last.view(diff).astype(np.int64)  # Bit patterns, as append() takes the differences
+        self._write_meta()
+
+    def append(self, snapshot, timestamp=0.0):
+        """
+            Append one snapshot.
+            :param snapshot: command object, raw little-endian USB buffer or array of num_items registers
+            :param timestamp: seconds, stored in the index
+            :return: index of the snapshot
+        """
+        storage, diff = REGISTER_DTYPES[self.data_type]
+        if hasattr(snapshot, 'to_bytes'):
+            snapshot = snapshot.to_bytes()
+        if isinstance(snapshot, (bytes, bytearray, memoryview)):
+            row = np.frombuffer(snapshot, dtype=storage, count=self.num_items)
+        else:
+            row = np.asarray(snapshot).astype(storage)
+            if row.shape != (self.num_items,):
+                raise ValueError(f'{self.command} snapshots have {self.num_items} registers, got {row.shape}')
+        row = row.view(diff).astype(np.int64)
+        if self.count % self.keyframe_interval == 0:
+            values = row
+        else:
+            values = row - self.previous
+        frame = zlib.compress(varint_encode(zigzag_encode(values)).tobytes(), self.level)
+        self.data_file.write(frame)
+        entry = np.array([(self.offset, len(frame), timestamp)], dtype=INDEX_DTYPE)
+        self.index_file.write(entry.tobytes())
+        self.offset += len(frame)
+        self.previous = row
+        self.count += 1
+        return self.count - 1
+
+    def flush(self):
+        self.data_file.flush()
+        self.index_file.flush()
+        self._write_meta()
+
+    def close(self):
+        self.flush()
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_meta(self):
+        meta = {'version': VERSION, 'command': self.command, 'data_type': self.data_type,
+                'num_items': self.num_items, 'keyframe_interval': self.keyframe_interval, 'count': self.count}
+        tmp = os.path.join(self.path, META_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(meta))
+        os.replace(tmp, os.path.join(self.path, META_FILE))
+
+
+class snapshot_store:
+    def __init__(self, path, count=None):
+        """
+            Open a store for reading.  Snapshots appended later are not visible; reopen to see them.
+            :param path: store directory
+            :param count: number of snapshots to use, default all complete ones
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.loads(f.read())
+        if meta['version'] != VERSION:
+            raise ValueError(f'unsupported snapshot store version {meta["version"]!r}')
+        self.command = meta['command']
+        self.data_type = meta['data_type']
+        self.num_items = meta['num_items']
+        self.keyframe_interval = meta['keyframe_interval']
+
+        index_fn = os.path.join(path, INDEX_FILE)
+        data_fn = os.path.join(path, DATA_FILE)
+        num = os.path.getsize(index_fn)//INDEX_DTYPE.itemsize
+        num = num if count is None else min(num, count)
+        self.index = np.fromfile(index_fn, dtype=INDEX_DTYPE, count=num)
+        size = os.path.getsize(data_fn)
+        while num and self.index[num - 1]['offset'] + self.index[num - 1]['length'] > size:
+            num -= 1  # The index may run ahead of the data while a writer is active
+        self.index = self.index[:num]
+        self.count = num
+        self.data = np.memmap(data_fn, dtype=np.uint8, mode='r') if size else np.empty(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def timestamps(self):
+        return self.index['timestamp']
+
+    def nbytes(self):
+        """
+            :return: (compressed bytes on disk, bytes of the raw registers)
+        """
+        storage, _ = REGISTER_DTYPES[self.data_type]
+        return int(self.index['length'].sum()), self.count*self.num_items*storage.itemsize
+
+    def read(self, start=0, stop=None):
+        """
+            Decode snapshots start <= i < stop in one vectorized pass, starting from the keyframe before start.
+            :return: (stop - start, num_items) array of the registers in their storage dtype
+        """
+        stop = self.count if stop is None else min(stop, self.count)
+        start = max(0, start)
+        storage, diff = REGISTER_DTYPES[self.data_type]
+        if start >= stop:
+            return np.empty((0, self.num_items), dtype=storage)
+        first = (start//self.keyframe_interval)*self.keyframe_interval
+        entries = self.index[first:stop]
+        raw = b''.join(zlib.decompress(self.data[o:o + n]) for o, n in zip(entries['offset'].tolist(),
+                                                                            entries['length'].tolist()))
+        values = zigzag_decode(varint_decode(raw))
+        if len(values) != len(entries)*self.num_items:
+            raise ValueError(f'{self.path}: corrupt frames between snapshots {first} and {stop}')
+        rows = values.reshape(len(entries), self.num_items)
+
+        # Cumulative sum over the rows, restarted at each keyframe (int64 wraps consistently, so this is exact)
+        total = np.cumsum(rows, axis=0)
+        keys = np.arange(0, len(entries), self.keyframe_interval)
+        before = np.zeros((len(keys), self.num_items), dtype=np.int64)
+        before[1:] = total[keys[1:] - 1]
+        total -= np.repeat(before, np.diff(np.append(keys, len(entries))), axis=0)
+        return total[start - first:].astype(diff).view(storage)
+
+    def __getitem__(self, i):
+        """
+            :return: command object holding the registers of snapshot i
+        """
+        if not -self.count <= i < self.count:
+            raise IndexError('snapshot index out of range')
+        i %= self.count
+        return mca3k_data.COMMANDS[self.command].from_buffer(self.read(i, i + 1)[0].tobytes())
+
+    def blocks(self, size=4096):
+        """
+            Replay the whole store in blocks of decoded snapshots.
+            :return: generator of (first index, (n, num_items) array)
+        """
+        size = max(self.keyframe_interval, size//self.keyframe_interval*self.keyframe_interval)
+        for start in range(0, self.count, size):
+            yield start, self.read(start, start + size)
+
+
+def check_round_trip(command, num=200, keyframe_interval=16, reopen_at=(37, 120), seed=0):
+    """
+        Write random snapshots of a command to a temporary store, closing and reopening the writer in between
+        (also in the middle of a keyframe interval), and compare what is read back with what was written.
+        :return: None; raises AssertionError on a mismatch
+    """
+    proto = mca3k_data.COMMANDS[command]()
+    storage, _ = REGISTER_DTYPES[proto.data_type]
+    rng = np.random.default_rng(seed)
+    if proto.data_type == 'f':
+        rows = np.cumsum(rng.normal(0.0, 1.0, (num, proto.num_items)), axis=0).astype(storage)
+    else:
+        rows = np.cumsum(rng.integers(0, 50, (num, proto.num_items)), axis=0).astype(storage)
+    path = tempfile.mkdtemp(prefix='snapshot_store_')
+    try:
+        start = 0
+        for stop in list(reopen_at) + [num]:
+            with snapshot_store_writer(path, command, keyframe_interval) as writer:
+                for i in range(start, stop):
+                    writer.append(rows[i], float(i))
+            start = stop
+        store = snapshot_store(path)
+        assert len(store) == num, f'{command}: {len(store)} snapshots read back, {num} written'
+        back = store.read()
+        assert back.tobytes() == rows.tobytes(), f'{command}: snapshots differ after reopening the writer'
+        assert store[reopen_at[0]].to_bytes() == rows[reopen_at[0]].tobytes()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    for name in ('fpga_histogram', 'fpga_time_slice', 'arm_status', 'arm_ctrl', 'arm_cal'):
+        check_round_trip(name)
+    print('snapshot_store round trips ok')
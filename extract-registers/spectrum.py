@@ -0,0 +1,431 @@
+"""
+    Analysis of 4096-bin fpga_histogram spectra: peak search, Gaussian peak fits, ROI integrals and energy
+    calibration, in numpy only.
+
+    find_peaks() correlates the spectrum with the negative second derivative of a Gaussian (a smoothed second
+    difference): a linear background gives no response, a peak of width sigma gives a maximum at its centroid.
+    The Poisson variance of the filter output gives each maximum a significance in standard deviations.
+    fit_peaks() fits one or more Gaussians on a linear background with Levenberg-Marquardt and Poisson weights and
+    returns the parameters with their uncertainties.  roi_integrals() integrates many ROIs at once from the
+    cumulative sum, with a background estimated from the bins on both sides.  energy_calibration is a polynomial
+    from MCA bins to energy fitted to known lines.
+
+    spectrum_engine combines them for successive readouts of the same detector: after a first full analysis it
+    seeds each fit with the previous result (areas scaled with the total counts), so a fit usually converges in one
+    or two iterations and the peak search can be skipped; fits that fail or move fall back to a cold start.  The
+    search is repeated while no peaks were found, every search_every analyses, and whenever the total counts grew by
+    search_growth since the last search, so peaks that emerge later are picked up.
+"""
+import numpy as np
+
+import mca3k_data
+
+NUM_BINS = 4096
+SQRT_2PI = np.sqrt(2.0*np.pi)
+FWHM = 2.0*np.sqrt(2.0*np.log(2.0))  # FWHM of a Gaussian in units of sigma
+
+
+def histogram_counts(histogram):
+    """
+        :param histogram: fpga_histogram object, or array-like of counts per MCA bin
+        :return: float64 array of counts
+    """
+    if isinstance(histogram, mca3k_data.fpga_histogram):
+        histogram = histogram.registers
+    return np.asarray(histogram, dtype=np.float64)
+
+
+def find_peaks(counts, sigma=3.0, threshold=5.0, lo=0, hi=None):
+    """
+        Search peaks with a second-derivative-of-Gaussian filter.
+        :param counts: counts per MCA bin
+        :param sigma: expected peak width (standard deviation) in bins
+        :param threshold: minimum significance in standard deviations
+        :param lo: first bin searched
+        :param hi: end of the searched bins, default all
+        :return: dictionary of arrays sorted by bin: 'centroid' (bins, parabola-interpolated), 'bin' (int),
+                 'significance', 'height' (filter response, about the peak height times the kernel sum)
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    half = int(np.ceil(4*sigma))
+    x = np.arange(-half, half + 1, dtype=np.float64)
+    kernel = (1.0 - (x/sigma)**2)*np.exp(-0.5*(x/sigma)**2)
+    kernel -= kernel.mean()  # Zero response to a constant (and, being symmetric, to a linear) background
+    response = np.convolve(counts, kernel, 'same')
+    variance = np.convolve(counts, kernel*kernel, 'same')
+    signif = response/np.sqrt(np.maximum(variance, 1.0))
+
+    # The filter runs off the spectrum within half a kernel of both ends
+    hi = len(counts) if hi is None else hi
+    i = np.arange(max(lo, half), min(hi, len(counts) - half))
+    s = response
+    is_peak = (s[i] > s[i - 1]) & (s[i] >= s[i + 1]) & (signif[i] > threshold)
+    i = i[is_peak]
+    curv = s[i - 1] - 2.0*s[i] + s[i + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(curv < 0, 0.5*(s[i - 1] - s[i + 1])/curv, 0.0)
+    return {
+        'centroid': i + 0.5 + np.clip(shift, -0.5, 0.5),  # Bin centers are at i + 0.5
+        'bin': i,
+        'significance': signif[i],
+        'height': response[i],
+    }
+
+
+def _model(x, p, num):
+    """
+        Linear background plus num Gaussians, and the Jacobian.
+        :param p: b0, b1, then area, centroid, sigma of each peak; b1 is the slope relative to x[0]
+        :return: (model, jacobian of shape (len(x), len(p)))
+    """
+    dx = x - x[0]
+    jac = np.empty((len(x), len(p)))
+    jac[:, 0] = 1.0
+    jac[:, 1] = dx
+    y = p[0] + p[1]*dx
+    for k in range(num):
+        a, mu, sd = p[2 + 3*k:5 + 3*k]
+        z = (x - mu)/sd
+        g = np.exp(-0.5*z*z)/(SQRT_2PI*sd)
+        y = y + a*g
+        jac[:, 2 + 3*k] = g
+        jac[:, 3 + 3*k] = a*g*z/sd
+        jac[:, 4 + 3*k] = a*g*(z*z - 1.0)/sd
+    return y, jac
+
+
+def fit_peaks(counts, centroids, sigma=3.0, lo=None, hi=None, seed=None, max_iter=50, tol=1e-2):
+    """
+        Fit Gaussians on a linear background to a part of a spectrum (Levenberg-Marquardt, Poisson weights).
+        :param counts: counts per MCA bin
+        :param centroids: initial peak centroids in bins; one Gaussian each
+        :param sigma: initial width in bins (number or one per peak)
+        :param lo: first bin of the fit range, default 4 sigma below the lowest centroid
+        :param hi: end of the fit range, default 4 sigma above the highest centroid
+        :param seed: full parameter vector (as in the returned 'params') to start from instead of estimates
+        :param tol: the fit has converged when an iteration lowers chi2 by less than this
+        :return: dictionary with 'params' (b0, b1, then area, centroid, sigma per peak), 'errors', 'covariance',
+                 'centroid', 'sigma', 'area', 'fwhm' arrays and their '..._err', 'background' (b0, b1),
+                 'lo', 'hi', 'chi2', 'ndf', 'iterations' and 'converged'
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    centroids = np.atleast_1d(np.asarray(centroids, dtype=np.float64))
+    num = len(centroids)
+    sigmas = np.broadcast_to(np.asarray(sigma, dtype=np.float64), (num,))
+    if lo is None:
+        lo = int(np.floor(np.min(centroids - 4*sigmas)))
+    if hi is None:
+        hi = int(np.ceil(np.max(centroids + 4*sigmas)))
+    lo, hi = max(0, int(lo)), min(len(counts), int(hi))
+    y = counts[lo:hi]
+    x = np.arange(lo, hi) + 0.5
+    if len(y) < 3*num + 3:
+        raise ValueError(f'fit range [{lo}, {hi}) is too short for {num} peaks')
+    w = 1.0/np.maximum(y, 1.0)  # Poisson weights; empty bins count as 1
+
+    if seed is not None:
+        p = np.array(seed, dtype=np.float64)
+    else:
+        edge = max(2, len(y)//10)
+        left, right = y[:edge].mean(), y[-edge:].mean()
+        p = [left, (right - left)/max(len(y) - edge, 1)]
+        for c, sd in zip(centroids, sigmas):
+            b = int(np.clip(np.floor(c) - lo, 0, len(y) - 1))
+            height = max(y[b] - (left + (right - left)*b/len(y)), 1.0)
+            p += [height*SQRT_2PI*sd, c, sd]
+        p = np.array(p)
+
+    lam = 1e-3
+    model, jac = _model(x, p, num)
+    chi2 = np.sum(w*(y - model)**2)
+    converged = False
+    it = 0
+    for it in range(1, max_iter + 1):
+        jw = jac*w[:, None]
+        alpha = jw.T @ jac
+        beta = jw.T @ (y - model)
+        while True:
+            step = np.linalg.solve(alpha + lam*np.diag(np.diag(alpha)) + 1e-12*np.eye(len(p)), beta)
+            trial = p + step
+            if np.all(trial[4::3] > 0):
+                trial_model, trial_jac = _model(x, trial, num)
+                trial_chi2 = np.sum(w*(y - trial_model)**2)
+                if trial_chi2 <= chi2*(1.0 + 1e-12):
+                    break
+            lam *= 10.0
+            if lam > 1e10:
+                break
+        if lam > 1e10:
+            break
+        done = chi2 - trial_chi2 <= tol
+        p, model, jac, chi2 = trial, trial_model, trial_jac, trial_chi2
+        lam = max(lam/10.0, 1e-7)
+        if done:
+            converged = True
+            break
+
+    alpha = (jac*w[:, None]).T @ jac
+    try:
+        cov = np.linalg.inv(alpha)
+    except np.linalg.LinAlgError:
+        cov = np.full((len(p), len(p)), np.nan)
+    ndf = max(len(y) - len(p), 1)
+    cov *= max(chi2/ndf, 1.0)  # Inflate the errors of a poor fit
+    err = np.sqrt(np.abs(np.diag(cov)))
+    return {
+        'params': p, 'errors': err, 'covariance': cov,
+        'area': p[2::3], 'area_err': err[2::3],
+        'centroid': p[3::3], 'centroid_err': err[3::3],
+        'sigma': p[4::3], 'sigma_err': err[4::3],
+        'fwhm': FWHM*p[4::3], 'fwhm_err': FWHM*err[4::3],
+        'background': p[:2], 'lo': lo, 'hi': hi,
+        'chi2': float(chi2), 'ndf': ndf, 'iterations': it, 'converged': converged,
+    }
+
+
+def roi_integrals(counts, rois, side=3):
+    """
+        Gross and net counts of many ROIs at once.  The background under an ROI is the trapezoid between the
+        average of the side bins left and right of it.
+        :param counts: counts per MCA bin
+        :param rois: (lo, hi) pair or sequence of pairs, bins lo <= bin < hi
+        :param side: number of bins on each side used for the background; 0 for none
+        :return: dictionary of arrays 'lo', 'hi', 'gross', 'gross_err', 'background', 'background_err', 'net',
+                 'net_err'
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    rois = np.atleast_2d(np.asarray(rois, dtype=np.int64))
+    lo = np.clip(rois[:, 0], 0, len(counts))
+    hi = np.clip(rois[:, 1], lo, len(counts))
+    csum = np.concatenate(([0.0], np.cumsum(counts)))
+    gross = csum[hi] - csum[lo]
+    width = (hi - lo).astype(np.float64)
+    if side > 0:
+        l0 = np.maximum(lo - side, 0)
+        r1 = np.minimum(hi + side, len(counts))
+        nl = np.maximum(lo - l0, 1)
+        nr = np.maximum(r1 - hi, 1)
+        left = csum[lo] - csum[l0]
+        right = csum[r1] - csum[hi]
+        background = width*(left/nl + right/nr)/2.0
+        background_var = (width/2.0)**2*(left/nl**2 + right/nr**2)
+    else:
+        background = np.zeros_like(gross)
+        background_var = np.zeros_like(gross)
+    return {
+        'lo': lo, 'hi': hi,
+        'gross': gross, 'gross_err': np.sqrt(gross),
+        'background': background, 'background_err': np.sqrt(background_var),
+        'net': gross - background, 'net_err': np.sqrt(gross + background_var),
+    }
+
+
+def ctrl_roi(ctrl):
+    """
+        The ROI configured in an fpga_ctrl object, for roi_integrals.
+        :return: (roi_low, roi_high) in MCA bins
+    """
+    ctrl.registers_2_fields()
+    ctrl.fields_2_user()
+    return ctrl.user['roi_low'], ctrl.user['roi_high']
+
+
+class energy_calibration:
+    def __init__(self, coeffs=(1.0, 0.0), covariance=None):
+        """
+            :param coeffs: polynomial from MCA bins to energy, highest power first (as numpy.polyval takes them)
+            :param covariance: covariance matrix of coeffs, if known
+        """
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)
+        self.covariance = None if covariance is None else np.asarray(covariance, dtype=np.float64)
+
+    @classmethod
+    def fit(cls, bins, energies, degree=1, bin_errors=None):
+        """
+            Least-squares polynomial through known lines.
+            :param bins: fitted centroids of the lines in MCA bins
+            :param energies: energies of the lines
+            :param degree: polynomial degree; needs at least degree + 1 lines
+            :param bin_errors: centroid uncertainties in bins, used as weights
+            :return: new energy_calibration
+        """
+        bins = np.asarray(bins, dtype=np.float64)
+        energies = np.asarray(energies, dtype=np.float64)
+        if len(bins) < degree + 1:
+            raise ValueError(f'a degree {degree} calibration needs at least {degree + 1} lines')
+        if bin_errors is None:
+            coeffs = np.polyfit(bins, energies, degree)
+            return cls(coeffs)
+        # Convert the centroid errors to energy errors with the slope of an unweighted first pass
+        slope = np.polyval(np.polyder(np.polyfit(bins, energies, degree)), bins)
+        sd = np.maximum(np.abs(slope*np.asarray(bin_errors, dtype=np.float64)), 1e-12)
+        if len(bins) > degree + 1:
+            coeffs, cov = np.polyfit(bins, energies, degree, w=1.0/sd, cov='unscaled')
+        else:
+            coeffs, cov = np.polyfit(bins, energies, degree, w=1.0/sd), None
+        return cls(coeffs, cov)
+
+    def __call__(self, bins):
+        """
+            :return: energies of MCA bin positions
+        """
+        return np.polyval(self.coeffs, bins)
+
+    def bins(self, energies, num_bins=NUM_BINS):
+        """
+            Inverse of the calibration over the spectrum range; the polynomial must be monotonic there.
+            :return: MCA bin positions of energies
+        """
+        grid = np.arange(num_bins + 1, dtype=np.float64)
+        table = self(grid)
+        if table[-1] < table[0]:
+            return np.interp(energies, table[::-1], grid[::-1])
+        return np.interp(energies, table, grid)
+
+    def bin_edges(self, num_bins=NUM_BINS):
+        """
+            :return: energies of the num_bins + 1 MCA bin edges
+        """
+        return self(np.arange(num_bins + 1, dtype=np.float64))
+
+    def to_dict(self):
+        return {'coeffs': self.coeffs.tolist(),
+                'covariance': None if self.covariance is None else self.covariance.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['coeffs'], d.get('covariance'))
+
+
+class spectrum_engine:
+    def __init__(self, sigma=3.0, threshold=5.0, max_peaks=8, lines=(), rois=(), side=3, degree=1,
+                 max_shift=None, search_every=16, search_growth=2.0):
+        """
+            :param sigma: expected peak width in bins, for the search and as the initial fit width
+            :param threshold: peak search significance in standard deviations
+            :param max_peaks: number of most significant search hits that are fitted
+            :param lines: (approximate bin, energy) of known lines; their fits give the energy calibration
+            :param rois: (lo, hi) ROIs in bins, or fpga_ctrl objects whose roi_low/roi_high are used
+            :param side: background side bins of the ROI integrals
+            :param degree: degree of the energy calibration polynomial
+            :param max_shift: largest centroid move in bins accepted for a seeded fit, default 2 sigma
+            :param search_every: repeat the peak search after this many seeded analyses, to find new peaks
+            :param search_growth: repeat the peak search once the total counts grew by this factor since the last
+        """
+        self.sigma = sigma
+        self.threshold = threshold
+        self.max_peaks = max_peaks
+        self.lines = [(float(b), float(e)) for b, e in lines]
+        self.rois = [ctrl_roi(r) if isinstance(r, mca3k_data.fpga_ctrl) else tuple(r) for r in rois]
+        self.side = side
+        self.degree = degree
+        self.max_shift = 2.0*sigma if max_shift is None else max_shift
+        self.search_every = search_every
+        self.search_growth = search_growth
+        self.previous = None  # (total counts, fits) of the last analysis, the seeds of the next one
+        self.searched = 0.0  # Total counts at the last peak search
+        self.since_search = 0  # Seeded analyses since the last peak search
+        self.cold_fits = 0
+        self.seeded_fits = 0
+
+    def reset(self):
+        """
+            Forget the seeds, e.g. after a gain change; the next analysis is a cold start.
+            :return: None
+        """
+        self.previous = None
+        self.searched = 0.0
+        self.since_search = 0
+
+    def analyze(self, histogram, incremental=True):
+        """
+            :param histogram: fpga_histogram object or array of counts
+            :param incremental: reuse the previous fits as seeds and skip the peak search where they hold
+            :return: dictionary with 'total', 'peaks' (find_peaks result, None if skipped), 'fits' (fit_peaks
+                     result per fitted peak, with 'energy' once calibrated and 'line' for known lines),
+                     'rois' (roi_integrals result or None) and 'calibration' (energy_calibration or None)
+        """
+        counts = histogram_counts(histogram)
+        total = float(counts.sum())
+        fits, peaks = None, None
+        if incremental and self._seedable(total):
+            fits = self._seeded(counts, total)
+        if fits is None:
+            fits, peaks = self._cold(counts)
+            self.searched = total
+            self.since_search = 0
+        else:
+            self.since_search += 1
+
+        calibration = None
+        lines = [f for f in fits if f.get('line') is not None and f['converged']]
+        if len(lines) >= self.degree + 1:
+            calibration = energy_calibration.fit([f['centroid'][0] for f in lines], [f['line'] for f in lines],
+                                                 self.degree, [f['centroid_err'][0] for f in lines])
+            for f in fits:
+                f['energy'] = calibration(f['centroid'])
+                f['energy_fwhm'] = f['fwhm']*np.abs(np.polyval(np.polyder(calibration.coeffs), f['centroid']))
+
+        self.previous = (total, fits)
+        return {
+            'total': total,
+            'peaks': peaks,
+            'fits': fits,
+            'rois': roi_integrals(counts, self.rois, self.side) if self.rois else None,
+            'calibration': calibration,
+        }
+
+    def _cold(self, counts):
+        peaks = find_peaks(counts, self.sigma, self.threshold)
+        targets = [(b, e) for b, e in self.lines]
+        order = np.argsort(peaks['significance'])[::-1]
+        for c in peaks['centroid'][order[:self.max_peaks]]:
+            if all(abs(c - b) > 2*self.sigma for b, _ in targets):
+                targets.append((c, None))
+        fits = []
+        for c, line in sorted(targets, key=lambda t: t[0]):
+            if self.lines and line is not None:
+                # Known line: start from the nearest search hit
+                near = peaks['centroid'][np.abs(peaks['centroid'] - c) <= 3*self.sigma]
+                c = near[np.argmin(np.abs(near - c))] if len(near) else c
+            f = self._fit(counts, c, self.sigma, None)
+            if f is not None:
+                f['line'] = line
+                fits.append(f)
+                self.cold_fits += 1
+        return fits, peaks
+
+    def _seedable(self, total):
+        """
+            Whether the previous fits can seed this analysis: there are some, and the peak search is not due.
+        """
+        if self.previous is None or self.previous[0] <= 0 or not self.previous[1]:
+            return False
+        return self.since_search < self.search_every and total < self.search_growth*self.searched
+
+    def _seeded(self, counts, total):
+        """
+            Refit the previous peaks from their parameters; None if any of them no longer holds.
+        """
+        scale = total/self.previous[0]
+        fits = []
+        for old in self.previous[1]:
+            seed = old['params'].copy()
+            seed[0:2] *= scale
+            seed[2::3] *= scale
+            f = self._fit(counts, old['centroid'][0], old['sigma'][0], seed, old['lo'], old['hi'])
+            if f is None or not f['converged'] or abs(f['centroid'][0] - old['centroid'][0]) > self.max_shift:
+                return None
+            f['line'] = old.get('line')
+            fits.append(f)
+        self.seeded_fits += len(fits)
+        return fits
+
+    def _fit(self, counts, centroid, sigma, seed, lo=None, hi=None):
+        try:
+            f = fit_peaks(counts, [centroid], sigma, lo, hi, seed=seed)
+        except (ValueError, np.linalg.LinAlgError):
+            return None
+        if not (f['lo'] <= f['centroid'][0] < f['hi']) or f['area'][0] <= 0:
+            return None
+        return f
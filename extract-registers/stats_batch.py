@@ -0,0 +1,96 @@
+"""
+    Columnar decoding of fpga_statistics snapshot series.
+
+    A series of N statistics readouts is an (N, 16) uint32 register matrix.  statistics_columns converts it into
+    the quantities of fpga_statistics.fields_2_user, one array per key and bank.  statistics_deltas does the same
+    for the differences between consecutive snapshots, giving the rates over each polling interval.
+"""
+import numpy as np
+
+# Register offsets of the counters in each bank, as in fpga_statistics.registers_2_fields
+BANK_REGISTERS = {
+    'bank_0': {'ct': 0, 'ev': 1, 'ts': 2, 'dt': 3, 'xev0': 8, 'xev1': 9, 'xev2': 10, 'xev3': 11},
+    'bank_1': {'ct': 4, 'ev': 5, 'ts': 6, 'dt': 7, 'xev0': 12, 'xev1': 13, 'xev2': 14, 'xev3': 15},
+}
+COUNTER_RATES = (('ev', 'event_rate'), ('ts', 'trigger_rate'),
+                 ('xev0', 'xev0_rate'), ('xev1', 'xev1_rate'), ('xev2', 'xev2_rate'), ('xev3', 'xev3_rate'))
+
+
+def _as_matrix(registers):
+    regs = np.asarray(registers)
+    if regs.ndim != 2 or regs.shape[1] != 16:
+        raise ValueError('statistics registers must have shape (N, 16)')
+    return regs.astype(np.uint32, copy=False)
+
+
+def _bank_user(counts, adc_sr):
+    """
+        fields_2_user for one bank on arrays of counter values (float64).
+        :param counts: dictionary of counter arrays keyed like fpga_statistics fields ('ct', 'ev', ...)
+        :return: dictionary of arrays keyed like fpga_statistics user
+    """
+    ct = counts['ct']
+    valid = ct > 0
+    rt = ct*65536/adc_sr
+    dt = counts['dt']*65536/adc_sr
+    live = valid & (rt > dt)
+    safe_rt = np.where(valid, rt, 1.0)
+    safe_live = np.where(live, rt - dt, 1.0)
+    zero = np.zeros_like(rt)
+
+    user = {
+        'run_time': np.where(valid, rt, zero),
+        'dead_time': np.where(valid, dt, zero),
+    }
+    for name, key in COUNTER_RATES:
+        user[key] = np.where(valid, counts[name]/safe_rt, zero)
+    user['pulse_rate'] = np.where(live, counts['ts']/safe_live, zero)
+    for name, key in COUNTER_RATES:
+        user[key + '_err'] = np.where(valid, 2.0*np.sqrt(counts[name])/safe_rt, zero)  # 2-sigma error
+    user['pulse_rate_err'] = np.where(live, 2.0*np.sqrt(counts['ts'])/safe_live, zero)
+    return user
+
+
+def statistics_fields(registers):
+    """
+        Columnar registers_2_fields: the raw counters of both banks.
+        :param registers: (N, 16) array-like of fpga_statistics registers
+        :return: {'bank_0': {'ct': array, ...}, 'bank_1': {...}} with uint32 column views
+    """
+    regs = _as_matrix(registers)
+    return {bank: {name: regs[:, col] for name, col in offsets.items()} for bank, offsets in BANK_REGISTERS.items()}
+
+
+def statistics_columns(registers, adc_sr=40.0e6):
+    """
+        Columnar fields_2_user over a series of statistics snapshots.
+        Each snapshot gives the same numbers as fpga_statistics.fields_2_user on its registers.
+        :param registers: (N, 16) array-like of fpga_statistics registers
+        :param adc_sr: ADC sampling rate in Hz
+        :return: {'bank_0': {'run_time': array, ...}, 'bank_1': {...}} with float64 arrays of length N
+    """
+    fields = statistics_fields(registers)
+    return {bank: _bank_user({k: v.astype(np.float64) for k, v in counts.items()}, adc_sr)
+            for bank, counts in fields.items()}
+
+
+def statistics_deltas(registers, adc_sr=40.0e6):
+    """
+        Rates over the intervals between consecutive snapshots.  The counters are cumulative; a counter that
+        wrapped past 2**32 is unwrapped, and where a bank's clock count went down (statistics were cleared) the
+        new counter values are taken as the interval counts.
+        :param registers: (N, 16) array-like of fpga_statistics registers, in acquisition order
+        :param adc_sr: ADC sampling rate in Hz
+        :return: same layout as statistics_columns with arrays of length N-1; run_time and dead_time are the
+                 interval lengths
+    """
+    fields = statistics_fields(registers)
+    out = {}
+    for bank, counts in fields.items():
+        cleared = counts['ct'][1:] < counts['ct'][:-1]
+        deltas = {}
+        for name, col in counts.items():
+            d = (col[1:] - col[:-1]).astype(np.float64)  # uint32 subtraction wraps modulo 2**32
+            deltas[name] = np.where(cleared, col[1:].astype(np.float64), d)
+        out[bank] = _bank_user(deltas, adc_sr)
+    return out
@@ -0,0 +1,143 @@
+"""
+    Fixed-capacity ring buffer of fpga_time_slice readouts.
+
+    Every slice is decoded straight into preallocated arrays: a (capacity, 1006) histogram block and one
+    array per scalar field.  Each row is stored twice, at slot and slot + capacity, so the most recent n slices
+    are always one contiguous block; spectrogram() and column() return views, never copies.  Memory use is
+    fixed by the capacity.
+"""
+import numpy as np
+
+from lm_stream import buffer_words
+
+DWELL_TIME = 0.1048576  # 64*65536/40e6, as in fpga_time_slice.registers_2_fields
+NUM_BINS = 1024 - 18
+
+# Scalar columns: name -> dtype
+COLUMNS = {
+    'buffer_number': np.uint16,
+    'temperature': np.float64,  # deg C
+    'gamma_events': np.uint16,
+    'gamma_triggers': np.uint16,
+    'dead_time': np.float64,  # seconds
+    'neutron_counts': np.uint16,
+    'gm_counts': np.uint16,
+}
+
+
+class time_slice_ring:
+    def __init__(self, capacity=1200, adc_sr=40.0e6, dwell_time=DWELL_TIME):
+        """
+            :param capacity: number of slices kept; 1200 slices are a little over two minutes
+            :param adc_sr: ADC sampling rate in Hz, for the dead time
+            :param dwell_time: duration of one slice in seconds
+        """
+        self.capacity = int(capacity)
+        self.adc_sr = adc_sr
+        self.dwell_time = dwell_time
+        self.count = 0  # Slices pushed so far
+        self.histograms = np.zeros((2*self.capacity, NUM_BINS), dtype=np.uint16)
+        self.columns = {name: np.zeros(2*self.capacity, dtype=dt) for name, dt in COLUMNS.items()}
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        self.count = 0
+
+    def push(self, buf):
+        """
+            Decode one time slice buffer into the ring, overwriting the oldest slice when full.
+            :param buf: fpga_time_slice object, bytes-like buffer or sequence of its 1024 registers
+            :return: None
+        """
+        words = buffer_words(buf)
+        slot = self.count % self.capacity
+        for row in (slot, slot + self.capacity):
+            self.histograms[row] = words[18:1024]
+            self.columns['buffer_number'][row] = words[0]
+            self.columns['temperature'][row] = words[1]/16.0
+            self.columns['gamma_events'][row] = words[8]
+            self.columns['gamma_triggers'][row] = words[10]
+            self.columns['dead_time'][row] = (int(words[12]) + int(words[13])*65536.0)/self.adc_sr
+            self.columns['neutron_counts'][row] = words[14]
+            self.columns['gm_counts'][row] = words[16]
+        self.count += 1
+
+    def _rows(self, n):
+        n = len(self) if n is None else min(int(n), len(self))
+        end = (self.count - 1) % self.capacity + self.capacity + 1 if self.count else 0
+        return slice(end - n, end)
+
+    def spectrogram(self, n=None):
+        """
+            View of the histograms of the last n slices (all kept slices by default), oldest first.
+            The view is only valid until the slices in it are overwritten.
+            :return: (n, 1006) uint16 array view
+        """
+        return self.histograms[self._rows(n)]
+
+    def column(self, name, n=None):
+        """
+            View of a scalar column over the last n slices, oldest first.
+            :param name: one of COLUMNS
+            :return: 1-D array view
+        """
+        return self.columns[name][self._rows(n)]
+
+    def times(self, n=None):
+        """
+            Start time of each of the last n slices in seconds, counting from the first slice pushed.
+            :return: float64 array
+        """
+        rows = self._rows(n)
+        first = self.count - (rows.stop - rows.start)
+        return np.arange(first, self.count)*self.dwell_time
+
+    def live_time(self, n=None):
+        """
+            Live time of each of the last n slices in seconds.
+            :return: float64 array
+        """
+        return np.maximum(self.dwell_time - self.column('dead_time', n), 0.0)
+
+    def rates(self, name='gamma_events', n=None):
+        """
+            Dead-time-corrected rate of a counter column for each of the last n slices, in counts per second.
+            Slices without live time get rate 0.
+            :return: float64 array
+        """
+        live = self.live_time(n)
+        counts = self.column(name, n)
+        return np.divide(counts, live, out=np.zeros(len(live)), where=live > 0)
+
+    def spectral_rates(self, n=None):
+        """
+            Dead-time-corrected spectrogram in counts per second per bin.
+            :return: (n, 1006) float64 array
+        """
+        live = self.live_time(n)
+        hist = self.spectrogram(n)
+        return np.divide(hist, live[:, None], out=np.zeros(hist.shape), where=live[:, None] > 0)
+
+    def window_sum(self, window):
+        """
+            Sum of the histograms of the last window slices.
+            :return: (1006,) uint32 array
+        """
+        return self.spectrogram(window).sum(axis=0, dtype=np.uint32)
+
+    def rolling_sum(self, window, name=None, n=None):
+        """
+            Sums over every run of window consecutive slices within the last n slices.
+            :param window: number of slices per sum
+            :param name: scalar column to sum; None sums the histograms
+            :return: (n - window + 1, 1006) or (n - window + 1,) array; row i covers slices i .. i + window - 1
+        """
+        data = self.spectrogram(n) if name is None else self.column(name, n)
+        if window < 1 or window > len(data):
+            raise ValueError(f'window must be between 1 and {len(data)}')
+        acc = np.float64 if data.dtype.kind == 'f' else np.int64
+        cs = np.zeros((len(data) + 1,) + data.shape[1:], dtype=acc)
+        np.cumsum(data, axis=0, dtype=acc, out=cs[1:])
+        return cs[window:] - cs[:-window]
@@ -0,0 +1,130 @@
+"""
+    Batch version of fpga_trace.trace_summary for many traces at once.
+
+    The traces are stacked into an (N, L) array of raw trace registers.  The only sequential part of the
+    algorithm, the baseline tracker that runs until the trigger, steps through the samples once for all traces
+    together; everything after the trigger is done with whole-array operations.  Very large sets are cut into
+    blocks, which can be spread over a process pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+THR = 10*32  # Trigger threshold above the baseline, raw units
+B_THR = 3*32  # Baseline band, raw units
+
+
+def _first_true(mask, default):
+    """
+        Column index of the first True in every row of a 2-D boolean array, or default where a row has none.
+    """
+    idx = np.argmax(mask, axis=1)
+    return np.where(mask[np.arange(len(mask)), idx], idx, default)
+
+
+def _last_true(mask, default):
+    idx = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    return np.where(mask[np.arange(len(mask)), idx], idx, default)
+
+
+def summarize_block(traces, adc_sr=40.0e6):
+    """
+        Summarize one block of traces; see trace_summary_batch.
+    """
+    tr = np.asarray(traces, dtype=np.float64)
+    num, tlen = tr.shape
+    rows = np.arange(num)
+    cols = np.arange(tlen)
+
+    # Baseline tracking up to the trigger, identical to the per-sample loop in fpga_trace.trace_summary
+    dc = tr[:, 0].copy()
+    n0 = np.zeros(num, dtype=np.intp)
+    active = np.ones(num, dtype=bool)
+    for i in range(1, tlen):
+        if not active.any():
+            break
+        t = tr[:, i]
+        diff = t - dc
+        track = active & (np.abs(diff) < B_THR)
+        dc[track] = 7 / 8 * dc[track] + t[track] / 8
+        fire = active & ~track & (diff > THR)
+        n0[fire] = i
+        active &= ~fire
+    found = ~active
+
+    # Pulse extent: from the trigger to the first sample back within B_THR of the baseline
+    after = cols[None, :] >= n0[:, None]
+    below = after & (tr - dc[:, None] < B_THR)
+    n1 = _first_true(below, tlen - 1)
+    measurable = found & (n1 > n0)
+
+    in_pulse = after & (cols[None, :] < n1[:, None])
+    energy = np.where(after & (cols[None, :] <= n1[:, None]), tr, 0.0).sum(axis=1)
+    pulse = np.where(in_pulse, tr, -np.inf)
+    xmax = np.argmax(pulse, axis=1)
+    ymax = pulse[rows, xmax]
+    xmax -= n0
+
+    def crossings(frac):
+        above = in_pulse & (pulse > frac*ymax[:, None])
+        return _first_true(above, 0) - n0, _last_true(above, 0) - n0
+
+    xrise10, xfall10 = crossings(0.1)
+    xrise50, xfall50 = crossings(0.5)
+    xrise90, xfall90 = crossings(0.9)
+
+    # Noise of the baseline samples before the trigger, trace[1:n0-1]
+    pre = (cols[None, :] >= 1) & (cols[None, :] < (n0 - 1)[:, None])
+    npre = np.maximum(n0 - 2, 1)
+    pre_avg = np.where(pre, tr, 0.0).sum(axis=1) / npre
+    pre_var = np.where(pre, (tr - pre_avg[:, None])**2, 0.0).sum(axis=1) / np.maximum(n0 - 3, 1)
+    pre_std = np.where(n0 > 3, np.sqrt(pre_var), 0.0)
+
+    # Whole-trace statistics, reported for traces without a pulse
+    avg = tr.mean(axis=1)
+    full_std = tr.std(axis=1, ddof=1) if tlen > 1 else np.zeros(num)
+
+    nan = np.full(num, np.nan)
+    out = {
+        'pulse_found': np.where(measurable, 1, np.where(found, -1, 0)).astype(np.int8),
+        'mca_bin': np.where(measurable, energy, nan),
+        'ymax': np.where(measurable, ymax, nan),
+        'rise_time': np.where(measurable, (xrise90 - xrise10) / adc_sr, nan),
+        'peaking_time': np.where(measurable, xmax / adc_sr, nan),
+        'fall_time': np.where(measurable, (xfall10 - xfall90) / adc_sr, nan),
+        'fwhm': np.where(measurable, (xfall50 - xrise50) / adc_sr, nan),
+        'dc_val': np.where(found, dc, nan),
+        'std_dev': np.where(found, pre_std, full_std),
+        'mini': np.where(found, nan, tr.min(axis=1)),
+        'maxi': np.where(found, nan, tr.max(axis=1)),
+        'avg': np.where(found, nan, avg),
+    }
+    return out
+
+
+def trace_summary_batch(traces, adc_sr=40.0e6, block_size=4096, processes=None):
+    """
+        Summarize N traces like fpga_trace.trace_summary, returning one array per quantity.
+        pulse_found is 1 for a measured pulse, 0 when no sample crossed the trigger threshold and -1 when the
+        trigger was on the last sample.  Pulse quantities are NaN unless pulse_found is 1; mini, maxi and avg
+        are only set when pulse_found is 0.  std_dev is the pre-trigger baseline noise for triggered traces and
+        the whole-trace standard deviation otherwise.
+        :param traces: (N, 1024) array-like of raw fpga_trace registers (uint16)
+        :param adc_sr: ADC sampling rate in Hz
+        :param block_size: number of traces processed at once; bounds the temporary memory
+        :param processes: worker processes for sets larger than one block; None picks os.cpu_count(), 0 or 1
+                          runs everything in this process
+        :return: dictionary of arrays of length N
+    """
+    traces = np.asarray(traces)
+    if traces.ndim != 2:
+        raise ValueError('traces must be a 2-D array of shape (N, num_samples)')
+    blocks = [traces[i:i + block_size] for i in range(0, len(traces), block_size)]
+    if not blocks:
+        return summarize_block(np.zeros((0, traces.shape[1]), dtype=np.uint16), adc_sr)
+    if len(blocks) == 1 or processes in (0, 1):
+        results = [summarize_block(b, adc_sr) for b in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(summarize_block, blocks, [adc_sr]*len(blocks)))
+    return {k: np.concatenate([r[k] for r in results]) for k in results[0]}